@@ -0,0 +1,454 @@
+"""
+Local stand-ins for the services the pipeline talks to, so that benchmarks
+run without network access:
+
+- FakeServer serves the HTML fixtures as paper pages (optionally rendering
+  for a while), an arXiv listing page, an arXiv API feed and the CodiMD
+  endpoints used by codimd_client, including note updates, with optional
+  failures.
+- install_fake_openai replaces openai.ChatCompletion.acreate with a stream of
+  canned chunks.
+- FakeOpenAIServer is a local OpenAI/Azure chat completions endpoint, with a
+  configurable time to first token and failures, to test the endpoint pool
+  over real HTTP.
+"""
+import re
+import json
+import time
+import uuid
+import asyncio
+import threading
+import collections
+from urllib.parse import parse_qs, urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import openai
+
+_ENTRY_TPL = """<entry>
+<id>http://arxiv.org/abs/{arxiv_id}v1</id>
+<updated>2023-01-02T00:00:00Z</updated>
+<published>2023-01-01T00:00:00Z</published>
+<title>Benchmark paper {arxiv_id}</title>
+<summary>A synthetic paper used by the benchmarks.</summary>
+<author><name>Alice</name></author>
+<author><name>Bob</name></author>
+<category term="cs.CL" scheme="http://arxiv.org/schemas/atom"/>
+</entry>"""
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=b"", headers=None):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, data):
+        self._send(200, json.dumps(data), {"Content-Type": "application/json"})
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length)
+
+    def _count_and_fail(self, method, path):
+        """
+        Counts the request and answers 503 if its path has failures left.
+        Returns True if it did.
+        """
+        server = self.server
+        with server.lock:
+            server.requests[f"{method} {path}"] += 1
+            failures_left = server.failures.get(path, 0)
+            if failures_left:
+                server.failures[path] = failures_left - 1
+        if failures_left:
+            self._send(503, "Service unavailable")
+        return bool(failures_left)
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        url = urlsplit(self.path)
+        if self._count_and_fail("GET", url.path):
+            return
+
+        m = re.fullmatch(r"/papers/([^/]+)/?", url.path)
+        if m:
+            html = server.pages.get(m.group(1))
+            if html is None:
+                return self._send(404, "Not found")
+            with server.lock:
+                renders_left = server.rendering.get(m.group(1), 0)
+                if renders_left:
+                    server.rendering[m.group(1)] = renders_left - 1
+            if renders_left:
+                return self._send(503, "Render in progress")
+            return self._send(200, html, {"Content-Type": "text/html; charset=utf-8"})
+
+        if re.fullmatch(r"/list/[^/]+/new", url.path):
+            if server.listing is None:
+                return self._send(404, "Not found")
+            return self._send(
+                200, server.listing, {"Content-Type": "text/html; charset=utf-8"}
+            )
+
+        if url.path == "/api/query":
+            ids = parse_qs(url.query).get("id_list", [""])[0].split(",")
+            entries = "\n".join(_ENTRY_TPL.format(arxiv_id=i) for i in ids if i)
+            feed = f'<?xml version="1.0"?>\n<feed xmlns="http://www.w3.org/2005/Atom">\n{entries}\n</feed>'
+            return self._send(200, feed, {"Content-Type": "application/atom+xml"})
+
+        if url.path == "/me":
+            if "sid=1" in (self.headers.get("Cookie") or ""):
+                return self._send_json({"status": "ok", "email": "bench"})
+            return self._send_json({"status": "forbidden"})
+
+        if url.path == "/history":
+            with server.lock:
+                history = [
+                    {"id": note_id, "tags": [], "text": "Untitled", "time": 0}
+                    for note_id in server.notes
+                ]
+            return self._send_json({"history": history})
+
+        m = re.fullmatch(r"/([^/]+)/publish", url.path)
+        if m:
+            return self._send(302, f"Found. Redirecting to /s/{m.group(1)}")
+
+        self._send(404, "Not found")
+
+    def do_POST(self):
+        server = self.server
+        body = self._read_body()
+        if self._count_and_fail("POST", self.path):
+            return
+        if self.path == "/login":
+            with server.lock:
+                server.logins += 1
+            return self._send(302, "Found. Redirecting to /", {"Set-Cookie": "sid=1"})
+        if self.path.startswith("/new"):
+            note_id = uuid.uuid4().hex[:16]
+            with server.lock:
+                server.notes[note_id] = body.decode("utf-8")
+            return self._send(302, f"Found. Redirecting to /{note_id}")
+        self._send(404, "Not found")
+
+    def do_PUT(self):
+        server = self.server
+        body = self._read_body()
+        if self._count_and_fail("PUT", self.path):
+            return
+        m = re.fullmatch(r"/api/notes/([^/]+)", self.path)
+        if m is None:
+            return self._send(404, "Not found")
+        if not server.note_api:
+            return self._send(405, "Method not allowed")
+        note_id = m.group(1)
+        with server.lock:
+            if note_id not in server.notes:
+                return self._send(404, "Not found")
+            try:
+                server.notes[note_id] = json.loads(body)["content"]
+            except (ValueError, KeyError, TypeError):
+                return self._send(400, "Bad request")
+            server.note_updates[note_id] = server.note_updates.get(note_id, 0) + 1
+        self._send(200, "OK")
+
+
+class FakeServer:
+    """
+    Serves paper pages, the arXiv API and CodiMD on a local port.
+
+    Parameters:
+    pages (dict): page name -> HTML, served at /papers/<name>/
+    latency (float): Seconds to wait before answering a GET
+    listing (str): The HTML served at /list/<category>/new
+    rendering (dict): page name -> number of times the page answers 503
+    (render in progress) before it is served
+    failures (dict): request path (e.g. "/new") -> number of times a request
+    of the path answers 503 before it is served
+    note_api (bool): If False, note updates answer 405, as CodiMD servers
+    without the note API do
+    """
+
+    def __init__(
+        self,
+        pages,
+        latency=0.0,
+        listing=None,
+        rendering=None,
+        failures=None,
+        note_api=True,
+    ):
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.pages = pages
+        self._httpd.latency = latency
+        self._httpd.listing = listing
+        self._httpd.rendering = dict(rendering or {})
+        self._httpd.failures = dict(failures or {})
+        self._httpd.note_api = note_api
+        self._httpd.requests = collections.Counter()
+        self._httpd.notes = {}
+        self._httpd.note_updates = {}
+        self._httpd.logins = 0
+        self._httpd.lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address
+        return f"http://{host}:{port}"
+
+    @property
+    def notes(self):
+        return self._httpd.notes
+
+    @property
+    def logins(self):
+        return self._httpd.logins
+
+    @property
+    def rendering(self):
+        """
+        page name -> number of 503 answers left, can be changed while it runs
+        """
+        return self._httpd.rendering
+
+    @property
+    def failures(self):
+        """
+        request path -> number of failures left, can be changed while it runs
+        """
+        return self._httpd.failures
+
+    @property
+    def requests(self):
+        """
+        "METHOD path" -> number of requests, e.g. requests["GET /history"]
+        """
+        return self._httpd.requests
+
+    @property
+    def note_updates(self):
+        """
+        note ID -> number of times the note was updated
+        """
+        return self._httpd.note_updates
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+def _default_content():
+    return "\n".join(
+        f"A{i}: A synthetic answer to question {i}." for i in range(1, 9)
+    )
+
+
+class _OpenAIHandler(BaseHTTPRequestHandler):
+    # HTTP/1.0: the end of the event stream is the end of the connection
+    protocol_version = "HTTP/1.0"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_event(self, data):
+        self.wfile.write(f"data: {data}\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get("Content-Length") or 0)
+        self.rfile.read(length)
+        # /openai/deployments/<engine>/chat/completions for Azure
+        if not urlsplit(self.path).path.endswith("/chat/completions"):
+            self.send_error(404)
+            return
+        with server.lock:
+            server.requests += 1
+            fail = server.fail_status is not None and server.failures_left != 0
+            if fail and server.failures_left is not None:
+                server.failures_left -= 1
+        time.sleep(server.ttft)
+        if fail:
+            body = json.dumps({"error": {"message": "Fake failure", "type": "fake"}})
+            self.send_response(server.fail_status)
+            self.send_header("Content-Type", "application/json")
+            if server.retry_after is not None:
+                self.send_header("Retry-After", str(server.retry_after))
+            self.end_headers()
+            self.wfile.write(body.encode("utf-8"))
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        content = server.content
+        step = max(1, len(content) // server.num_chunks)
+
+        def event(delta, finish_reason=None):
+            choice = {"index": 0, "delta": delta, "finish_reason": finish_reason}
+            chunk = {"object": "chat.completion.chunk", "choices": [choice]}
+            return json.dumps(chunk)
+
+        self._send_event(event({"role": "assistant"}))
+        for i in range(0, len(content), step):
+            if server.chunk_delay:
+                time.sleep(server.chunk_delay)
+            self._send_event(event({"content": content[i : i + step]}))
+        self._send_event(event({}, "stop"))
+        self._send_event("[DONE]")
+
+
+class FakeOpenAIServer:
+    """
+    A chat completions endpoint on a local port, answering every request with
+    a stream of `content`. The attributes can be changed while it runs, e.g.
+    to make it fail:
+
+        with FakeOpenAIServer(ttft=0.2) as slow, FakeOpenAIServer() as fast:
+            fast.fail_status = 429
+            pool = EndpointPool([slow.endpoint("slow"), fast.endpoint("fast")])
+
+    Parameters:
+    content (str): The answer, defaults to synthetic answers
+    num_chunks (int): The number of chunks of the answer
+    ttft (float): Seconds before the first chunk (or the error)
+    chunk_delay (float): Seconds before each next chunk
+    fail_status (int): If set, requests fail with this HTTP status
+    failures_left (int): The number of requests that fail, None for all
+    retry_after (float): The Retry-After header of the failures
+    """
+
+    def __init__(
+        self,
+        content=None,
+        num_chunks=20,
+        ttft=0.0,
+        chunk_delay=0.0,
+        fail_status=None,
+        failures_left=None,
+        retry_after=None,
+    ):
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), _OpenAIHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.lock = threading.Lock()
+        self._httpd.requests = 0
+        self.content = content if content is not None else _default_content()
+        self.num_chunks = num_chunks
+        self.ttft = ttft
+        self.chunk_delay = chunk_delay
+        self.fail_status = fail_status
+        self.failures_left = failures_left
+        self.retry_after = retry_after
+        self._thread = None
+
+    # the handler reads the settings from the HTTP server
+    _SETTINGS = (
+        "content",
+        "num_chunks",
+        "ttft",
+        "chunk_delay",
+        "fail_status",
+        "failures_left",
+        "retry_after",
+    )
+
+    def __setattr__(self, name, value):
+        if name in self._SETTINGS:
+            with self._httpd.lock:
+                setattr(self._httpd, name, value)
+        else:
+            super().__setattr__(name, value)
+
+    def __getattr__(self, name):
+        if name in self._SETTINGS:
+            return getattr(self._httpd, name)
+        raise AttributeError(name)
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address
+        return f"http://{host}:{port}"
+
+    @property
+    def requests(self):
+        """
+        The number of requests received, failed ones included
+        """
+        return self._httpd.requests
+
+    def endpoint(self, name, **kwargs):
+        """
+        Returns an endpoints.Endpoint of this server.
+        """
+        from endpoints import Endpoint
+
+        return Endpoint(
+            name,
+            api_base=self.url,
+            api_key="fake",
+            api_type="azure",
+            api_version="2023-05-15",
+            **kwargs,
+        )
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+def install_fake_openai(content=None, num_chunks=100, chunk_delay=0.0):
+    """
+    Replaces openai.ChatCompletion.acreate with a fake that streams `content`
+    in num_chunks chunks, sleeping chunk_delay seconds before each one.
+    Returns a function that restores the original.
+    """
+    if content is None:
+        content = _default_content()
+    step = max(1, len(content) // num_chunks)
+    original = openai.ChatCompletion.acreate
+
+    async def stream():
+        yield {"choices": [{"delta": {"role": "assistant"}, "finish_reason": None}]}
+        for i in range(0, len(content), step):
+            if chunk_delay:
+                await asyncio.sleep(chunk_delay)
+            yield {
+                "choices": [
+                    {"delta": {"content": content[i : i + step]}, "finish_reason": None}
+                ]
+            }
+        yield {"choices": [{"delta": {}, "finish_reason": "stop"}]}
+
+    async def acreate(*args, **kwargs):
+        return stream()
+
+    openai.ChatCompletion.acreate = acreate
+
+    def restore():
+        openai.ChatCompletion.acreate = original
+
+    return restore
@@ -0,0 +1,180 @@
+"""
+Generates the HTML fixtures used by run_benchmarks.py.
+
+The fixtures mimic the markup of arxiv-vanity (MathJax spans, vanity header
+and footer) and ar5iv (MathML with annotations) pages: sections with <h2>
+titles, paragraphs with math, citations, footnotes, tables, subsections,
+references and appendices. They are generated from fixed seeds, so running
+this script again gives the same files.
+
+listing-new.html mimics the new submissions page of an arXiv category
+(/list/<category>/new), with the fixtures as papers (see LISTING_PAPERS).
+"""
+import gzip
+import random
+from pathlib import Path
+
+import click
+
+FIXTURES_DIR = Path(__file__).parent / "fixtures"
+
+# name -> (seed, number of numbered sections)
+SIZES = {"small": (1, 8), "medium": (2, 25), "large": (3, 70)}
+
+# The arXiv IDs of the listing fixture and the fixture served as each paper,
+# and the part of the listing each paper is in
+LISTING_PAPERS = (
+    ("2301.00001", "arxiv-vanity-small", "New submissions"),
+    ("2301.00002", "arxiv-vanity-medium", "New submissions"),
+    ("2301.00003", "arxiv-vanity-large", "New submissions"),
+    ("2301.00004", "ar5iv-small", "New submissions"),
+    ("2301.00005", "ar5iv-medium", "Cross-lists"),
+    ("2212.00006", "ar5iv-large", "Replacements"),
+)
+
+WORDS = (
+    "the model learns robust representations of data using attention and we "
+    "show that it improves accuracy on standard benchmarks while the training "
+    "cost of our method stays close to the baseline for every dataset"
+).split()
+
+
+def _mathml(i):
+    return (
+        f'<math id="m{i}" class="ltx_Math" alttext="x_{{{i}}}^{{2}}+\\alpha" display="inline">'
+        f"<semantics><mrow><msubsup><mi>x</mi><mn>{i}</mn><mn>2</mn></msubsup>"
+        f"<mo>+</mo><mi>α</mi></mrow>"
+        f'<annotation-xml encoding="MathML-Content"><apply><plus/><ci>x</ci></apply></annotation-xml>'
+        f'<annotation encoding="application/x-tex">x_{{{i}}}^{{2}}+\\alpha</annotation>'
+        f"</semantics></math>"
+    )
+
+
+def _mathjax(i):
+    return (
+        f'<span class="mjx-chtml"><span class="mjx-math" aria-label="x sub {i} squared" role="math">'
+        f'<span class="mjx-mrow"><span class="mjx-msubsup"><span class="mjx-mi">x</span>'
+        f'<span class="mjx-mn">{i}</span></span></span></span></span>'
+    )
+
+
+def _paragraph(r, i, vanity):
+    words = []
+    for k in range(r.randint(30, 120)):
+        words.append(r.choice(WORDS))
+        if r.random() < 0.05:
+            words.append(_mathjax(i * 1000 + k) if vanity else _mathml(i * 1000 + k))
+        if r.random() < 0.02:
+            words.append('<cite class="ltx_cite">[<a href="#bib.bib1">1</a>]</cite>')
+        if r.random() < 0.01:
+            words.append(
+                '<span class="ltx_note"><sup>1</sup><span class="ltx_note_outer">'
+                "Footnote&nbsp;text &amp; more italic_ a</span></span>"
+            )
+        if r.random() < 0.02:
+            words.append("\n   ")
+    return f'<p class="ltx_p">{" ".join(words)}</p>\n'
+
+
+def _table(r):
+    rows = "".join(
+        "<tr>" + "".join(f"<td class='ltx_td'>{r.random():.3f}</td>\n" for _ in range(6)) + "</tr>\n"
+        for _ in range(8)
+    )
+    return (
+        f'<figure class="ltx_table"><table class="ltx_tabular">\n<tbody>{rows}</tbody></table>'
+        f"<figcaption>Table 1: Results start_POSTSUPERSCRIPT a end_POSTSUPERSCRIPT</figcaption></figure>\n"
+    )
+
+
+def make_page(seed, num_sections, vanity):
+    r = random.Random(seed)
+    titles = [f"Section {i}" for i in range(1, num_sections + 1)]
+    titles += ["Acknowledgements", "References", "Appendix A Proofs", "Appendix B More"]
+    sections = []
+    for i, title in enumerate(titles):
+        body = "".join(_paragraph(r, i, vanity) for _ in range(r.randint(3, 9)))
+        if r.random() < 0.3:
+            body += _table(r)
+        if r.random() < 0.4:
+            body += (
+                f'<section class="ltx_subsection"><h3 class="ltx_title">{i}.1 Details</h3>'
+                f"{_paragraph(r, i + 500, vanity)}</section>"
+            )
+        heading = f'<h2 class="ltx_title ltx_title_section"><span class="ltx_tag">{i} </span>{title}</h2>'
+        sections.append(f'<section id="S{i}" class="ltx_section">\n{heading}\n{body}</section>\n')
+
+    if vanity:
+        head = "<title>A Paper – arXiv Vanity</title>"
+        header = (
+            "<header>arXiv Vanity renders academic papers from arXiv as responsive "
+            "web pages so you don’t have to squint at a PDF. View this paper on arXiv</header>"
+        )
+        footer = (
+            '<footer class="ltx_page_footer">Generated by LaTeXML <img src="x.png"/> '
+            "Want to hear about new tools we're making? Sign up</footer>"
+        )
+    else:
+        head = "<title>[2301.00000] A Paper</title>"
+        header = '<header class="ltx_page_header">ar5iv</header>'
+        footer = '<footer class="ltx_page_footer">Generated by LaTeXML</footer>'
+
+    return f"""<!DOCTYPE html><html lang="en"><head><meta charset="utf-8">{head}
+<script>var a = 1;</script><style>p {{}}</style></head>
+<body>{header}
+<div class="ltx_page_main"><div class="ltx_page_content">
+<article class="ltx_document ltx_authors_1line">
+<h1 class="ltx_title ltx_title_document">A Paper with a  Title</h1>
+<div class="ltx_authors"><span class="ltx_creator ltx_role_author"><span class="ltx_personname">Alice<br class="ltx_break">University of X</span></span></div>
+<div class="ltx_abstract"><h6 class="ltx_title">Abstract</h6>{_paragraph(r, 0, vanity)}</div>
+{"".join(sections)}
+</article></div>
+{footer}</div>
+</body></html>
+"""
+
+
+def make_listing():
+    parts = {}
+    for i, (arxiv_id, name, part) in enumerate(LISTING_PAPERS, start=1):
+        parts.setdefault(part, []).append(
+            f"""<dt><a name="item{i}">[{i}]</a>&nbsp; <span class="list-identifier"><a href="/abs/{arxiv_id}" title="Abstract">arXiv:{arxiv_id}</a> [<a href="/pdf/{arxiv_id}" title="Download PDF">pdf</a>, <a href="/format/{arxiv_id}" title="Other formats">other</a>]</span></dt>
+<dd><div class="meta">
+<div class="list-title mathjax"><span class="descriptor">Title:</span> A Paper with a Title ({name})</div>
+<div class="list-authors"><span class="descriptor">Authors:</span> <a href="/a/alice_a_1">Alice</a></div>
+<div class="list-subjects"><span class="descriptor">Subjects:</span> <span class="primary-subject">Computation and Language (cs.CL)</span></div>
+</div></dd>"""
+        )
+    body = "\n".join(
+        f"<h3>{part} for Mon, 2 Jan 23</h3>\n<dl>\n" + "\n".join(items) + "\n</dl>"
+        for part, items in parts.items()
+    )
+    return f"""<!DOCTYPE html><html lang="en"><head><meta charset="utf-8">
+<title>Computation and Language  authors/titles "new"</title></head>
+<body><div id="content"><h1>Computation and Language</h1>
+<h2>New submissions</h2>
+{body}
+</div></body></html>
+"""
+
+
+@click.command()
+def main():
+    """
+    Writes the fixtures to benchmarks/fixtures/<source>-<size>.html.gz, and
+    the listing to benchmarks/fixtures/listing-new.html.
+    """
+    FIXTURES_DIR.mkdir(exist_ok=True)
+    for source, vanity in (("arxiv-vanity", True), ("ar5iv", False)):
+        for size, (seed, num_sections) in SIZES.items():
+            html = make_page(seed, num_sections, vanity)
+            path = FIXTURES_DIR / f"{source}-{size}.html.gz"
+            path.write_bytes(gzip.compress(html.encode("utf-8"), mtime=0))
+            print(f"{path.name}: {len(html) // 1024} KB")
+    path = FIXTURES_DIR / "listing-new.html"
+    path.write_text(make_listing(), encoding="utf-8")
+    print(f"{path.name}: {len(LISTING_PAPERS)} papers")
+
+
+if __name__ == "__main__":
+    main()
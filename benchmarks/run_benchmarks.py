@@ -0,0 +1,465 @@
+"""
+Offline benchmarks of the fetch -> parse -> reduce -> prompt pipeline.
+
+Every stage runs over the HTML fixtures in benchmarks/fixtures, served by a
+local FakeServer. The end-to-end pipeline stage streams from a fake OpenAI
+and publishes to a fake CodiMD, so nothing leaves the machine.
+
+    python benchmarks/run_benchmarks.py --save-baseline   # on the base branch
+    python benchmarks/run_benchmarks.py --compare         # on the PR branch
+
+The startup stage imports read_paper in a new interpreter, as every run of
+the script does, and reports its slowest imports (python -X importtime). The
+prefetch stage runs prefetch.py over the listing fixture, whose papers are
+the HTML fixtures. The run fails if the parser backends extract different
+sections from a fixture.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import platform
+import tempfile
+import statistics
+import subprocess
+import tracemalloc
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+SRC_DIR = BENCH_DIR.parent / "src"
+sys.path.insert(0, str(SRC_DIR))
+
+# llm.py reads the OpenAI settings at import, the fake stream ignores them
+for _name in (
+    "OPENAI_API_KEY",
+    "OPENAI_API_BASE",
+    "OPENAI_API_TYPE",
+    "OPENAI_API_VERSION",
+):
+    os.environ.setdefault(_name, "benchmark")
+
+import click
+
+from fakes import FakeServer, install_fake_openai
+from make_fixtures import LISTING_PAPERS
+
+import arxiv_loader
+import codimd_client
+import read_paper
+import batch_read_papers
+import prefetch
+from arxiv_loader import (
+    PARSER_BACKENDS,
+    fetch_paper_html_async,
+    parse_paper_sections,
+    reduce_paper_content,
+    set_paper_cache,
+)
+from http_client import HttpClient
+from llm import make_chatml, set_response_cache
+from compaction import compact_sections
+from paper_cache import PaperCache, read_blob_text
+from prompt_templates import make_messages
+
+FIXTURES_DIR = BENCH_DIR / "fixtures"
+LISTING_FIXTURE = FIXTURES_DIR / "listing-new.html"
+DEFAULT_BASELINE = BENCH_DIR / "baseline.json"
+
+# The module imported by the startup stage, and the number of its slowest
+# imports reported
+STARTUP_MODULE = "read_paper"
+STARTUP_TOP_IMPORTS = 10
+
+
+def load_fixtures():
+    """
+    Returns the fixtures as (name, source, path) tuples, e.g.
+    ("ar5iv-large", "ar5iv", Path(".../ar5iv-large.html.gz")).
+    """
+    fixtures = []
+    for path in sorted(FIXTURES_DIR.glob("*.html.gz")):
+        name = path.name[: -len(".html.gz")]
+        source = "ar5iv" if name.startswith("ar5iv") else "arxiv-vanity"
+        fixtures.append((name, source, path))
+    return fixtures
+
+
+def get_encoder():
+    """
+    Returns the gpt-4 tiktoken encoder, or None if its BPE file is neither
+    cached (see TIKTOKEN_CACHE_DIR) nor downloadable.
+    """
+    import tiktoken
+
+    try:
+        return tiktoken.encoding_for_model("gpt-4")
+    except Exception:
+        return None
+
+
+def profile_imports(module):
+    """
+    Imports module in a new interpreter with -X importtime.
+
+    Returns:
+    imports (list of (str, float)): The name and the cumulative import time
+    in seconds of every module imported, slowest first
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=SRC_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    imports = []
+    # e.g. "import time:       567 |      51607 |     soupsieve"
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        if cumulative.strip().isdigit():
+            imports.append((name.strip(), int(cumulative) / 1e6))
+    imports.sort(key=lambda i: -i[1])
+    return imports
+
+
+def measure(func, repeat):
+    """
+    Runs func `repeat` times for the wall time (the median is reported), then
+    once more under tracemalloc for the peak of Python memory.
+
+    Returns:
+    wall (float): The median wall time in seconds
+    peak_mb (float): The peak of traced memory in MB
+    result: The result of the last run
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        result = func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return statistics.median(times), peak / 1024 / 1024, result
+
+
+class Benchmarks:
+    """
+    The benchmark stages, each a method that processes all fixtures and
+    returns the inputs of the next stage.
+    """
+
+    def __init__(self, server, repeat=3, max_parsers=2):
+        self.server = server
+        self.repeat = repeat
+        self.max_parsers = max_parsers
+        self.fixtures = load_fixtures()
+        self.enc = get_encoder()
+        self.results = {}
+
+    def run_stage(self, name, func, per_paper=True):
+        wall, peak_mb, result = measure(func, self.repeat)
+        n = len(self.fixtures) if per_paper else 0
+        self.results[name] = {
+            "wall": wall,
+            "papers_per_sec": n / wall if wall > 0 else 0.0,
+            "peak_mb": peak_mb,
+        }
+        return result
+
+    def startup(self):
+        """
+        Returns the imports of STARTUP_MODULE, slowest first, the wall time of
+        the stage is the one of the whole interpreter.
+        """
+        return profile_imports(STARTUP_MODULE)
+
+    def fetch(self):
+        async def fetch_all():
+            async with HttpClient() as client:
+                return await asyncio.gather(
+                    *(
+                        fetch_paper_html_async(
+                            f"{self.server.url}/papers/{name}/",
+                            client,
+                            force_refresh=True,
+                            arxiv_id=name,
+                            source=source,
+                        )
+                        for name, source, _ in self.fixtures
+                    )
+                )
+
+        return asyncio.run(fetch_all())
+
+    def parse(self, backend):
+        return [
+            parse_paper_sections(
+                path, remove_references=True, remove_appendix=True, backend=backend
+            )
+            for _, _, path in self.fixtures
+        ]
+
+    def check_parsers(self, parsed):
+        """
+        Checks that every parser backend extracts the same sections from every
+        fixture, since they are interchangeable (--parser). parsed has the
+        output of the parse stages that ran, the other backends parse the
+        fixtures here.
+
+        Raises:
+        RuntimeError: If two backends give a different text
+        """
+        outputs = {b: parsed.get(b) or self.parse(b) for b in PARSER_BACKENDS}
+        reference, *others = PARSER_BACKENDS
+        for backend in others:
+            for (name, _, _), expected, sections in zip(
+                self.fixtures, outputs[reference], outputs[backend]
+            ):
+                if sections != expected:
+                    raise RuntimeError(
+                        f"{backend} and {reference} extract a different text "
+                        f"from {name}"
+                    )
+
+    def reduce(self, sections):
+        return [
+            reduce_paper_content(iter(paper_sections), source=source)
+            for paper_sections, (_, source, _) in zip(sections, self.fixtures)
+        ]
+
+    def compact(self, texts):
+        # the papers over the limit also try (and, for the largest, give up)
+        # the pruning
+        max_tokens = read_paper.MAX_PROMPT_TOKENS
+        return [compact_sections([text], self.enc, max_tokens)[0] for text in texts]
+
+    def prompt(self, texts):
+        return [make_chatml(make_messages(text)) for text in texts]
+
+    def encode(self, prompts):
+        return [len(self.enc.encode(prompt)) for prompt in prompts]
+
+    def pipeline(self):
+        # with compaction, as the pipeline was measured in baseline.json
+        pipeline = batch_read_papers.BatchPipeline(
+            max_parsers=self.max_parsers,
+            parser="lxml",
+            compact=True,
+            force_refresh=True,
+        )
+        results = asyncio.run(pipeline.run([name for name, _, _ in self.fixtures]))
+        failed = {k: v for k, v in results.items() if v is not None}
+        if failed:
+            raise RuntimeError(f"Pipeline failed: {failed}")
+
+    def prefetch(self):
+        prefetcher = prefetch.Prefetcher(
+            max_parsers=self.max_parsers,
+            delay=0,
+            parser="lxml",
+            compact=True,
+            force_refresh=True,
+        )
+        results = asyncio.run(prefetcher.run([f"{self.server.url}/list/cs.CL/new"]))
+        failed = {k: v for k, v in results.items() if v is not None}
+        if failed or len(results) != len(LISTING_PAPERS):
+            raise RuntimeError(f"Prefetch failed: {failed or results}")
+
+    def run(self, stages):
+        """
+        Runs the requested stages, and the stages whose output they need.
+        Returns the results of the requested stages.
+        """
+        if "startup" in stages:
+            imports = self.run_stage("startup", self.startup, per_paper=False)
+            self.results["startup"]["imports"] = imports[:STARTUP_TOP_IMPORTS]
+        if "fetch" in stages:
+            self.run_stage("fetch", self.fetch)
+        backends = [b for b in PARSER_BACKENDS if f"parse-{b}" in stages] or ["lxml"]
+        parsed = {}
+        for backend in backends:
+            sections = self.run_stage(f"parse-{backend}", lambda: self.parse(backend))
+            parsed[backend] = sections
+        # a faster parser is only worth timing if it gives the same text
+        self.check_parsers(parsed)
+        texts = self.run_stage("reduce", lambda: self.reduce(sections))
+        prompts = self.run_stage("prompt", lambda: self.prompt(texts))
+        if self.enc is None:
+            click.echo("tiktoken encoder not available offline, skipping encode, compact, pipeline and prefetch")
+        else:
+            if "encode" in stages:
+                self.run_stage("encode", lambda: self.encode(prompts))
+            if "compact" in stages:
+                self.run_stage("compact", lambda: self.compact(texts))
+            if "pipeline" in stages:
+                self.run_stage("pipeline", self.pipeline)
+            if "prefetch" in stages:
+                self.run_stage("prefetch", self.prefetch)
+        return {name: r for name, r in self.results.items() if name in stages}
+
+
+STAGES = ("startup", "fetch") + tuple(f"parse-{b}" for b in PARSER_BACKENDS) + (
+    "reduce",
+    "prompt",
+    "encode",
+    "compact",
+    "pipeline",
+    "prefetch",
+)
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints the change of each stage against the baseline, returns the stages
+    whose wall time grew by more than threshold (a fraction).
+    """
+    regressions = []
+    click.echo(f"\n{'stage':<16} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name, r in results.items():
+        base = baseline["stages"].get(name)
+        if base is None:
+            click.echo(f"{name:<16} {'-':>10} {r['wall']:>9.3f}s {'new':>8}")
+            continue
+        change = r["wall"] / base["wall"] - 1 if base["wall"] > 0 else 0.0
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        click.echo(
+            f"{name:<16} {base['wall']:>9.3f}s {r['wall']:>9.3f}s {change:>+8.1%}{flag}"
+        )
+    return regressions
+
+
+@click.command()
+@click.option("--repeat", default=3, show_default=True, help="Timed runs per stage.")
+@click.option(
+    "--stage",
+    "stages",
+    multiple=True,
+    type=click.Choice(STAGES),
+    help="Run only these stages (can be repeated). Defaults to all.",
+)
+@click.option(
+    "--max-parsers",
+    default=2,
+    show_default=True,
+    help="Number of parser processes in the pipeline stage.",
+)
+@click.option(
+    "--baseline",
+    type=click.Path(dir_okay=False, path_type=Path),
+    default=DEFAULT_BASELINE,
+    show_default=True,
+    help="The baseline file.",
+)
+@click.option("--save-baseline", is_flag=True, help="Save the results as the baseline.")
+@click.option(
+    "--compare", "do_compare", is_flag=True, help="Compare the results with the baseline."
+)
+@click.option(
+    "--threshold",
+    default=0.10,
+    show_default=True,
+    help="With --compare, the slowdown (fraction of the baseline) reported as a regression.",
+)
+@click.option(
+    "--fail-on-regression", is_flag=True, help="Exit with 1 if a stage regressed."
+)
+@click.option(
+    "--output",
+    type=click.Path(dir_okay=False, path_type=Path),
+    help="Also write the results as JSON to this file.",
+)
+def main(
+    repeat,
+    stages,
+    max_parsers,
+    baseline,
+    save_baseline,
+    do_compare,
+    threshold,
+    fail_on_regression,
+    output,
+):
+    """
+    Benchmarks each stage of the pipeline on the bundled fixtures, offline.
+    """
+    stages = stages or STAGES
+    fixtures = load_fixtures()
+    pages = {name: read_blob_text(path) for name, _, path in fixtures}
+    # the papers of the listing are the fixtures under their arXiv IDs
+    served = dict(pages)
+    for arxiv_id, name, _ in LISTING_PAPERS:
+        served[arxiv_id] = pages[name]
+    listing = LISTING_FIXTURE.read_text(encoding="utf-8")
+
+    restore_openai = install_fake_openai()
+    try:
+        with FakeServer(
+            served, listing=listing
+        ) as server, tempfile.TemporaryDirectory() as tmp:
+            # everything the pipeline writes goes to the temporary directory,
+            # and every request goes to the fake server
+            set_paper_cache(PaperCache(Path(tmp) / "cache"))
+            set_response_cache(None)
+            batch_read_papers.METADATA_STORE_PATH = Path(tmp) / "metadata.sqlite3"
+            prefetch.METADATA_STORE_PATH = Path(tmp) / "metadata.sqlite3"
+            arxiv_loader.ARXIV_API_URL = f"{server.url}/api/query"
+            read_paper.get_paper_url = (
+                lambda arxiv_id, use_ar5iv=False: f"{server.url}/papers/{arxiv_id}/"
+            )
+            codimd_client.CODIMD_HOST = server.url
+            codimd_client.CODIMD_STORE_PATH = Path(tmp) / "codimd.sqlite3"
+
+            bench = Benchmarks(server, repeat=repeat, max_parsers=max_parsers)
+            results = bench.run(stages)
+    finally:
+        restore_openai()
+        set_paper_cache(None)
+
+    html_mb = sum(len(page) for page in pages.values()) / 1024 / 1024
+    click.echo(f"{len(fixtures)} papers, {html_mb:.1f} MB of HTML\n")
+    click.echo(f"{'stage':<16} {'wall':>9} {'papers/s':>10} {'peak mem':>10}")
+    for name, r in results.items():
+        click.echo(
+            f"{name:<16} {r['wall']:>8.3f}s {r['papers_per_sec']:>10.1f} "
+            f"{r['peak_mb']:>8.1f}MB"
+        )
+    if "startup" in results:
+        click.echo(f"\nslowest imports of {STARTUP_MODULE} (cumulative)")
+        for module, seconds in results["startup"]["imports"]:
+            click.echo(f"{module:<40} {seconds * 1000:>8.1f}ms")
+
+    report = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "papers": len(fixtures),
+        "repeat": repeat,
+        "stages": results,
+    }
+    if output:
+        output.write_text(json.dumps(report, indent=2))
+    if save_baseline:
+        baseline.write_text(json.dumps(report, indent=2))
+        click.echo(f"\nSaved baseline to {baseline}")
+    if do_compare:
+        if not baseline.exists():
+            raise click.ClickException(
+                f"No baseline at {baseline}, run with --save-baseline first"
+            )
+        regressions = compare(results, json.loads(baseline.read_text()), threshold)
+        if regressions and fail_on_regression:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,15 @@
 import os
 import re
+import time
+import asyncio
 import logging
 from pathlib import Path
-import requests
 import hashlib
-from bs4 import BeautifulSoup
+
+from http_client import RETRY_STATUSES
+from paper_cache import PaperCache, read_blob_text
+from text_normalizer import get_normalizer
+from tracing import current_span, traced
 
 
 class PaperFailedToRender(Exception):
@@ -19,43 +24,66 @@ class PaperNotFound(Exception):
     pass
 
 
+# Bump when the output of parse_paper_content or reduce_paper_content changes,
+# so that text cached by an older version is not used
+PARSER_VERSION = 2
+
+# Inserted before every <h2> by parse_paper_sections to mark section boundaries
+SECTION_SEPARATOR = "\x00"
+
 # The directory where the cached HTML and text files are stored
 _CURRENT_DIR = Path(os.path.dirname(os.path.realpath(__file__)))
 CACHE_DIR = _CURRENT_DIR / ".cached"
 CACHE_DIR.mkdir(exist_ok=True)
 
+_paper_cache = None
 
-def fetch_metainfo(arxiv_id):
+
+def get_paper_cache():
     """
-    Fetches the metadata for a given arXiv ID.
+    Returns the PaperCache in CACHE_DIR, where the HTML, text and summaries
+    of papers are stored.
+    """
+    global _paper_cache
+    if _paper_cache is None:
+        _paper_cache = PaperCache(CACHE_DIR)
+    return _paper_cache
 
-    Parameters:
-    arxiv_id (str): The arXiv ID of the paper
 
-    Returns:
-    metadata (dict): The metadata for the paper, including the title, authors, categories, published date, updated date, and abstract.
+def set_paper_cache(cache):
+    """
+    Sets the PaperCache returned by get_paper_cache, e.g. a temporary one.
     """
+    global _paper_cache
+    _paper_cache = cache
 
-    # Construct the URL for the paper
-    url = f"http://export.arxiv.org/api/query?id_list={arxiv_id}"
 
-    # Fetch the XML file for the paper
-    xml = requests.get(url).text
+# A session shared by all requests to reuse connections, see _get_session
+_session = None
 
-    # Parse the XML file
-    soup = BeautifulSoup(xml, "xml")
 
-    entry = soup.find("entry")
+def _get_session():
+    # requests is imported by the first request, not by the runs that find
+    # everything in the cache
+    global _session
+    if _session is None:
+        import requests
 
-    # Extract the metadata
+        _session = requests.Session()
+    return _session
 
-    def _clean(t):
-        t = t.strip()
-        t = t.replace("\n", " ")
-        while "  " in t:
-            t = t.replace("  ", " ")
-        return t
+ARXIV_API_URL = "http://export.arxiv.org/api/query"
 
+
+def _clean(t):
+    t = t.strip()
+    t = t.replace("\n", " ")
+    while "  " in t:
+        t = t.replace("  ", " ")
+    return t
+
+
+def _parse_metainfo_entry(entry):
     metadata = {
         "title": entry.find("title").text,
         "authors": [author.text.strip() for author in entry.find_all("author")],
@@ -75,17 +103,205 @@ def fetch_metainfo(arxiv_id):
     return metadata
 
 
+def split_arxiv_version(arxiv_id):
+    """
+    Splits an arXiv ID into the ID without version and the version,
+    e.g. "2303.01469v2" -> ("2303.01469", "v2"), "2303.01469" -> ("2303.01469", "").
+    """
+    m = re.match(r"^(.*?)(v\d+)?$", arxiv_id)
+    return m.group(1), m.group(2) or ""
+
+
+def fetch_metainfo(arxiv_id):
+    """
+    Fetches the metadata for a given arXiv ID.
+
+    Parameters:
+    arxiv_id (str): The arXiv ID of the paper
+
+    Returns:
+    metadata (dict): The metadata for the paper, including the title, authors, categories, published date, updated date, and abstract.
+    """
+
+    # Construct the URL for the paper
+    url = f"{ARXIV_API_URL}?id_list={arxiv_id}"
+
+    # Fetch the XML file for the paper
+    xml = _get_session().get(url).text
+
+    # Parse the XML file
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(xml, "xml")
+
+    entry = soup.find("entry")
+
+    # Extract the metadata
+    return _parse_metainfo_entry(entry)
+
+
+def fetch_metainfo_many(arxiv_ids, batch_size=100):
+    """
+    Fetches the metadata for many arXiv IDs, batch_size IDs per request.
+
+    Parameters:
+    arxiv_ids (list of str): The arXiv IDs of the papers
+    batch_size (int): The number of IDs in one request to the arXiv API
+
+    Returns:
+    metadata (dict): arxiv_id -> metadata (as returned by fetch_metainfo). IDs
+    that the API does not know are missing.
+    """
+    results = {}
+    for i in range(0, len(arxiv_ids), batch_size):
+        batch = arxiv_ids[i : i + batch_size]
+        response = _get_session().get(
+            ARXIV_API_URL,
+            params={"id_list": ",".join(batch), "max_results": len(batch)},
+        )
+        response.raise_for_status()
+        results.update(_parse_metainfo_feed(response.text, batch))
+    return results
+
+
+async def fetch_metainfo_many_async(arxiv_ids, client, batch_size=100):
+    """
+    Fetches the metadata for many arXiv IDs like fetch_metainfo_many, with an
+    HttpClient.
+    """
+    results = {}
+    for i in range(0, len(arxiv_ids), batch_size):
+        batch = arxiv_ids[i : i + batch_size]
+        response = await client.get(
+            ARXIV_API_URL,
+            params={"id_list": ",".join(batch), "max_results": len(batch)},
+        )
+        response.raise_for_status()
+        results.update(_parse_metainfo_feed(response.text, batch))
+    return results
+
+
+# The new submissions of a category, e.g. cs.CL
+ARXIV_LISTING_URL = "https://arxiv.org/list/{category}/new"
+
+
+def get_listing_url(category):
+    return ARXIV_LISTING_URL.format(category=category)
+
+
+# An arXiv ID in a link or a citation, e.g. /abs/2303.01469v2, arXiv:2303.01469
+# or /abs/hep-th/9901001
+_LISTING_ID_RE = re.compile(
+    r"(?:/abs/|arXiv:)(\d{4}\.\d{4,5}(?:v\d+)?|[a-z-]+(?:\.[A-Z]{2})?/\d{7}(?:v\d+)?)"
+)
+
+
+def parse_listing_ids(text):
+    """
+    Returns the arXiv IDs of the papers in a listing, without version and in
+    the order of the listing. The listing can be a listing page of arXiv
+    (/list/<category>/new), an RSS or Atom feed, or a plain list of IDs (one
+    per line, # starts a comment).
+    """
+    matches = _LISTING_ID_RE.findall(text)
+    if not matches:
+        matches = [line.split("#", 1)[0].strip() for line in text.splitlines()]
+    arxiv_ids = []
+    for match in matches:
+        arxiv_id, _ = split_arxiv_version(match)
+        if arxiv_id and arxiv_id not in arxiv_ids:
+            arxiv_ids.append(arxiv_id)
+    return arxiv_ids
+
+
+def _parse_metainfo_feed(xml, arxiv_ids):
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(xml, "xml")
+
+    entries = {}
+    for entry in soup.find_all("entry"):
+        # e.g. http://arxiv.org/abs/2303.01469v2, errors have no /abs/ id
+        entry_id = entry.find("id").text.strip()
+        if "/abs/" not in entry_id:
+            continue
+        entry_id = entry_id.split("/abs/", 1)[1]
+        base_id, _ = split_arxiv_version(entry_id)
+        metadata = _parse_metainfo_entry(entry)
+        entries[entry_id] = metadata
+        entries[base_id] = metadata
+
+    return {arxiv_id: entries[arxiv_id] for arxiv_id in arxiv_ids if arxiv_id in entries}
+
+
+def get_html_cache_key(paper_url):
+    # The hash of the paper URL
+    return hashlib.sha256(paper_url.encode("utf-8")).hexdigest()
+
+
+def remove_cached_html(paper_url):
+    get_paper_cache().delete(get_html_cache_key(paper_url), "html")
+
+
+def _get_cached_html(paper_url, force_refresh, arxiv_id, source, since=None):
+    # with force_refresh, only a file fetched since `since` (by another
+    # process, while this one waited for the lock) is used
+    if force_refresh and since is None:
+        return None
+    cache_path = get_paper_cache().get_path(
+        get_html_cache_key(paper_url),
+        "html",
+        arxiv_id=arxiv_id,
+        source=source,
+        since=since if force_refresh else None,
+    )
+    if cache_path is not None:
+        logging.info(f"Using cached file {cache_path}")
+    return cache_path
+
+
+def _lock_html(paper_url):
+    # held while a paper is fetched, so that the processes that need it too
+    # wait and use its file instead of fetching it again
+    return get_paper_cache().lock(get_html_cache_key(paper_url), "html")
+
+
+def _save_html(paper_url, html, arxiv_id, source):
+    cache_path = get_paper_cache().put(
+        get_html_cache_key(paper_url), "html", html, arxiv_id=arxiv_id, source=source
+    )
+    logging.info(f"Saved HTML file to {cache_path}")
+    return cache_path
+
+
+def _raise_for_paper_status(status_code):
+    # 500 failed to render
+    # 503 render in progress
+    # 404 not found
+    if status_code == 500:
+        raise PaperFailedToRender
+    elif status_code == 503:
+        raise PaperRenderInProgress
+    elif status_code == 404:
+        raise PaperNotFound
+
+
 # A function that fetches and caches the HTML file for a given paper URL
-def fetch_paper_html(paper_url, force_refresh=False):
+@traced("fetch")
+def fetch_paper_html(paper_url, force_refresh=False, arxiv_id=None, source=None):
     """
     Fetches and caches the HTML file for a given paper URL from arXiv Vanity.
+    Processes that fetch the same paper at the same time wait for the first
+    one and use its file.
 
     Parameters:
     paper_url (str): The URL of the paper on arXiv or arXiv Vanity
     force_refresh (bool): Whether to ignore the cached file and fetch a new one
+    arxiv_id, source (str): The paper and source, stored in the cache index
 
     Returns:
-    cache_path (Path): The path of the cached HTML file
+    cache_path (Path): The path of the cached (compressed) HTML file, to be
+    read with parse_paper_content
 
     Raises:
     PaperFailedToRender: If the paper failed to render on arXiv Vanity
@@ -94,57 +310,140 @@ def fetch_paper_html(paper_url, force_refresh=False):
     requests.exceptions.HTTPError: If any other HTTP error occurs
     """
 
-    # Create a session object to reuse the same connection
-    session = requests.Session()
+    # Check if the paper is cached
+    current_span().set(source=source, cached=True)
+    cache_path = _get_cached_html(paper_url, force_refresh, arxiv_id, source)
+    if cache_path is None:
+        started = time.time()
+        with _lock_html(paper_url):
+            # another process may have fetched the paper while this one waited
+            cache_path = _get_cached_html(
+                paper_url, force_refresh, arxiv_id, source, since=started
+            )
+            if cache_path is None:
+                current_span().set(cached=False)
+                logging.info(f"Fetching HTML file from {paper_url}")
+
+                # Make a GET request to the paper URL
+                response = _get_session().get(paper_url, allow_redirects=False)
+                _raise_for_paper_status(response.status_code)
+                # Raise an exception if any other error occurred
+                response.raise_for_status()
+                current_span().set(bytes=len(response.content))
+
+                # Store the response text in the cache
+                cache_path = _save_html(paper_url, response.text, arxiv_id, source)
 
-    # Compute the hash of the paper URL
-    hash = hashlib.sha256(paper_url.encode("utf-8")).hexdigest()
+    # Return the cache path
+    return cache_path.absolute()
 
-    # Construct the cache path for the HTML file
-    cache_path = CACHE_DIR / f"{hash}.html"
 
-    # Check if the cache file exists and is not expired
-    if not force_refresh and cache_path.exists():
-        logging.info(f"Using cached file {cache_path}")
-    else:
-        logging.info(f"Fetching HTML file from {paper_url}")
-
-        try:
-            # Make a GET request to the paper URL
-            response = session.get(paper_url, allow_redirects=False)
-            # Raise an exception if the status code is not 200
-            response.raise_for_status()
-            # Write the response text to the cache file
-        except requests.exceptions.HTTPError as errh:
-            # 500 failed to render
-            # 503 render in progress
-            # 404 not found
-            if response.status_code == 500:
-                raise PaperFailedToRender
-            elif response.status_code == 503:
-                raise PaperRenderInProgress
-            elif response.status_code == 404:
-                raise PaperNotFound
-            else:
-                raise errh
-
-        with cache_path.open("w", encoding="utf-8") as f:
-            f.write(response.text)
-        logging.info(f"Saved HTML file to {cache_path}")
+# How often a paper that is still rendering is fetched again, in seconds
+RENDER_POLL_INTERVAL = 30
 
-    # Return the cache path
+
+@traced("fetch")
+async def fetch_paper_html_async(
+    paper_url,
+    client,
+    force_refresh=False,
+    render_timeout=0,
+    poll_interval=RENDER_POLL_INTERVAL,
+    arxiv_id=None,
+    source=None,
+):
+    """
+    Fetches and caches the HTML file for a given paper URL, like
+    fetch_paper_html, with an HttpClient.
+
+    A paper that is still rendering (503) is fetched again every
+    poll_interval seconds until it renders or render_timeout seconds passed.
+    The wait does not hold a connection, so other papers fetched with the same
+    client are not blocked. Processes (and tasks) that fetch the same paper at
+    the same time wait for the first one and use its file.
+
+    Parameters:
+    paper_url (str): The URL of the paper on arXiv Vanity or ar5iv
+    client (HttpClient): The client used for the request
+    force_refresh (bool): Whether to ignore the cached file and fetch a new one
+    render_timeout (float): How long to wait for the paper to render, 0 to
+    fail at once
+    poll_interval (float): The time between two fetches of a rendering paper
+    arxiv_id, source (str): The paper and source, stored in the cache index
+
+    Returns:
+    cache_path (Path): The path of the cached HTML file
+
+    Raises:
+    PaperFailedToRender: If the paper failed to render
+    PaperRenderInProgress: If the paper did not render within render_timeout
+    PaperNotFound: If the paper is not found
+    aiohttp.ClientResponseError: If any other HTTP error occurs
+    """
+    current_span().set(source=source, cached=True)
+    cache_path = _get_cached_html(paper_url, force_refresh, arxiv_id, source)
+    if cache_path is None:
+        started = time.time()
+        async with _lock_html(paper_url):
+            # another process may have fetched the paper while this one waited
+            cache_path = _get_cached_html(
+                paper_url, force_refresh, arxiv_id, source, since=started
+            )
+            if cache_path is None:
+                current_span().set(cached=False)
+                cache_path = await _download_html_async(
+                    paper_url, client, render_timeout, poll_interval, arxiv_id, source
+                )
     return cache_path.absolute()
 
 
+async def _download_html_async(
+    paper_url, client, render_timeout, poll_interval, arxiv_id, source
+):
+    logging.info(f"Fetching HTML file from {paper_url}")
+    polls = 0
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + render_timeout
+    while True:
+        # 503 means "render in progress" here, it is polled below instead of
+        # being retried by the client
+        response = await client.get(
+            paper_url,
+            allow_redirects=False,
+            retry_statuses=tuple(s for s in RETRY_STATUSES if s != 503),
+        )
+        if response.status != 503:
+            break
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            raise PaperRenderInProgress
+        logging.info(f"Paper {paper_url} is rendering, fetching again later")
+        polls += 1
+        await asyncio.sleep(min(poll_interval, remaining))
+
+    current_span().set(render_polls=polls, status=response.status)
+    _raise_for_paper_status(response.status)
+    response.raise_for_status()
+    current_span().set(bytes=len(response.text))
+
+    return _save_html(paper_url, response.text, arxiv_id, source)
+
+
 # A function that parses and extracts the content of the paper from the HTML file
+@traced("parse")
 def parse_paper_content(
-    html_path, keep_latex=False, remove_references=False, remove_appendix=False
+    html_path,
+    keep_latex=False,
+    remove_references=False,
+    remove_appendix=False,
+    backend="html5lib",
 ):
     """
     Parses and extracts the content of the paper from the HTML file.
 
     Parameters:
     html_path (Path): The path of the HTML file
+    backend (str): The parser to use, one of PARSER_BACKENDS
 
     Returns:
     paper_content (str): The text content of the paper
@@ -152,69 +451,175 @@ def parse_paper_content(
     Raises:
     ValueError: If the HTML file is empty or invalid
     """
+    current_span().set(backend=backend)
+    return _extract_paper_content(
+        html_path,
+        keep_latex=keep_latex,
+        remove_references=remove_references,
+        remove_appendix=remove_appendix,
+        backend=backend,
+    )
+
+
+# The start tag of div.ltx_page_content, then the tags and spaces before its
+# first text
+_PAGE_CONTENT_RE = re.compile(
+    r"<div\s[^>]*\bclass\s*=\s*[\"']?[^\"'>]*\bltx_page_content\b[^>]*>"
+    r"(?:\s|<[^>]*>)*[^<\s]",
+    re.IGNORECASE,
+)
 
-    # Read the HTML file as a string
-    with html_path.open("r", encoding="utf-8") as f:
-        html = f.read()
+
+def has_paper_content(html_path):
+    """
+    Returns True if the HTML file has the element the content of the paper is
+    extracted from (div.ltx_page_content) with some text in it, without
+    parsing the file. A render without it fails to parse with
+    PaperFailedToRender or ValueError.
+    """
+    return _PAGE_CONTENT_RE.search(read_blob_text(html_path)) is not None
+
+
+@traced("parse")
+def parse_paper_sections(
+    html_path,
+    keep_latex=False,
+    remove_references=False,
+    remove_appendix=False,
+    backend="html5lib",
+):
+    """
+    Parses the content of the paper like parse_paper_content, but splits it at
+    the <h2> section boundaries.
+
+    Parameters:
+    html_path (Path): The path of the HTML file
+    backend (str): The parser to use, one of PARSER_BACKENDS
+
+    Returns:
+    sections (list of str): The text of the part before the first section,
+    followed by the text of each section. "".join(sections) is equal to the
+    output of parse_paper_content.
+
+    Raises:
+    ValueError: If the HTML file is empty or invalid
+    """
+    current_span().set(backend=backend)
+    content = _extract_paper_content(
+        html_path,
+        keep_latex=keep_latex,
+        remove_references=remove_references,
+        remove_appendix=remove_appendix,
+        section_separator=SECTION_SEPARATOR,
+        backend=backend,
+    )
+    return content.split(SECTION_SEPARATOR)
+
+
+# The <h2> titles of the sections removed by remove_references and remove_appendix,
+# a trailing "_" matches any title starting with the name
+REFERENCE_SECTION_NAMES = [
+    "References",
+    "Reference",
+    "Bibliography",
+    "Bibliography and References",
+]
+APPENDIX_SECTION_NAMES = [
+    "Appendix",
+    "Appendices",
+    "Supplementary Material",
+    "Supplementary Materials",
+    "Supplementary",
+    "Supplementary Information",
+    "Supplementary Data",
+    "Supplementary Appendix",
+    "Supplementary Appendices",
+    "Appendix_",
+]
+
+# The parsers supported by parse_paper_content, html5lib is the reference
+# implementation and lxml gives identical text much faster
+PARSER_BACKENDS = ("html5lib", "lxml")
+
+
+def _get_removed_section_names(remove_references, remove_appendix):
+    target_section_names = []
+    if remove_references:
+        target_section_names += REFERENCE_SECTION_NAMES
+    if remove_appendix:
+        target_section_names += APPENDIX_SECTION_NAMES
+    return [x.lower() for x in target_section_names]
+
+
+def _is_removed_section(h2_text, target_section_names):
+    h2_text_comp = h2_text.strip().lower()
+    # only keep letters, e.g. "7 Appendix" -> "appendix"
+    h2_text_comp = re.sub(r"[^a-z]", "", h2_text_comp)
+
+    for target_sec_name in target_section_names:
+        if target_sec_name.endswith("_"):
+            if h2_text_comp.startswith(target_sec_name[:-1]):
+                return True
+        else:
+            if h2_text_comp == target_sec_name:
+                return True
+    return False
+
+
+def _extract_paper_content(
+    html_path,
+    keep_latex=False,
+    remove_references=False,
+    remove_appendix=False,
+    section_separator=None,
+    backend="html5lib",
+):
+
+    # Read the (compressed) HTML file as a string
+    html = read_blob_text(html_path)
 
     # Check if the HTML file is empty
     if not html:
         raise ValueError(f"Empty HTML file: {html_path}")
 
-    soup = BeautifulSoup(html, "html5lib")
-    if soup.title:
-        title = str(soup.title.string)
+    target_section_names = _get_removed_section_names(
+        remove_references, remove_appendix
+    )
+    if backend == "html5lib":
+        content = _extract_with_html5lib(
+            html, html_path, keep_latex, target_section_names, section_separator
+        )
+    elif backend == "lxml":
+        content = _extract_with_lxml(
+            html, html_path, keep_latex, target_section_names, section_separator
+        )
     else:
-        title = ""
+        raise ValueError(f"Unknown parser backend: {backend}")
+
+    # Check if the content element exists
+    if not content:
+        raise ValueError(f"Invalid HTML file: {html_path}")
+
+    return content
 
-    def remove_section_by_h2(soup, target_section_names):
-        target_section_names = [x.lower() for x in target_section_names]
 
+def _extract_with_html5lib(
+    html, html_path, keep_latex, target_section_names, section_separator
+):
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, "html5lib")
+
+    def remove_section_by_h2(soup, target_section_names):
         for h2 in soup.find_all("h2"):
             h2_text = h2.get_text().strip()
-            h2_text_comp = h2_text.lower()
-            # only keep letters, e.g. "7 Appendix" -> "appendix"
-            h2_text_comp = re.sub(r"[^a-z]", "", h2_text_comp)
-
-            for target_sec_name in target_section_names:
-                if target_sec_name.endswith("_"):
-                    if h2_text_comp.startswith(target_sec_name[:-1]):
-                        if h2.parent:
-                            h2.parent.decompose()
-                            logging.info(f"Removing: {h2_text}")
-                else:
-                    if h2_text_comp == target_sec_name:
-                        if h2.parent:
-                            h2.parent.decompose()
-                            logging.info(f"Removing: {h2_text}")
-
-    if remove_references:
-        remove_section_by_h2(
-            soup,
-            [
-                "References",
-                "Reference",
-                "Bibliography",
-                "Bibliography and References",
-            ],
-        )
+            if _is_removed_section(h2_text, target_section_names):
+                if h2.parent:
+                    h2.parent.decompose()
+                    logging.info(f"Removing: {h2_text}")
 
-    if remove_appendix:
-        remove_section_by_h2(
-            soup,
-            [
-                "Appendix",
-                "Appendices",
-                "Supplementary Material",
-                "Supplementary Materials",
-                "Supplementary",
-                "Supplementary Information",
-                "Supplementary Data",
-                "Supplementary Appendix",
-                "Supplementary Appendices",
-                "Appendix_",
-            ],
-        )
+    if target_section_names:
+        remove_section_by_h2(soup, target_section_names)
 
     # dealing with <math> tags, especially for the case of ar5iv, e.g. https://ar5iv.labs.arxiv.org/html/2303.01469
     # but not for the case of arxiv-vanity, e.g. https://arxiv-vanity.com/papers/2003.01469/
@@ -236,67 +641,136 @@ def parse_paper_content(
             elem.decompose()
 
     try:
-        content = soup.find("div", class_="ltx_page_content").get_text()
+        content_elem = soup.find("div", class_="ltx_page_content")
+        if section_separator is not None:
+            for h2 in content_elem.find_all("h2"):
+                h2.insert_before(section_separator)
+        content = content_elem.get_text()
         logging.info(f"Using main content extraction method for {html_path}")
     except Exception as e:
         logging.error(f"Cannot extract main content for {html_path}")
         raise PaperFailedToRender
 
-    # Check if the content element exists
-    if not content:
-        raise ValueError(f"Invalid HTML file: {html_path}")
-
     return content
 
 
+_PAGE_CONTENT_XPATH = (
+    "//div[contains(concat(' ', normalize-space(@class), ' '), ' ltx_page_content ')]"
+)
+
+# html5lib drops the newline right after the start tag of these elements
+_LEADING_NEWLINE_TAGS = ("pre", "listing", "textarea")
+
+
+def _extract_with_lxml(
+    html, html_path, keep_latex, target_section_names, section_separator
+):
+    """
+    Extracts the same text as _extract_with_html5lib, but parses with lxml and
+    does the section removal, the LaTeX substitution and the annotation
+    removal in a single traversal of div.ltx_page_content.
+    """
+    # html5lib normalizes newlines in the input stream
+    html = html.replace("\r\n", "\n").replace("\r", "\n")
+    import lxml.html
+
+    parser = lxml.html.HTMLParser(encoding="utf-8")
+    root = lxml.html.document_fromstring(html.encode("utf-8"), parser=parser)
+
+    found = root.xpath(_PAGE_CONTENT_XPATH, smart_strings=False)
+    # a removed section title in the content div or around it removes the
+    # whole content, as the parent of the <h2> is decomposed
+    if not found or (
+        target_section_names
+        and any(
+            _find_removed_h2(elem, target_section_names) is not None
+            for elem in [found[0], *found[0].iterancestors()]
+        )
+    ):
+        logging.error(f"Cannot extract main content for {html_path}")
+        raise PaperFailedToRender
+    logging.info(f"Using main content extraction method for {html_path}")
+
+    parts = []
+    _collect_text(
+        found[0], parts, keep_latex, target_section_names, section_separator
+    )
+    return "".join(parts)
+
+
+def _find_removed_h2(elem, target_section_names):
+    """
+    Returns the text of the first <h2> child of elem that is the title of a
+    removed section, or None.
+    """
+    for h2 in elem.iterchildren("h2"):
+        h2_text = "".join(h2.itertext()).strip()
+        if _is_removed_section(h2_text, target_section_names):
+            return h2_text
+    return None
+
+
+def _collect_text(elem, parts, keep_latex, target_section_names, section_separator):
+    text = elem.text
+    if text:
+        if elem.tag in _LEADING_NEWLINE_TAGS and text.startswith("\n"):
+            text = text[1:]
+        parts.append(text)
+
+    for child in elem:
+        tag = child.tag
+        # comments and processing instructions have no text, only a tail
+        if isinstance(tag, str):
+            _collect_child_text(
+                child, parts, keep_latex, target_section_names, section_separator
+            )
+        if child.tail:
+            parts.append(child.tail)
+
+
+def _collect_child_text(
+    elem, parts, keep_latex, target_section_names, section_separator
+):
+    tag = elem.tag
+    if target_section_names:
+        h2_text = _find_removed_h2(elem, target_section_names)
+        if h2_text is not None:
+            logging.info(f"Removing: {h2_text}")
+            return
+
+    if keep_latex:
+        # for ar5iv, replace <math> with its alttext
+        if tag == "math":
+            parts.append(elem.get("alttext") or "")
+            return
+        # for arxiv-vanity, replace <span class="mjx-math"> with its aria-label
+        if tag == "span" and "mjx-math" in elem.get("class", "").split():
+            parts.append(elem.get("aria-label") or "")
+            return
+    elif tag in ("annotation", "annotation-xml"):
+        # for ar5iv, remove the <annotation> tag
+        return
+
+    if tag == "h2" and section_separator is not None:
+        parts.append(section_separator)
+    _collect_text(elem, parts, keep_latex, target_section_names, section_separator)
+
+
 # A function that reduces the noise and whitespace from the paper content
-def reduce_paper_content(paper_content):
+def reduce_paper_content(paper_content, source="default"):
     """
     Reduces the noise and whitespace from the paper content.
 
     Parameters:
-    paper_content (str): The text content of the paper
+    paper_content (str or iterable of str): The text content of the paper, or
+    an iterator of chunks of it
+    source (str): The rule set in text_normalizer.RULE_SETS to apply, e.g.
+    "arxiv-vanity" or "ar5iv"
 
     Returns:
     reduced_content (str): The reduced text content of the paper
     """
-
-    # Remove unnecessary whitespace and noise
-    paper_content = paper_content.replace("\r", "\n")
-    paper_content = paper_content.replace("\t", " ")
-    paper_content = paper_content.strip()
-    paper_content = re.sub(r"\n\s+", "\n", paper_content)
-    paper_content = re.sub(r"\s+\n", "\n", paper_content)
-    paper_content = re.sub(r"\n\n+", "\n\n", paper_content)
-    paper_content = re.sub(r"\s\s+", " ", paper_content)
-
-    # Remove arXiv Vanity specific text
-    paper_content = paper_content.replace(" – arXiv Vanity", "")
-    paper_content = paper_content.replace(
-        "arXiv Vanity renders academic papers from", ""
-    )
-    paper_content = paper_content.replace("arXiv as responsive web pages so you", "")
-    paper_content = paper_content.replace("don’t have to squint at a PDF", "")
-    paper_content = paper_content.replace("View this paper on arXiv", "")
-    paper_content = paper_content.replace("arXiv Vanity", "")
-    paper_content = re.sub(
-        r"Generated by LaTeXML.*?Want to hear about new.*",
-        "",
-        paper_content,
-        flags=re.DOTALL,
-    )
-
-    # Remove some latex commands
-    paper_content = paper_content.replace("start_POSTSUPERSCRIPT", "")
-    paper_content = paper_content.replace("end_POSTSUPERSCRIPT", "")
-    paper_content = paper_content.replace("start_POSTSUBSCRIPT", "")
-    paper_content = paper_content.replace("end_POSTSUBSCRIPT", "")
-    paper_content = paper_content.replace("start_FLOATSUPERSCRIPT", "")
-    paper_content = paper_content.replace("end_FLOATSUPERSCRIPT", "")
-    paper_content = paper_content.replace("italic_", "")
-    paper_content = paper_content.replace("textbf_", "")
-    paper_content = paper_content.replace("textit_", "")
-    paper_content = paper_content.replace("texttt_", "")
-
-    # Return the reduced content
-    return paper_content
+    normalizer = get_normalizer(source)
+    if isinstance(paper_content, str):
+        return normalizer.normalize(paper_content)
+    return "".join(normalizer.iter_normalize(paper_content))
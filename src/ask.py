@@ -0,0 +1,176 @@
+import asyncio
+import logging
+
+import click
+
+from llm import (
+    DEFAULT_MODEL,
+    create_stream,
+    fetch_response_with_streaiming,
+    make_chatml,
+    set_response_cache,
+)
+from llm_cache import ResponseCache
+from arxiv_loader import get_paper_cache
+from metadata_store import MetadataStore
+from paper_index import DEFAULT_CHUNK_WORDS, PaperIndex
+from prompt_templates import make_ask_messages
+from read_paper import LLM_CACHE_DIR, MAX_PROMPT_TOKENS, METADATA_STORE_PATH
+from token_counter import count_tokens, get_encoder
+
+logger = logging.getLogger(__name__)
+
+# The previous questions and answers sent with a follow-up question
+MAX_HISTORY = 3
+
+
+def get_paper_index(chunk_words=DEFAULT_CHUNK_WORDS, reindex=False):
+    """
+    Returns the search index of the cached papers, updated with the papers
+    cached since it was last saved.
+    """
+    cache = get_paper_cache()
+    index = PaperIndex(cache.root / "search_index", chunk_words=chunk_words)
+    if reindex:
+        index.clear()
+    if index.update(cache):
+        index.save()
+    return index
+
+
+def get_paper_titles(arxiv_ids):
+    """
+    Returns the titles of the papers found in the metadata store, without
+    fetching the missing ones.
+    """
+    store = MetadataStore(METADATA_STORE_PATH)
+    titles = {}
+    for arxiv_id in arxiv_ids:
+        metadata = store.get(arxiv_id)
+        if metadata is not None:
+            titles[arxiv_id] = metadata["title"]
+    return titles
+
+
+def format_excerpts(results, titles):
+    """
+    Formats the retrieved chunks, grouped by paper and in the order of the
+    paper.
+    """
+    papers = {}
+    for _, chunk in results:
+        papers.setdefault(chunk[0], []).append(chunk)
+    blocks = []
+    for arxiv_id, chunks in papers.items():
+        title = titles.get(arxiv_id)
+        header = f"[{arxiv_id}] {title}" if title else f"[{arxiv_id}]"
+        for _, _, section_title, text in sorted(chunks, key=lambda c: c[1]):
+            blocks.append(f"### {header}\nSection: {section_title}\n\n{text}\n")
+    return "\n".join(blocks)
+
+
+def make_question_messages(question, results, enc, history=()):
+    """
+    Returns the messages of a question and their number of tokens. The least
+    relevant excerpts are dropped until the prompt fits in MAX_PROMPT_TOKENS.
+    """
+    results = list(results)
+    titles = get_paper_titles({chunk[0] for _, chunk in results})
+    while True:
+        num_papers = len({chunk[0] for _, chunk in results})
+        messages = make_ask_messages(
+            question, format_excerpts(results, titles), num_papers, history
+        )
+        num_tokens = count_tokens(make_chatml(messages), enc)
+        if num_tokens <= MAX_PROMPT_TOKENS or len(results) <= 1:
+            return messages, num_tokens
+        # results are sorted best first
+        results.pop()
+
+
+async def answer_question(question, results, enc, history=(), echo=True):
+    """
+    Answers a question from the retrieved chunks.
+
+    Returns:
+    answer (str): The answer of the LLM
+    """
+    messages, num_tokens = make_question_messages(question, results, enc, history)
+    logger.info(f"Asking with {len(results)} excerpts, {num_tokens} prompt tokens")
+    return await fetch_response_with_streaiming(
+        create_stream(messages=messages, prompt_tokens=num_tokens), echo=echo
+    )
+
+
+@click.command()
+@click.argument("question", required=False)
+@click.option(
+    "--paper",
+    "arxiv_ids",
+    multiple=True,
+    help="The arXiv ID of a paper to ask about, can be repeated to ask across papers. Defaults to all cached papers.",
+)
+@click.option(
+    "--top-k",
+    default=8,
+    show_default=True,
+    help="The number of excerpts sent with a question. With several --paper, each paper gets its share.",
+)
+@click.option(
+    "--chunk-words",
+    default=DEFAULT_CHUNK_WORDS,
+    show_default=True,
+    help="The number of words in an excerpt. Changing it rebuilds the index.",
+)
+@click.option(
+    "--reindex", is_flag=True, help="If True, rebuild the index of the cached papers."
+)
+@click.option(
+    "--no-llm-cache",
+    is_flag=True,
+    help="If True, don't use cached LLM responses. The new responses are still cached.",
+)
+def main(question, arxiv_ids, top_k, chunk_words, reindex, no_llm_cache):
+    """
+    Answers questions about the papers read before (see read_paper.py), from
+    the excerpts of the cached papers most relevant to the question. Without
+    QUESTION, asks questions interactively, follow-up questions see the
+    previous answers.
+    """
+    set_response_cache(ResponseCache(LLM_CACHE_DIR, bypass=no_llm_cache))
+    index = get_paper_index(chunk_words=chunk_words, reindex=reindex)
+    missing = [arxiv_id for arxiv_id in arxiv_ids if arxiv_id not in index.papers]
+    if missing:
+        raise click.BadParameter(
+            f"{', '.join(missing)} not cached, run read_paper.py first",
+            param_hint="--paper",
+        )
+    if not index.papers:
+        raise click.UsageError("No cached papers, run read_paper.py first")
+
+    enc = get_encoder(DEFAULT_MODEL)
+
+    if question:
+        results = index.search(question, top_k=top_k, arxiv_ids=arxiv_ids)
+        asyncio.run(answer_question(question, results, enc))
+        return
+
+    history = []
+    while True:
+        try:
+            question = input("\n> ").strip()
+        except (EOFError, KeyboardInterrupt):
+            print("")
+            break
+        if not question:
+            continue
+        # follow-up questions often don't name what they refer to, so the
+        # previous question helps retrieving the right excerpts
+        query = " ".join([q for q, _ in history[-1:]] + [question])
+        results = index.search(query, top_k=top_k, arxiv_ids=arxiv_ids)
+        answer = asyncio.run(answer_question(question, results, enc, history))
+        history = (history + [(question, answer)])[-MAX_HISTORY:]
+
+
+if __name__ == "__main__":
+    main()
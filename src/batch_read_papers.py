@@ -0,0 +1,556 @@
+import sys
+import time
+import logging
+import asyncio
+import functools
+import contextlib
+import contextvars
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import click
+
+from llm import set_response_cache
+from llm_cache import ResponseCache
+from endpoints import configure_endpoints
+from arxiv_loader import get_paper_cache
+from codimd_client import get_codimd_client
+from http_client import HttpClient
+from hedged_fetch import DEFAULT_HEDGE_DELAY, describe_error, fetch_paper_hedged
+from metadata_store import DEFAULT_MAX_AGE, MetadataStore
+from map_reduce import DEFAULT_CHUNK_TOKENS
+from fanout import get_question_groups
+from incremental import (
+    MIN_CHANGED_WORDS,
+    is_paper_updated,
+    load_snapshot,
+    plan_update,
+    save_snapshot,
+)
+from token_counter import LazyEncoder
+from tracing import Tracer, set_tracer, span, trace
+from cli_options import (
+    compact_option,
+    endpoint_options,
+    force_refresh_option,
+    metrics_file_option,
+    pipeline_options,
+    render_timeout_option,
+    source_options,
+    summary_options,
+    trace_file_option,
+)
+from read_paper import (
+    LLM_CACHE_DIR,
+    MAX_PROMPT_TOKENS,
+    FETCH_STATS_PATH,
+    METADATA_STORE_PATH,
+    extract_paper_content,
+    format_metadata,
+    get_paper_urls,
+    get_source_text_key,
+    get_url_hash,
+    load_or_fetch_text,
+    make_summary,
+    prepare_prompt,
+    run_llm,
+    save_summary,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class StageStats:
+    """
+    Collects timing for one stage of the batch pipeline.
+
+    `busy` is the sum of the time spent inside the stage over all papers, the
+    wall span is measured from the first start to the last finish. Comparing
+    the two (together with the concurrency of the stage) shows which stage
+    the pipeline is waiting on.
+    """
+
+    def __init__(self, name, concurrency):
+        self.name = name
+        self.concurrency = concurrency
+        self.count = 0
+        self.failed = 0
+        self.busy = 0.0
+        self.first_start = None
+        self.last_end = None
+
+    def record(self, start, end, ok=True):
+        self.count += 1
+        if not ok:
+            self.failed += 1
+        self.busy += end - start
+        if self.first_start is None or start < self.first_start:
+            self.first_start = start
+        if self.last_end is None or end > self.last_end:
+            self.last_end = end
+
+    @property
+    def wall(self):
+        if self.first_start is None:
+            return 0.0
+        return self.last_end - self.first_start
+
+    @property
+    def throughput(self):
+        return self.count / self.wall if self.wall > 0 else 0.0
+
+    @property
+    def utilization(self):
+        if self.wall <= 0:
+            return 0.0
+        return self.busy / (self.wall * self.concurrency)
+
+    def report(self):
+        avg = self.busy / self.count if self.count else 0.0
+        return (
+            f"{self.name:<8} {self.count:>5} done {self.failed:>4} failed "
+            f"{self.throughput:>8.2f} papers/s  avg {avg:>7.2f}s  "
+            f"wall {self.wall:>8.2f}s  utilization {self.utilization:>6.1%}"
+        )
+
+
+class BatchPipeline:
+    """
+    Runs many papers through fetch -> parse -> tokenize -> LLM -> publish.
+
+    Each stage has its own concurrency limit: downloads and metadata requests
+    share one pooled HttpClient with a per-host limit, parsing runs in a
+    process pool, compaction and token counting run in a thread, CodiMD
+    uploads run in a thread pool and LLM calls are limited by an asyncio
+    semaphore. Papers flow through the stages
+    independently, so one paper can be parsed while another is streaming, and
+    a paper that is still rendering is polled without holding up the others.
+    """
+
+    def __init__(
+        self,
+        max_downloads=4,
+        max_parsers=None,
+        max_llm_calls=2,
+        dry_run=False,
+        keep_ref=False,
+        keep_app=False,
+        keep_latex=False,
+        use_ar5iv=False,
+        auto_source=False,
+        hedge_delay=DEFAULT_HEDGE_DELAY,
+        parser="html5lib",
+        force_refresh=False,
+        render_timeout=0,
+        chunked=True,
+        chunk_tokens=DEFAULT_CHUNK_TOKENS,
+        question_groups=None,
+        incremental=False,
+        min_changed_words=MIN_CHANGED_WORDS,
+        compact=False,
+    ):
+        self.max_downloads = max_downloads
+        self.max_parsers = max_parsers
+        self.max_llm_calls = max_llm_calls
+        self.dry_run = dry_run
+        self.keep_ref = keep_ref
+        self.keep_app = keep_app
+        self.keep_latex = keep_latex
+        self.use_ar5iv = use_ar5iv
+        self.auto_source = auto_source
+        self.hedge_delay = hedge_delay
+        self.parser = parser
+        self.force_refresh = force_refresh
+        self.render_timeout = render_timeout
+        self.chunked = chunked
+        self.chunk_tokens = chunk_tokens
+        self.question_groups = question_groups
+        self.incremental = incremental
+        self.min_changed_words = min_changed_words
+        self.compact = compact
+
+        self.enc = LazyEncoder()
+        self.codimd_client = None if dry_run else get_codimd_client()
+        self.metadata_store = MetadataStore(METADATA_STORE_PATH)
+        self.stats = {
+            "fetch": StageStats("fetch", max_downloads),
+            "parse": StageStats("parse", max_parsers or 1),
+            "tokenize": StageStats("tokenize", 1),
+            "llm": StageStats("llm", max_llm_calls),
+            "publish": StageStats("publish", max_downloads),
+        }
+
+    async def _run_stage(self, name, coro):
+        start = time.perf_counter()
+        ok = False
+        try:
+            result = await coro
+            ok = True
+            return result
+        finally:
+            self.stats[name].record(start, time.perf_counter(), ok=ok)
+
+    async def _in_executor(self, executor, func, *args):
+        loop = asyncio.get_running_loop()
+        if isinstance(executor, ThreadPoolExecutor):
+            # threads run in a copy of the context, so that they are part of
+            # the paper's trace. Processes are traced by the caller's span.
+            func = functools.partial(contextvars.copy_context().run, func)
+        return await loop.run_in_executor(executor, func, *args)
+
+    @contextlib.asynccontextmanager
+    async def open(self):
+        """
+        Starts the HTTP client and the worker pools used by process, and
+        stops them when the block exits. run opens the pipeline for one batch,
+        the server keeps it open while it runs.
+        """
+        self._publish_sem = asyncio.Semaphore(self.max_downloads)
+        self._llm_sem = asyncio.Semaphore(self.max_llm_calls)
+        self._metadata = {}
+        async with HttpClient(limit_per_host=self.max_downloads) as http:
+            with ThreadPoolExecutor(self.max_downloads) as io_pool, ProcessPoolExecutor(
+                self.max_parsers
+            ) as parse_pool, ThreadPoolExecutor(1) as tokenize_pool:
+                self._http = http
+                self._io_pool = io_pool
+                self._parse_pool = parse_pool
+                self._tokenize_pool = tokenize_pool
+                yield self
+
+    def prefetch_metadata(self, arxiv_ids):
+        """
+        Starts fetching the metadata of the papers in bulk, process picks it
+        up when it needs it.
+        """
+        # incremental runs check whether the papers have a new version
+        max_age = 0 if self.incremental else DEFAULT_MAX_AGE
+        future = asyncio.ensure_future(
+            self.metadata_store.load_many_async(
+                arxiv_ids, self._http, max_age=max_age
+            )
+        )
+        for arxiv_id in arxiv_ids:
+            self._metadata[arxiv_id] = future
+
+    async def _get_metadata(self, arxiv_id, metadata_future):
+        try:
+            metadata = (await metadata_future).get(arxiv_id)
+            if metadata is None:
+                logger.error(f"No metadata for {arxiv_id}")
+        except Exception as e:
+            logger.error(f"Cannot fetch metadata for {arxiv_id}: {e}")
+            metadata = None
+        return metadata
+
+    async def _fetch(self, arxiv_id, paper_urls, force_refresh):
+        return await self._run_stage(
+            "fetch",
+            fetch_paper_hedged(
+                paper_urls,
+                self._http,
+                hedge_delay=self.hedge_delay,
+                force_refresh=force_refresh,
+                render_timeout=self.render_timeout,
+                stats_path=FETCH_STATS_PATH,
+                arxiv_id=arxiv_id,
+            ),
+        )
+
+    async def _extract(self, html_path, source):
+        with span("extract", pool="process"):
+            return await self._run_stage(
+                "parse",
+                self._in_executor(
+                    self._parse_pool,
+                    extract_paper_content,
+                    html_path,
+                    self.keep_ref,
+                    self.keep_app,
+                    self.keep_latex,
+                    self.parser,
+                    source,
+                ),
+            )
+
+    async def process(self, arxiv_id, on_content=None):
+        """
+        Summarizes a single paper, returns the path of the summary file.
+
+        on_content, if set, is called with each piece of the summary while it
+        is generated.
+        """
+        # a paper that was not prefetched gets its metadata while it is
+        # fetched and summarized
+        if arxiv_id not in self._metadata:
+            self.prefetch_metadata([arxiv_id])
+        metadata_future = self._metadata.pop(arxiv_id)
+
+        paper_urls = get_paper_urls(
+            arxiv_id, use_ar5iv=self.use_ar5iv, auto_source=self.auto_source
+        )
+        url_hash = get_url_hash(paper_urls[0][1])
+        options = (self.keep_ref, self.keep_app, self.keep_latex)
+        snapshot_key = get_source_text_key(paper_urls[0][1], *options)
+
+        force_refresh = self.force_refresh
+        snapshot = None
+        if self.incremental:
+            snapshot = load_snapshot(get_paper_cache(), snapshot_key)
+        if snapshot is not None:
+            metadata = await self._get_metadata(arxiv_id, metadata_future)
+            # the cached HTML and text are the ones of the previous version
+            if is_paper_updated(snapshot, metadata):
+                logger.info(f"Paper {arxiv_id} has a new version, fetching it")
+                force_refresh = True
+
+        text_key, paper_content, sections, _ = await load_or_fetch_text(
+            paper_urls,
+            functools.partial(self._fetch, arxiv_id, paper_urls, force_refresh),
+            self._extract,
+            *options,
+            force_refresh=force_refresh,
+            arxiv_id=arxiv_id,
+        )
+        # compacting and counting a long paper takes long enough to hold up
+        # the papers that are being fetched or streamed
+        paper_content, sections, messages, token_counts = await self._run_stage(
+            "tokenize",
+            self._in_executor(
+                self._tokenize_pool,
+                prepare_prompt,
+                text_key,
+                paper_content,
+                sections,
+                self.enc,
+                self.compact,
+                arxiv_id,
+                self.keep_latex,
+            ),
+        )
+
+        action, update_messages, num_update_tokens = "full", None, 0
+        if snapshot is not None:
+            action, update_messages, num_update_tokens = await self._in_executor(
+                self._tokenize_pool,
+                functools.partial(
+                    plan_update,
+                    snapshot,
+                    sections,
+                    self.enc,
+                    max_prompt_tokens=MAX_PROMPT_TOKENS,
+                    min_changed_words=self.min_changed_words,
+                ),
+            )
+
+        num_prompt_tokens = token_counts["prompt"]
+        too_long = num_prompt_tokens > MAX_PROMPT_TOKENS
+        if too_long and not self.chunked and action == "full":
+            raise ValueError(f"Prompt too long: {num_prompt_tokens}")
+
+        if action == "reuse":
+            content = snapshot["content"]
+            num_prompt_tokens = snapshot["num_prompt_tokens"]
+            num_generated_tokens = snapshot["num_generated_tokens"]
+        elif self.dry_run:
+            content = ""
+            num_generated_tokens = 0
+        else:
+            async with self._llm_sem:
+                (
+                    content,
+                    num_prompt_tokens,
+                    num_generated_tokens,
+                ) = await self._run_stage(
+                    "llm",
+                    run_llm(
+                        paper_content,
+                        sections,
+                        messages,
+                        token_counts,
+                        self.enc,
+                        update_messages=(
+                            update_messages if action == "update" else None
+                        ),
+                        num_update_tokens=num_update_tokens,
+                        chunk_tokens=self.chunk_tokens,
+                        question_groups=self.question_groups,
+                        echo=False,
+                        on_content=on_content,
+                    ),
+                )
+
+        metadata = await self._get_metadata(arxiv_id, metadata_future)
+
+        if not self.dry_run:
+            # the sections the answers were made from, so that small changes
+            # add up over versions until they are worth an update
+            if action == "reuse":
+                sections = snapshot["sections"]
+            save_snapshot(
+                get_paper_cache(),
+                snapshot_key,
+                sections,
+                content,
+                num_prompt_tokens,
+                num_generated_tokens,
+                updated=metadata["updated"] if metadata is not None else None,
+                arxiv_id=arxiv_id,
+            )
+
+        async with self._publish_sem:
+            summary_path, url = await self._run_stage(
+                "publish",
+                self._in_executor(
+                    self._io_pool,
+                    self._finish,
+                    arxiv_id,
+                    url_hash,
+                    metadata,
+                    content,
+                    num_prompt_tokens,
+                    num_generated_tokens,
+                    action != "reuse",
+                ),
+            )
+        if url:
+            logger.info(f"Published summary of {arxiv_id} to {url}")
+        return summary_path
+
+    def _finish(
+        self,
+        arxiv_id,
+        url_hash,
+        metadata,
+        content,
+        num_prompt_tokens,
+        num_generated_tokens,
+        publish=True,
+    ):
+        paper_title, arxiv_metadata = None, ""
+        if metadata is not None:
+            paper_title, arxiv_metadata = format_metadata(metadata)
+
+        summary = make_summary(
+            arxiv_id,
+            content,
+            num_prompt_tokens,
+            num_generated_tokens,
+            paper_title=paper_title,
+            arxiv_metadata=arxiv_metadata,
+        )
+        summary_path = save_summary(url_hash, summary, arxiv_id=arxiv_id)
+
+        # a kept summary was published before
+        url = None
+        if self.codimd_client and publish:
+            url = self.codimd_client.create_and_publish(summary.strip())
+        return summary_path, url
+
+    async def _process_safe(self, arxiv_id):
+        with trace(arxiv_id) as s:
+            try:
+                summary_path = await self.process(arxiv_id)
+                logger.info(f"Saved summary of {arxiv_id} to {summary_path}")
+                return arxiv_id, None
+            except Exception as e:
+                error = describe_error(e)
+            logger.error(f"Paper {arxiv_id}: {error}")
+            s.set(error=error)
+            return arxiv_id, error
+
+    async def run(self, arxiv_ids):
+        """
+        Processes all papers, returns a dict of arxiv_id -> error (None on success).
+        """
+        async with self.open():
+            # the metadata of all papers is fetched in bulk, while the first
+            # papers are downloaded
+            self.prefetch_metadata(arxiv_ids)
+            results = await asyncio.gather(
+                *(self._process_safe(arxiv_id) for arxiv_id in arxiv_ids)
+            )
+        return dict(results)
+
+    def report(self):
+        return "\n".join(stats.report() for stats in self.stats.values())
+
+
+def read_arxiv_ids(f):
+    arxiv_ids = []
+    for line in f:
+        # allow comments and blank lines in id files
+        line = line.split("#", 1)[0].strip()
+        if line and line not in arxiv_ids:
+            arxiv_ids.append(line)
+    return arxiv_ids
+
+
+@click.command()
+@click.argument("id_file", type=click.File("r"), default="-")
+@pipeline_options
+@source_options
+@force_refresh_option
+@render_timeout_option()
+@compact_option
+@summary_options
+@endpoint_options
+@trace_file_option
+@metrics_file_option
+def main(
+    id_file,
+    max_downloads,
+    max_parsers,
+    max_llm_calls,
+    endpoints_file,
+    tpm,
+    rpm,
+    fanout,
+    question_groups,
+    no_llm_cache,
+    trace_file,
+    metrics_file,
+    **options,
+):
+    """
+    Summarizes every arXiv ID in ID_FILE (one per line, defaults to stdin).
+    """
+    try:
+        question_groups = get_question_groups(fanout, question_groups)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--question-groups")
+    set_response_cache(ResponseCache(LLM_CACHE_DIR, bypass=no_llm_cache))
+    configure_endpoints(endpoints_file, tpm=tpm, rpm=rpm)
+    tracer = Tracer(trace_file, metrics_file)
+    set_tracer(tracer)
+    arxiv_ids = read_arxiv_ids(id_file)
+    logger.info(f"Processing {len(arxiv_ids)} papers")
+
+    pipeline = BatchPipeline(
+        max_downloads=max_downloads,
+        max_parsers=max_parsers,
+        max_llm_calls=max_llm_calls,
+        question_groups=question_groups,
+        **options,
+    )
+    start = time.perf_counter()
+    try:
+        results = asyncio.run(pipeline.run(arxiv_ids))
+    finally:
+        set_tracer(None)
+        tracer.close()
+    elapsed = time.perf_counter() - start
+
+    failed = {k: v for k, v in results.items() if v is not None}
+    logger.info(
+        f"Finished {len(results) - len(failed)}/{len(results)} papers in {elapsed:.2f}s"
+    )
+    logger.info("Per-stage throughput:\n" + pipeline.report())
+    for arxiv_id, error in failed.items():
+        logger.error(f"Failed {arxiv_id}: {error}")
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
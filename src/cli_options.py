@@ -0,0 +1,197 @@
+from pathlib import Path
+
+import click
+
+from arxiv_loader import PARSER_BACKENDS
+from hedged_fetch import DEFAULT_HEDGE_DELAY
+from map_reduce import DEFAULT_CHUNK_TOKENS
+from incremental import MIN_CHANGED_WORDS
+
+# The click options shared by read_paper.py, batch_read_papers.py, server.py
+# and prefetch.py, so that the same option means the same in every mode
+
+
+def _options(*options):
+    """
+    Returns a decorator that adds the click options in the given order.
+    """
+
+    def decorator(f):
+        for option in reversed(options):
+            f = option(f)
+        return f
+
+    return decorator
+
+
+# How the text of a paper is fetched and parsed. The parsed text is cached per
+# --keep-* options, so the modes must agree on them to share it.
+source_options = _options(
+    click.option(
+        "--keep-ref",
+        is_flag=True,
+        help="If True, keep the references in the paper before summarizing.",
+    ),
+    click.option(
+        "--keep-app",
+        is_flag=True,
+        help="If True, keep the appendices in the paper before summarizing.",
+    ),
+    click.option(
+        "--keep-latex",
+        is_flag=True,
+        help="If True, keep the LaTeX in the paper before summarizing, otherwise it will be converted to plain text.",
+    ),
+    click.option(
+        "--use-ar5iv", is_flag=True, help="If True, use ar5iv instead of arxiv-vanity."
+    ),
+    click.option(
+        "--auto-source",
+        is_flag=True,
+        help="If True, also fetch a paper from the other source (ar5iv or arxiv-vanity) when the preferred one is slow or fails, and use the first usable render.",
+    ),
+    click.option(
+        "--hedge-delay",
+        default=DEFAULT_HEDGE_DELAY,
+        show_default=True,
+        help="With --auto-source, the seconds to wait for the preferred source before also fetching the other one. 0 to fetch both at once.",
+    ),
+    click.option(
+        "--parser",
+        type=click.Choice(PARSER_BACKENDS),
+        default="html5lib",
+        show_default=True,
+        help="The HTML parser used to extract the text. lxml is much faster and gives the same text.",
+    ),
+)
+
+force_refresh_option = click.option(
+    "--force-refresh",
+    is_flag=True,
+    help="If True, fetch and parse the papers again, ignoring the cache.",
+)
+
+
+def render_timeout_option(default=0):
+    """
+    Returns the --render-timeout option, prefetch.py waits longer by default.
+    """
+    return click.option(
+        "--render-timeout",
+        default=default,
+        type=float,
+        show_default=True,
+        help="How long to wait for a paper that is still rendering, in seconds. 0 to fail at once.",
+    )
+
+
+compact_option = click.option(
+    "--compact/--no-compact",
+    default=False,
+    help="If True, remove the noise (footnote marks, LaTeX formatting, repeated affiliations) from the paper text, and shorten its citations and tables if that makes a paper that is too long fit in a single prompt.",
+)
+
+# How the summary is made
+summary_options = _options(
+    click.option(
+        "--dry-run",
+        is_flag=True,
+        help="If True, don't actually generate summaries. Papers will still be downloaded and cached, but no calls will be made to the LLM.",
+    ),
+    click.option(
+        "--chunked/--no-chunked",
+        default=True,
+        help="If True, summarize papers that are too long for a single prompt chunk by chunk, otherwise fail them.",
+    ),
+    click.option(
+        "--chunk-tokens",
+        default=DEFAULT_CHUNK_TOKENS,
+        show_default=True,
+        help="The maximum number of tokens in a chunk of a long paper.",
+    ),
+    click.option(
+        "--fanout",
+        default=0,
+        show_default=True,
+        help="Split the questions into this many groups and answer the groups with concurrent LLM calls. Faster, but the paper is sent once per group. 0 to ask all questions in one call.",
+    ),
+    click.option(
+        "--question-groups",
+        help='The question groups of --fanout, e.g. "1-6,7-12,13-19" or "1-4+19,5-18".',
+    ),
+    click.option(
+        "--incremental",
+        is_flag=True,
+        help="If True, check arXiv for new versions of the papers that were summarized before. Only the sections that changed are sent to the LLM, with the previous answers, and the summary is kept if nothing material changed.",
+    ),
+    click.option(
+        "--min-changed-words",
+        default=MIN_CHANGED_WORDS,
+        show_default=True,
+        help="With --incremental, the number of changed words below which the previous summary is kept.",
+    ),
+    click.option(
+        "--no-llm-cache",
+        is_flag=True,
+        help="If True, don't use cached LLM responses. The new responses are still cached.",
+    ),
+)
+
+# Where the LLM calls go, see endpoints.configure_endpoints
+endpoint_options = _options(
+    click.option(
+        "--endpoints",
+        "endpoints_file",
+        type=click.Path(exists=True, dir_okay=False),
+        envvar="OPENAI_ENDPOINTS",
+        help="A JSON file listing the deployments the LLM calls are spread over. Defaults to $OPENAI_ENDPOINTS, or the single deployment of the OPENAI_API_* variables.",
+    ),
+    click.option(
+        "--tpm",
+        type=int,
+        envvar="OPENAI_TPM",
+        help="The tokens-per-minute limit of each deployment that doesn't set its own, LLM calls wait for the budget. Defaults to $OPENAI_TPM, or no limit.",
+    ),
+    click.option(
+        "--rpm",
+        type=int,
+        envvar="OPENAI_RPM",
+        help="The requests-per-minute limit of each deployment that doesn't set its own. Defaults to $OPENAI_RPM, or no limit.",
+    ),
+)
+
+max_parsers_option = click.option(
+    "--max-parsers",
+    default=None,
+    type=int,
+    help="Number of parser processes. Defaults to the number of CPUs.",
+)
+
+# The concurrency of the stages of BatchPipeline
+pipeline_options = _options(
+    click.option(
+        "--max-downloads",
+        default=4,
+        show_default=True,
+        help="Maximum number of concurrent downloads per host and CodiMD uploads.",
+    ),
+    max_parsers_option,
+    click.option(
+        "--max-llm-calls",
+        default=2,
+        show_default=True,
+        help="Maximum number of concurrent LLM calls.",
+    ),
+)
+
+trace_file_option = click.option(
+    "--trace-file",
+    type=click.Path(dir_okay=False, path_type=Path),
+    help="Append the timing of each step of each paper (fetch, parse, LLM, ...) to this JSONL file.",
+)
+
+metrics_file_option = click.option(
+    "--metrics-file",
+    type=click.Path(dir_okay=False, path_type=Path),
+    help="Write the step timings, LLM speed, token counts and cost to this file, in the Prometheus text format.",
+)
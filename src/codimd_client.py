@@ -1,30 +1,276 @@
-import requests
 import re
 import os
+import json
+import time
+import random
+import asyncio
+import sqlite3
+import hashlib
+import logging
+import functools
+import threading
 import dotenv
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+
+from file_lock import get_lock
+from tracing import traced
 
 dotenv.load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 CODIMD_HOST = os.getenv("CODIMD_HOST")
 CODIMD_EMAIL = os.getenv("CODIMD_EMAIL")
 CODIMD_PASSWORD = os.getenv("CODIMD_PASSWORD")
 
+# The session cookie and the published notes, kept between runs
+_CURRENT_DIR = Path(os.path.dirname(os.path.realpath(__file__)))
+CODIMD_STORE_PATH = _CURRENT_DIR / ".cached" / "codimd.sqlite3"
+
+# How often a streamed note is updated while the summary is generated, in
+# seconds
+DEFAULT_UPDATE_INTERVAL = 5.0
+
+# Responses retried with backoff, like http_client.RETRY_STATUSES
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# How long the note history is reused to check for unchanged summaries
+HISTORY_MAX_AGE = 60.0
+
+# The client returned by get_codimd_client, shared by all papers of a run
+_client = None
+
+
+class CodimdError(Exception):
+    pass
+
+
+class NoteUpdateNotSupported(CodimdError):
+    pass
+
+
+class CodimdStore:
+    """
+    Keeps the session cookies of CodiMD accounts, so that runs don't log in
+    again, and the notes published for each summary, so that unchanged
+    summaries are not published twice.
+
+    The file holds a session cookie, so it is only readable by its owner.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS sessions (
+                    host TEXT NOT NULL,
+                    user TEXT NOT NULL,
+                    cookies TEXT NOT NULL,
+                    saved_at REAL NOT NULL,
+                    PRIMARY KEY (host, user)
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS published (
+                    host TEXT NOT NULL,
+                    content_hash TEXT NOT NULL,
+                    note_id TEXT NOT NULL,
+                    url TEXT NOT NULL,
+                    published_at REAL NOT NULL,
+                    PRIMARY KEY (host, content_hash)
+                )
+                """
+            )
+        os.chmod(self.path, 0o600)
+
+    def _connect(self):
+        # one connection per call, so the store can be used from any thread
+        return sqlite3.connect(self.path, timeout=30)
+
+    def load_cookies(self, host, user):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT cookies FROM sessions WHERE host = ? AND user = ?",
+                (host, user or ""),
+            ).fetchone()
+        return json.loads(row[0]) if row is not None else []
+
+    def save_cookies(self, host, user, cookies):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?)",
+                (host, user or "", json.dumps(cookies), time.time()),
+            )
+
+    def get_published(self, host, content_hash):
+        """
+        Returns the (note_id, url) a content was published to, or None.
+        """
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT note_id, url FROM published "
+                "WHERE host = ? AND content_hash = ?",
+                (host, content_hash),
+            ).fetchone()
+
+    def lock(self, host, content_hash):
+        """
+        Returns the FileLock held while a content is published, see
+        CodimdClient.create_and_publish.
+        """
+        lock_dir = self.path.parent / "locks"
+        return get_lock(lock_dir, f"published:{host}:{content_hash}")
+
+    def put_published(self, host, content_hash, note_id, url):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO published VALUES (?, ?, ?, ?, ?)",
+                (host, content_hash, note_id, url, time.time()),
+            )
+
+
+def get_content_hash(markdown_content):
+    return hashlib.sha256(markdown_content.encode("utf-8")).hexdigest()
+
 
 class CodimdClient:
-    def __init__(self, host, user, password):
+    """
+    A client of a CodiMD server.
+
+    The session cookie is kept in the store and reused by the next runs; the
+    client only logs in when the server does not know the session anymore.
+    Requests that fail to connect or return one of RETRY_STATUSES are retried
+    with exponential backoff. create_and_publish skips summaries that were
+    already published unchanged, as long as the note is still in the history.
+
+    Parameters:
+    host (str): The URL of the server
+    user, password (str): The credentials of the account
+    store (CodimdStore): Where the session and the published notes are kept,
+    or None to keep nothing
+    max_retries (int): The number of retries after the first attempt
+    backoff (float): The delay before the first retry in seconds, doubled on
+    every retry
+    max_backoff (float): The maximum delay between retries in seconds
+    timeout (float): The timeout of a single attempt in seconds
+    """
+
+    def __init__(
+        self,
+        host,
+        user,
+        password,
+        store=None,
+        max_retries=3,
+        backoff=1.0,
+        max_backoff=30.0,
+        timeout=30.0,
+    ):
         self.host = host
-        self.session = self.login(user, password)
+        self.user = user
+        self.password = password
+        self.store = store
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        # requests is imported by the runs that publish, not by dry runs
+        import requests
+
+        self.session = requests.Session()
+        # connections for the threads of publish_many and the batch mode
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=16)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._history = None
+        self._history_time = 0.0
+        self._lock = threading.Lock()
+
+        if store is not None:
+            for cookie in store.load_cookies(host, user):
+                self.session.cookies.set(**cookie)
+        if not self.is_logged_in():
+            self.login()
+
+    def _request(self, method, path, **kwargs):
+        """
+        Sends a request, retrying on connection errors and RETRY_STATUSES.
+
+        Raises:
+        CodimdError: If the last attempt failed to connect or was retried
+        """
+        import requests
+
+        attempt = 0
+        while True:
+            try:
+                r = self.session.request(
+                    method, self.host + path, timeout=self.timeout, **kwargs
+                )
+            except requests.RequestException as e:
+                if attempt >= self.max_retries:
+                    raise CodimdError(f"{method} {path} failed: {e}") from e
+                reason = f"failed ({type(e).__name__}: {e})"
+            else:
+                if r.status_code not in RETRY_STATUSES:
+                    return r
+                if attempt >= self.max_retries:
+                    raise CodimdError(f"{method} {path} returned {r.status_code}")
+                reason = f"returned {r.status_code}"
+            delay = min(self.backoff * 2**attempt, self.max_backoff)
+            delay *= random.uniform(0.5, 1.0)
+            logger.warning(f"{method} {path} {reason}, retrying in {delay:.1f}s")
+            attempt += 1
+            time.sleep(delay)
 
-    def login(self, user, password):
+    def is_logged_in(self):
         """
-        login and return session
+        Returns True if the session is logged in, according to /me.
         """
-        session = requests.Session()
-        r = session.post(
-            self.host + "/login", data={"email": user, "password": password}
+        if not self.session.cookies:
+            return False
+        r = self._request("GET", "/me")
+        try:
+            return r.ok and r.json().get("status") == "ok"
+        except ValueError:
+            return False
+
+    @traced("codimd_login")
+    def login(self):
+        """
+        login and keep the session cookie in the store
+
+        Raises:
+        CodimdError: If the server does not accept the credentials
+        """
+        self.session.cookies.clear()
+        r = self._request(
+            "POST",
+            "/login",
+            data={"email": self.user, "password": self.password},
+            allow_redirects=False,
         )
-        r.raise_for_status()
-        return session
+        if r.status_code >= 400 or not self.is_logged_in():
+            raise CodimdError(f"Cannot log into {self.host} as {self.user}")
+        if self.store is not None:
+            cookies = [
+                {
+                    "name": c.name,
+                    "value": c.value,
+                    "domain": c.domain,
+                    "path": c.path,
+                }
+                for c in self.session.cookies
+            ]
+            self.store.save_cookies(self.host, self.user, cookies)
+        logger.info(f"Logged into {self.host}")
 
     def create_new(self, markdown_content, note_id=None):
         """
@@ -36,35 +282,123 @@ class CodimdClient:
         else:
             endpoint = "/new"
 
-        r = self.session.post(
-            self.host + endpoint,
+        r = self._request(
+            "POST",
+            endpoint,
             headers=header,
             data=markdown_content.encode("utf-8"),
             allow_redirects=False,
         )
-        assert r.status_code == 302, r.text
         # Found. Redirecting to /note_id
-        note_id = re.search(r"Found. Redirecting to /(.*)", r.text).group(1).strip()
-        assert note_id is not None
-        return note_id
+        m = re.search(r"Found. Redirecting to /(.*)", r.text)
+        if r.status_code != 302 or m is None:
+            raise CodimdError(f"Cannot create note: {r.status_code} {r.text[:200]}")
+        return m.group(1).strip()
 
     def publish_note(self, note_id):
         """
         publish note and return publish url
         """
-        r = self.session.get(self.host + f"/{note_id}/publish", allow_redirects=False)
-        assert r.status_code == 302
+        r = self._request("GET", f"/{note_id}/publish", allow_redirects=False)
         # Found. Redirecting to /publish_note_id
-        publish_url = re.search(r"Found. Redirecting to (.*)", r.text).group(1).strip()
-        return publish_url
+        m = re.search(r"Found. Redirecting to (.*)", r.text)
+        if r.status_code != 302 or m is None:
+            raise CodimdError(f"Cannot publish note {note_id}: {r.status_code}")
+        return m.group(1).strip()
 
-    def create_and_publish(self, markdown_content):
+    def update_note(self, note_id, markdown_content):
+        """
+        replace the content of a note, with a JSON body {"content": markdown}
+
+        Raises:
+        NoteUpdateNotSupported: If the server has no API to update notes
+        CodimdError: If the update failed
+        """
+        r = self._request(
+            "PUT", f"/api/notes/{note_id}", json={"content": markdown_content}
+        )
+        if r.status_code in (404, 405):
+            raise NoteUpdateNotSupported(f"{self.host} cannot update notes")
+        if r.status_code >= 400:
+            raise CodimdError(f"Cannot update note {note_id}: {r.status_code}")
+
+    def _get_history_ids(self):
+        # one history request for the papers of a batch
+        with self._lock:
+            if time.monotonic() - self._history_time > HISTORY_MAX_AGE:
+                self._history = {h["id"] for h in self.history()["history"]}
+                self._history_time = time.monotonic()
+            return self._history
+
+    def _find_published(self, content_hash):
+        if self.store is None:
+            return None
+        published = self.store.get_published(self.host, content_hash)
+        if published is None:
+            return None
+        note_id, url = published
+        try:
+            if note_id in self._get_history_ids():
+                return url
+        except (CodimdError, ValueError, KeyError) as e:
+            logger.warning(f"Cannot read the note history: {e}")
+        return None
+
+    @traced("publish")
+    def create_and_publish(self, markdown_content, skip_unchanged=True):
         """
         create new and publish and return publish url
+
+        If skip_unchanged and the same content was published before to a note
+        that is still in the history, the url of that note is returned. The
+        processes that publish the same content at the same time wait for the
+        first one and return its url.
         """
+        content_hash = get_content_hash(markdown_content)
+        if skip_unchanged and self.store is not None:
+            with self.store.lock(self.host, content_hash):
+                url = self._find_published(content_hash)
+                if url is not None:
+                    logger.info(f"The summary was already published to {url}")
+                    return url
+                return self._create_and_publish(markdown_content, content_hash)
+        return self._create_and_publish(markdown_content, content_hash)
+
+    def _create_and_publish(self, markdown_content, content_hash):
         note_id = self.create_new(markdown_content)
-        publish_url = self.publish_note(note_id)
-        return self.host + publish_url
+        url = self.host + self.publish_note(note_id)
+        self._record_published(content_hash, note_id, url)
+        return url
+
+    def _record_published(self, content_hash, note_id, url):
+        # the note is found again by _find_published while it exists
+        if self.store is not None:
+            self.store.put_published(self.host, content_hash, note_id, url)
+            with self._lock:
+                if self._history is not None:
+                    self._history.add(note_id)
+
+    async def publish_many(
+        self, markdown_contents, max_concurrency=4, skip_unchanged=True
+    ):
+        """
+        Publishes many notes concurrently, over the pooled session, see
+        create_and_publish.
+
+        Returns:
+        results (list): The publish url of each note, or the exception that
+        made it fail
+        """
+        loop = asyncio.get_running_loop()
+        publish = functools.partial(
+            self.create_and_publish, skip_unchanged=skip_unchanged
+        )
+        with ThreadPoolExecutor(max_concurrency) as pool:
+            futures = [
+                loop.run_in_executor(pool, publish, content)
+                for content in markdown_contents
+            ]
+            return await asyncio.gather(*futures, return_exceptions=True)
 
     def history(self):
         """
@@ -79,13 +413,150 @@ class CodimdClient:
               'text': 'Untitled',
               'time': 1681397337712}]}
         """
-        r = self.session.get(self.host + "/history")
-        r.raise_for_status()
+        r = self._request("GET", "/history")
+        if r.status_code >= 400:
+            raise CodimdError(f"Cannot read the history: {r.status_code}")
         return r.json()
 
 
+class StreamingNote:
+    """
+    A note that is published before its content is generated, and updated
+    with the content so far while it is streamed.
+
+    Updates are sent at most every interval seconds from a background thread,
+    so that on_content can be called from the event loop. If an update is
+    still running, the next one waits for the next piece of content.
+
+    Parameters:
+    client (CodimdClient): The client the note is created with
+    header (str): The markdown shown above the content
+    placeholder (str): The content shown until the first update
+    interval (float): The minimum time between two updates, in seconds
+    """
+
+    def __init__(
+        self,
+        client,
+        header,
+        placeholder="*The notes are being generated...*",
+        interval=DEFAULT_UPDATE_INTERVAL,
+    ):
+        self.client = client
+        self.header = header
+        self.interval = interval
+        self.note_id = client.create_new(self._render(placeholder))
+        self.url = client.host + client.publish_note(self.note_id)
+        self.updates = 0
+        self._content = []
+        self._last_update = time.monotonic()
+        self._pending = None
+        self._supported = True
+        self._pool = ThreadPoolExecutor(max_workers=1)
+
+    def _render(self, content):
+        return self.header.rstrip() + "\n\n" + content
+
+    def _update(self, markdown):
+        try:
+            self.client.update_note(self.note_id, markdown)
+            self.updates += 1
+        except NoteUpdateNotSupported as e:
+            logger.warning(f"{e}, the note is written when the summary is done")
+            self._supported = False
+        except CodimdError as e:
+            # the next update sends the whole content again
+            logger.warning(f"Cannot update note {self.note_id}: {e}")
+
+    def on_content(self, content):
+        self._content.append(content)
+        if not self._supported:
+            return
+        if self._pending is not None and not self._pending.done():
+            return
+        now = time.monotonic()
+        if now - self._last_update < self.interval:
+            return
+        self._last_update = now
+        markdown = self._render("".join(self._content))
+        self._pending = self._pool.submit(self._update, markdown)
+
+    def close(self, markdown):
+        """
+        Writes the final markdown to the note and returns the publish URL. If
+        the server cannot update the note, a new note is published instead.
+        Either way the note is recorded in the store, so that the same summary
+        is not published again.
+        """
+        if self._pending is not None:
+            self._pending.result()
+        self._pool.shutdown()
+        if self._supported:
+            try:
+                self.client.update_note(self.note_id, markdown)
+            except NoteUpdateNotSupported:
+                pass
+            except CodimdError as e:
+                logger.warning(f"{e}, publishing the summary as a new note")
+            else:
+                self.client._record_published(
+                    get_content_hash(markdown), self.note_id, self.url
+                )
+                return self.url
+        return self.client.create_and_publish(markdown)
+
+
 def get_codimd_client():
-    if CODIMD_HOST:
-        return CodimdClient(CODIMD_HOST, CODIMD_EMAIL, CODIMD_PASSWORD)
-    else:
+    """
+    Returns the client of CODIMD_HOST, created once per process, or None if
+    no server is configured.
+    """
+    global _client
+    if not CODIMD_HOST:
         return None
+    if _client is None:
+        _client = CodimdClient(
+            CODIMD_HOST,
+            CODIMD_EMAIL,
+            CODIMD_PASSWORD,
+            store=CodimdStore(CODIMD_STORE_PATH),
+        )
+    return _client
+
+
+@click.command()
+@click.argument("files", nargs=-1, type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--max-concurrency",
+    default=4,
+    show_default=True,
+    help="Maximum number of notes published at the same time.",
+)
+@click.option(
+    "--force",
+    is_flag=True,
+    help="If True, publish summaries again even if they were published unchanged.",
+)
+def main(files, max_concurrency, force):
+    """
+    Publishes summary files (e.g. from src/.cached) to CodiMD.
+    """
+    logging.basicConfig(
+        level=logging.INFO, format="%(levelname)s [%(filename)s]: %(message)s"
+    )
+    client = get_codimd_client()
+    if client is None:
+        raise click.UsageError("CODIMD_HOST is not set")
+    contents = [Path(f).read_text(encoding="utf-8").strip() for f in files]
+    results = asyncio.run(
+        client.publish_many(contents, max_concurrency, skip_unchanged=not force)
+    )
+    for path, result in zip(files, results):
+        if isinstance(result, Exception):
+            logger.error(f"Cannot publish {path}: {result}")
+        else:
+            print(f"{path}\t{result}")
+
+
+if __name__ == "__main__":
+    main()
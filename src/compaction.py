@@ -0,0 +1,404 @@
+import re
+import abc
+import json
+import hashlib
+import logging
+
+from token_counter import (
+    count_paper_prompt_tokens,
+    count_tokens,
+    count_tokens_batch,
+    get_encoder,
+)
+
+logger = logging.getLogger(__name__)
+
+# Bump when the output of the rules changes, so that the cached compacted
+# texts are made again
+COMPACTION_VERSION = 2
+
+# Tables are runs of at least TABLE_MIN_LINES short lines (one cell per line),
+# shortened to their first TABLE_KEEP_LINES cells
+TABLE_MIN_LINES = 12
+TABLE_MAX_LINE_LENGTH = 24
+TABLE_KEEP_LINES = 6
+
+# The footnote marks of LaTeXML: a mark glued to the word before it or at
+# the start of a line ("work11footnote 1Equal contribution"), or the explicit
+# "footnotemark:" and "footnotetext:" forms. "see 2 footnotes" is prose.
+_FOOTNOTE_MARK_RE = (
+    r"(?:(?<=[^\s\d])|^)\d+footnote ?\d+"
+    r"|(?<![A-Za-z])\d*footnote(?:mark|text): ?\d* ?"
+)
+
+# LaTeX commands that only change the typesetting of formulas, left in the
+# text by the renderers: their arguments are kept, the commands are removed.
+# The formulas kept on purpose with --keep-latex are left as they are.
+_LATEX_RE = (
+    r"\\(?:mathrm|textrm|text|mathit|textit|operatorname)\{(?P<arg>[^{}]*)\}"
+    r"|\\(?:left|right)(?:\.|(?![a-zA-Z]))"
+    r"|\\(?:displaystyle|textstyle|scriptstyle|[bB]igg?[lr]?)(?![a-zA-Z]) ?"
+    r"|\\[,;:!]"
+    r"|(?P<space>\\q?quad)(?![a-zA-Z]) ?"
+    r"|\\label\{[^{}]*\}"
+)
+
+# Numeric citations, e.g. "[1]" or "[3, 7-9]", whose references are removed
+# unless --keep-ref is used. A citation follows a word and ends the clause
+# ("as shown in [3, 7-9]."); intervals like "[0, 1]" and ranges followed by
+# more words ("[2-5] tokens") are not citations.
+_CITATION_NUMBERS = r"\[[1-9]\d*(?:\s*[,–-]\s*[1-9]\d*)*\]"
+_CITATION_RE = r"(?<=\w) ?(?:%s)+(?=[.,;:)]|$)" % _CITATION_NUMBERS
+
+# A run of table cells, the caption that follows them is not part of it
+_TABLE_RE = r"(?:^(?!Table|Figure)[^\n]{1,%d}(?:\n|\Z)){%d,}" % (
+    TABLE_MAX_LINE_LENGTH,
+    TABLE_MIN_LINES,
+)
+
+_ABSTRACT_RE = re.compile(r"^Abstract", re.MULTILINE)
+_EMAIL_RE = re.compile(r" ?[\w.+-]+@[\w-]+(?:\.[\w-]+)+")
+
+
+def _replace_footnote_mark(m):
+    # a mark glued between two words is replaced by a space
+    start = m.start()
+    if start == 0 or m.string[start - 1] in "\n ":
+        return ""
+    return " "
+
+
+def _replace_latex(m):
+    if m.group("arg") is not None:
+        return m.group("arg")
+    if m.group("space") is not None:
+        return " "
+    return ""
+
+
+def _shorten_table(m):
+    lines = m.group().splitlines(keepends=True)
+    omitted = len(lines) - TABLE_KEEP_LINES
+    return "".join(lines[:TABLE_KEEP_LINES]) + f"[{omitted} more table cells]\n"
+
+
+class CompactionRule(abc.ABC):
+    """
+    Finds the spans of the text of a paper that can be replaced by shorter
+    text.
+
+    The value of a rule orders the pruning: the spans of the rules with value
+    0 are noise and are always replaced, the spans of the others only when the
+    paper does not fit in the prompt, lowest value first.
+
+    Parameters:
+    name (str): The name of the rule in the reports
+    value (int): How much the replaced text is worth to the summary
+    """
+
+    def __init__(self, name, value=0):
+        self.name = name
+        self.value = value
+
+    @abc.abstractmethod
+    def find(self, text, index):
+        """
+        Returns the (start, end, replacement) spans of the text of the section
+        at position index of the paper.
+        """
+
+
+class RegexRule(CompactionRule):
+    """
+    Replaces the matches of a regex, in multiline mode.
+
+    Parameters:
+    name (str): The name of the rule in the reports
+    pattern (str): The regex of the spans
+    repl (str or function): The replacement, as in re.sub
+    value (int): How much the replaced text is worth to the summary
+    """
+
+    def __init__(self, name, pattern, repl="", value=0):
+        super().__init__(name, value)
+        self.pattern = re.compile(pattern, re.MULTILINE)
+        self.repl = repl
+
+    def find(self, text, index):
+        spans = []
+        for m in self.pattern.finditer(text):
+            repl = m.expand(self.repl) if isinstance(self.repl, str) else self.repl(m)
+            spans.append((m.start(), m.end(), repl))
+        return spans
+
+
+class FrontMatterRule(CompactionRule):
+    """
+    Removes the lines that repeat an earlier line (e.g. the affiliation of
+    each author) and the email addresses from the title block, the text of the
+    first section before its abstract.
+    """
+
+    def find(self, text, index):
+        if index != 0:
+            return []
+        m = _ABSTRACT_RE.search(text)
+        if m is None:
+            return []
+        spans = []
+        seen = set()
+        pos = 0
+        for line in text[: m.start()].splitlines(keepends=True):
+            emails = list(_EMAIL_RE.finditer(line))
+            key = _EMAIL_RE.sub("", line).strip()
+            if key and key in seen:
+                spans.append((pos, pos + len(line), ""))
+            else:
+                seen.add(key)
+                for email in emails:
+                    spans.append((pos + email.start(), pos + email.end(), ""))
+            pos += len(line)
+        return spans
+
+
+# The rules applied by default, in order
+COMPACTION_RULES = [
+    RegexRule("footnotes", _FOOTNOTE_MARK_RE, _replace_footnote_mark),
+    RegexRule("latex", _LATEX_RE, _replace_latex),
+    FrontMatterRule("affiliations"),
+    RegexRule("citations", _CITATION_RE, value=1),
+    RegexRule("tables", _TABLE_RE, _shorten_table, value=2),
+]
+
+
+def get_compaction_rules(keep_latex=False):
+    """
+    Returns the rules of COMPACTION_RULES that apply to a paper. The "latex"
+    rule is skipped when the LaTeX of the formulas is kept with --keep-latex.
+    """
+    if keep_latex:
+        return [rule for rule in COMPACTION_RULES if rule.name != "latex"]
+    return COMPACTION_RULES
+
+
+def _find_spans(rule, sections):
+    return [
+        (index, start, end, repl)
+        for index, text in enumerate(sections)
+        for start, end, repl in rule.find(text, index)
+    ]
+
+
+def _replace_spans(sections, spans):
+    by_section = {}
+    for index, start, end, repl in spans:
+        by_section.setdefault(index, []).append((start, end, repl))
+    compacted = []
+    for index, text in enumerate(sections):
+        parts = []
+        pos = 0
+        for start, end, repl in sorted(by_section.get(index, ())):
+            # a span that overlaps one already replaced is skipped
+            if start < pos:
+                continue
+            parts.append(text[pos:start])
+            parts.append(repl)
+            pos = end
+        parts.append(text[pos:])
+        compacted.append("".join(parts))
+    return compacted
+
+
+def _count_savings(sections, spans, enc):
+    """
+    Returns the number of tokens saved by each span, counted on the span
+    alone, so the total can be off by a token where the span joins the text.
+    """
+    if not spans:
+        return []
+    texts = [sections[index][start:end] for index, start, end, _ in spans]
+    texts += [repl for *_, repl in spans]
+    counts = count_tokens_batch(texts, enc)
+    return [counts[i] - counts[len(spans) + i] for i in range(len(spans))]
+
+
+def _prune(sections, num_tokens, max_tokens, rules, enc):
+    """
+    Replaces the spans of the rules, lowest value first and the spans that
+    save the most tokens first, until the text has at most max_tokens tokens.
+
+    Returns:
+    sections (list of str): The pruned sections, or None if the spans of all
+    rules don't save enough tokens
+    num_tokens (int): The number of tokens of the pruned text
+    saved (dict): The tokens saved by each rule
+    """
+    saved = {}
+    for rule in sorted(rules, key=lambda r: r.value):
+        if num_tokens <= max_tokens:
+            break
+        base = sections
+        spans = _find_spans(rule, base)
+        ranked = sorted(
+            zip(_count_savings(base, spans, enc), spans),
+            key=lambda item: item[0],
+            reverse=True,
+        )
+        ranked = [item for item in ranked if item[0] > 0]
+        chosen = []
+        # the estimate of each round is checked with the count of the text
+        while ranked and num_tokens > max_tokens:
+            estimate = num_tokens
+            while ranked and estimate > max_tokens:
+                saving, span = ranked.pop(0)
+                chosen.append(span)
+                estimate -= saving
+                saved[rule.name] = saved.get(rule.name, 0) + saving
+            sections = _replace_spans(base, chosen)
+            num_tokens = count_tokens("\n".join(sections), enc)
+    if num_tokens > max_tokens:
+        return None, num_tokens, saved
+    return sections, num_tokens, saved
+
+
+def compact_sections(
+    sections, enc=None, max_tokens=None, rules=None, keep_latex=False
+):
+    """
+    Removes the noise from the sections of a paper, then, if the paper has
+    more than max_tokens tokens, prunes the spans of the other rules until it
+    fits. The pruning is skipped if it cannot make the paper fit, since the
+    paper is then read in chunks anyway.
+
+    Parameters:
+    sections (list of str): The reduced text of each section
+    enc (tiktoken.Encoding or LazyEncoder): The encoder, defaults to the
+    gpt-4 one
+    max_tokens (int): The tokens the paper content may have, None to only
+    remove the noise
+    rules (list of CompactionRule): The rules, defaults to the rules of
+    get_compaction_rules
+    keep_latex (bool): Whether the text has the LaTeX of the formulas
+
+    Returns:
+    sections (list of str): The compacted sections, without empty sections
+    report (dict): The tokens "saved" by each rule, and whether the paper
+    was "pruned" to fit
+    """
+    enc = enc or get_encoder()
+    rules = get_compaction_rules(keep_latex) if rules is None else rules
+
+    saved = {}
+    for rule in rules:
+        if rule.value != 0:
+            continue
+        spans = _find_spans(rule, sections)
+        if spans:
+            saved[rule.name] = sum(_count_savings(sections, spans, enc))
+            sections = _replace_spans(sections, spans)
+
+    pruned = False
+    if max_tokens is not None:
+        num_tokens = count_tokens("\n".join(sections), enc)
+        if num_tokens > max_tokens:
+            lossy_rules = [rule for rule in rules if rule.value != 0]
+            pruned_sections, num_tokens, pruned_saved = _prune(
+                sections, num_tokens, max_tokens, lossy_rules, enc
+            )
+            if pruned_sections is not None:
+                sections = pruned_sections
+                saved.update(pruned_saved)
+                pruned = True
+
+    sections = [section for section in sections if section.strip()]
+    return sections, {"saved": saved, "pruned": pruned}
+
+
+def _get_compaction_hash(sections, rules, max_tokens, encoding):
+    h = hashlib.sha256()
+    names = ",".join(f"{rule.name}:{rule.value}" for rule in rules)
+    h.update(f"{COMPACTION_VERSION}|{names}|{max_tokens}|{encoding}\0".encode())
+    for text in sections:
+        h.update(text.encode("utf-8") + b"\0")
+    return h.hexdigest()
+
+
+def compact_paper(
+    cache,
+    key,
+    sections,
+    enc=None,
+    max_prompt_tokens=None,
+    arxiv_id=None,
+    rules=None,
+    keep_latex=False,
+):
+    """
+    Compacts the reduced sections of a paper before the prompt is made, see
+    compact_sections.
+
+    The result is stored in the PaperCache next to the cached text (same key,
+    kind "compact") and reused as long as the sections, the rules and the
+    budget are the same, so a paper read again is not compacted (nor
+    tokenized) again.
+
+    Parameters:
+    cache (PaperCache): The cache of the paper text, or None to not store
+    the result
+    key (str): The text cache key of the paper
+    sections (list of str): The reduced text of each section
+    enc (tiktoken.Encoding or LazyEncoder): The encoder
+    max_prompt_tokens (int): The tokens the paper_query.tpl prompt may have,
+    None to only remove the noise
+    rules (list of CompactionRule): The rules, defaults to the rules of
+    get_compaction_rules
+    keep_latex (bool): Whether the text has the LaTeX of the formulas
+
+    Returns:
+    paper_content (str): The compacted text of the paper
+    sections (list of str): The compacted sections
+    report (dict): The tokens "saved" by each rule, and whether the paper
+    was "pruned" to fit
+    """
+    enc = enc or get_encoder()
+    rules = get_compaction_rules(keep_latex) if rules is None else rules
+    text_hash = _get_compaction_hash(sections, rules, max_prompt_tokens, enc.name)
+    if cache is not None:
+        data = cache.get_text(key, "compact")
+        if data is not None:
+            try:
+                entry = json.loads(data)
+            except ValueError:
+                entry = {}
+            if entry.get("hash") == text_hash:
+                sections = entry["sections"]
+                return "\n".join(sections), sections, entry["report"]
+
+    max_tokens = None
+    if max_prompt_tokens is not None:
+        max_tokens = max_prompt_tokens - count_paper_prompt_tokens(0, enc=enc)
+    sections, report = compact_sections(sections, enc, max_tokens, rules)
+    if cache is not None:
+        entry = {"hash": text_hash, "sections": sections, "report": report}
+        cache.put(
+            key,
+            "compact",
+            json.dumps(entry),
+            arxiv_id=arxiv_id,
+            options=key.split(".", 1)[1] if "." in key else None,
+        )
+    return "\n".join(sections), sections, report
+
+
+def format_report(report):
+    """
+    Returns the tokens saved by each rule as text for the logs, e.g.
+    "120 tokens (latex 80, footnotes 40)".
+    """
+    saved = {name: n for name, n in report["saved"].items() if n}
+    total = sum(saved.values())
+    details = ", ".join(f"{name} {n}" for name, n in saved.items())
+    text = f"{total} tokens" + (f" ({details})" if details else "")
+    if report["pruned"]:
+        text += ", pruned to fit the prompt"
+    return text
@@ -1,13 +1,53 @@
-# count tokens from stdin
-import tiktoken
-import click
+# count tokens from stdin or files
 import sys
 
+import click
+
+from token_counter import DEFAULT_NUM_THREADS, count_tokens_batch, get_encoder
+
+
 @click.command()
+@click.argument("files", nargs=-1, type=click.File("r", encoding="utf-8"))
 @click.option("--model", default="gpt-4", help="Model name")
-def main(model):
-    enc = tiktoken.encoding_for_model(model)
-    print(len(enc.encode(sys.stdin.read())))
+@click.option(
+    "--lines",
+    is_flag=True,
+    help="If True, count each line as a separate document, e.g. for JSONL files.",
+)
+@click.option(
+    "--threads",
+    default=DEFAULT_NUM_THREADS,
+    show_default=True,
+    help="The number of threads the documents are encoded with.",
+)
+def main(files, model, lines, threads):
+    """
+    Counts the tokens of FILES (or stdin). With several files or --lines,
+    prints the count of each document and the total.
+    """
+    enc = get_encoder(model)
+    if not files:
+        files = [sys.stdin]
+
+    names, texts = [], []
+    for f in files:
+        if lines:
+            for i, line in enumerate(f, start=1):
+                names.append(f"{f.name}:{i}")
+                texts.append(line.rstrip("\n"))
+        else:
+            names.append(f.name)
+            texts.append(f.read())
+
+    # all documents are encoded in one batch, spread over the threads
+    counts = count_tokens_batch(texts, enc, num_threads=threads)
+    if len(texts) == 1 and not lines:
+        print(counts[0])
+        return
+    for name, count in zip(names, counts):
+        print(f"{count}\t{name}")
+    print(f"{sum(counts)}\ttotal")
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,434 @@
+import os
+import json
+import time
+import random
+import logging
+
+from llm import (
+    DEFAULT_MODEL,
+    PRIORITY_ANSWER,
+    LLMScheduler,
+    get_openai,
+    is_retry_error,
+)
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+# The weight of the last time to first token in the moving average of an
+# endpoint
+TTFT_SMOOTHING = 0.3
+
+# The endpoint pool used by create_stream, see get_endpoint_pool
+_endpoint_pool = None
+_endpoint_options = {}
+
+
+class Endpoint:
+    """
+    A deployment of the model that LLM requests can be sent to, with its own
+    rate limits (an LLMScheduler) and health: the moving average of its time
+    to the first token, the requests in flight and the failures in a row.
+
+    Parameters:
+    name (str): The name of the endpoint in logs and metrics
+    api_base (str): The URL of the API, e.g. https://eastus.openai.azure.com/
+    api_key (str): The API key
+    api_type (str): "azure" or "open_ai"
+    api_version (str): The Azure API version, e.g. "2023-05-15"
+    engine (str): The deployment name (Azure) or model
+    model (str): The model the deployment serves, which the requests for it
+    are routed by and their responses cached under
+    tpm (int): The tokens-per-minute limit of the deployment, None for none
+    rpm (int): The requests-per-minute limit of the deployment, None for none
+    """
+
+    def __init__(
+        self,
+        name,
+        api_base,
+        api_key,
+        api_type="azure",
+        api_version=None,
+        engine=DEFAULT_MODEL,
+        model=DEFAULT_MODEL,
+        tpm=None,
+        rpm=None,
+    ):
+        self.name = name
+        self.api_base = api_base
+        self.api_key = api_key
+        self.api_type = api_type
+        self.api_version = api_version
+        self.engine = engine
+        self.model = model
+        self.scheduler = LLMScheduler(tpm=tpm, rpm=rpm)
+        self.ttft = None
+        self.active = 0
+        self.failures = 0
+        self.requests = 0
+        self.errors = 0
+        self.last_error = None
+
+    def create(self, **kwargs):
+        """
+        Returns the coroutine that requests a streamed chat completion from
+        the deployment.
+        """
+        return get_openai().ChatCompletion.acreate(
+            api_base=self.api_base,
+            api_key=self.api_key,
+            api_type=self.api_type,
+            api_version=self.api_version,
+            engine=self.engine,
+            stream=True,
+            **kwargs,
+        )
+
+    def expected_wait(self, prompt_tokens):
+        """
+        Returns about how many seconds a new request would take to get its
+        first token: the wait for the rate limits (or a pause after a failure)
+        plus the recent time to first token, longer with more requests in
+        flight. Endpoints without a request yet are tried first.
+        """
+        wait = self.scheduler.estimate_wait(prompt_tokens)
+        return wait + (self.ttft or 0.0) * (1 + self.active)
+
+    def record_success(self, ttft):
+        self.requests += 1
+        self.failures = 0
+        if self.ttft is None:
+            self.ttft = ttft
+        else:
+            self.ttft += TTFT_SMOOTHING * (ttft - self.ttft)
+
+    def record_failure(self, error, pause=0.0):
+        self.requests += 1
+        self.errors += 1
+        self.failures += 1
+        self.last_error = f"{type(error).__name__}: {error}"
+        if pause:
+            self.scheduler.pause(pause)
+
+    def health(self):
+        """
+        Returns the state of the endpoint, e.g. for the /endpoints page of the
+        server.
+        """
+        return {
+            "name": self.name,
+            "model": self.model,
+            "healthy": self.failures == 0,
+            "ttft": None if self.ttft is None else round(self.ttft, 3),
+            "active": self.active,
+            "requests": self.requests,
+            "errors": self.errors,
+            "failures_in_a_row": self.failures,
+            "wait": round(self.scheduler.estimate_wait(0), 3),
+            "last_error": self.last_error,
+        }
+
+
+class _EndpointStream:
+    """
+    The stream of a response, with the chunk that was read to check the
+    request. It counts as a request in flight of its endpoint until it is
+    exhausted, fails, is closed or is garbage collected, so a stream that is
+    abandoned or never read does not hold the endpoint.
+    """
+
+    def __init__(self, first, stream, endpoint):
+        self._first = first
+        self._stream = stream
+        self._endpoint = endpoint
+        self._released = False
+        if first is None:
+            self._release()
+
+    def _release(self):
+        if not self._released:
+            self._released = True
+            self._endpoint.active -= 1
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._first is not None:
+            chunk, self._first = self._first, None
+            return chunk
+        if self._released:
+            raise StopAsyncIteration
+        try:
+            return await self._stream.__anext__()
+        except BaseException:
+            # the end of the stream, an error or a cancellation
+            self._release()
+            raise
+
+    async def aclose(self):
+        self._first = None
+        self._release()
+        aclose = getattr(self._stream, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+    def __del__(self):
+        self._release()
+
+
+class EndpointPool:
+    """
+    Routes the LLM requests over several deployments.
+
+    Every request goes to the endpoint it would get its first token from the
+    soonest (see Endpoint.expected_wait), so that the load follows the free
+    rate limits and the fastest deployments. A request that fails before its
+    first token (429, 5xx, timeout or connection error) is sent again to
+    another endpoint, and the endpoint that failed is paused for the
+    Retry-After delay or an exponential backoff over its failures in a row.
+
+    Parameters:
+    endpoints (list of Endpoint): The endpoints, at least one
+    max_retries (int): The number of retries after the first attempt
+    backoff (float): The first pause of a failed endpoint, doubled after each
+    failure in a row
+    max_backoff (float): The maximum pause of a failed endpoint
+    """
+
+    def __init__(self, endpoints, max_retries=5, backoff=2.0, max_backoff=60.0):
+        if not endpoints:
+            raise ValueError("The endpoint pool needs at least one endpoint")
+        self.endpoints = list(endpoints)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def serving(self, model):
+        """
+        Returns the endpoints that serve a model.
+
+        Raises:
+        ValueError: If no endpoint serves it
+        """
+        endpoints = [e for e in self.endpoints if e.model == model]
+        if not endpoints:
+            raise ValueError(f"No LLM endpoint serves {model}")
+        return endpoints
+
+    def choose(self, prompt_tokens, exclude=(), model=DEFAULT_MODEL):
+        """
+        Returns the endpoint of the model a request should go to, avoiding the
+        endpoints named in exclude unless there is no other.
+        """
+        endpoints = self.serving(model)
+        candidates = [e for e in endpoints if e.name not in exclude]
+        return min(
+            candidates or endpoints,
+            key=lambda e: e.expected_wait(prompt_tokens),
+        )
+
+    def _pause(self, error, failures):
+        retry_after = (getattr(error, "headers", None) or {}).get("Retry-After")
+        if retry_after is not None:
+            try:
+                return min(float(retry_after), self.max_backoff)
+            except ValueError:
+                pass
+        delay = min(self.backoff * 2 ** (failures - 1), self.max_backoff)
+        # jitter, so that the paused requests don't all retry at once
+        return delay * random.uniform(0.5, 1.0)
+
+    async def _send(self, endpoint, request):
+        """
+        Sends a request and waits for its first chunk, so that the errors
+        before the first token can be retried.
+        """
+        stream = await request(endpoint)
+        try:
+            return await stream.__anext__(), stream
+        except StopAsyncIteration:
+            return None, stream
+
+    async def run(
+        self, request, prompt_tokens, priority=PRIORITY_ANSWER, model=DEFAULT_MODEL
+    ):
+        """
+        Sends a streamed request to the best endpoint of the model, retrying
+        it on the errors of is_retry_error.
+
+        Parameters:
+        request (callable): Takes an Endpoint and returns the coroutine that
+        sends the request to it, e.g. `lambda e: e.create(messages=...)`
+        prompt_tokens (int): The number of tokens of the prompt
+        priority (int): PRIORITY_ANSWER or PRIORITY_NOTES
+        model (str): The model the request is for
+
+        Returns:
+        The stream of the response
+
+        Raises:
+        ValueError: If no endpoint serves the model
+        """
+        num_endpoints = len(self.serving(model))
+        attempt = 0
+        tried = set()
+        while True:
+            # a request goes to every endpoint once before one gets it again
+            if len(tried) == num_endpoints:
+                tried = set()
+            endpoint = self.choose(prompt_tokens, exclude=tried, model=model)
+            tried.add(endpoint.name)
+            with span(
+                "llm_queue",
+                prompt_tokens=prompt_tokens,
+                priority=priority,
+                endpoint=endpoint.name,
+            ):
+                await endpoint.scheduler.acquire(prompt_tokens, priority)
+
+            endpoint.active += 1
+            start = time.perf_counter()
+            with span("llm_request", endpoint=endpoint.name, attempt=attempt) as s:
+                try:
+                    first, stream = await self._send(endpoint, request)
+                except Exception as e:
+                    endpoint.active -= 1
+                    s.set(error=type(e).__name__)
+                    if not is_retry_error(e):
+                        endpoint.record_failure(e)
+                        raise
+                    pause = self._pause(e, endpoint.failures + 1)
+                    endpoint.record_failure(e, pause)
+                    if attempt >= self.max_retries:
+                        raise
+                    logger.warning(
+                        f"LLM request to {endpoint.name} failed ({e}), "
+                        f"pausing it for {pause:.1f}s and retrying"
+                    )
+                    attempt += 1
+                    continue
+                ttft = time.perf_counter() - start
+                s.set(ttft=round(ttft, 6))
+            endpoint.record_success(ttft)
+            return _EndpointStream(first, stream, endpoint)
+
+    def health(self):
+        return [endpoint.health() for endpoint in self.endpoints]
+
+
+def _get_int_env(name):
+    value = os.getenv(name)
+    return int(value) if value else None
+
+
+def load_endpoints(path=None, tpm=None, rpm=None):
+    """
+    Returns the endpoints configured in a JSON file, or the single endpoint of
+    the OPENAI_API_* environment variables if there is no file.
+
+    The file is a list of endpoints with the parameters of Endpoint, where
+    the API key can also be read from an environment variable, e.g.
+
+        [{"name": "eastus", "api_base": "https://eastus.openai.azure.com/",
+          "api_key_env": "EASTUS_KEY", "api_version": "2023-05-15",
+          "engine": "gpt4-eastus", "model": "gpt-4-32k", "tpm": 80000,
+          "rpm": 480}, ...]
+
+    Parameters:
+    path (str): The JSON file, defaults to $OPENAI_ENDPOINTS
+    tpm (int): The tokens-per-minute limit of the endpoints that don't set
+    theirs, defaults to $OPENAI_TPM
+    rpm (int): The requests-per-minute limit of the endpoints that don't set
+    theirs, defaults to $OPENAI_RPM
+
+    Raises:
+    ValueError: If the file is invalid or no endpoint is configured
+    """
+    path = path or os.getenv("OPENAI_ENDPOINTS")
+    tpm = tpm or _get_int_env("OPENAI_TPM")
+    rpm = rpm or _get_int_env("OPENAI_RPM")
+
+    if not path:
+        missing = [
+            name
+            for name in ("OPENAI_API_BASE", "OPENAI_API_KEY")
+            if not os.getenv(name)
+        ]
+        if missing:
+            raise ValueError(
+                f"No LLM endpoint configured, set {' and '.join(missing)} "
+                "or OPENAI_ENDPOINTS"
+            )
+        return [
+            Endpoint(
+                "default",
+                api_base=os.environ["OPENAI_API_BASE"],
+                api_key=os.environ["OPENAI_API_KEY"],
+                api_type=os.getenv("OPENAI_API_TYPE") or "azure",
+                api_version=os.getenv("OPENAI_API_VERSION") or None,
+                tpm=tpm,
+                rpm=rpm,
+            )
+        ]
+
+    try:
+        with open(path, "r") as f:
+            configs = json.load(f)
+    except (OSError, ValueError) as e:
+        raise ValueError(f"Cannot read the endpoints of {path}: {e}")
+    if not isinstance(configs, list) or not configs:
+        raise ValueError(f"{path} should be a list of endpoints")
+
+    endpoints = []
+    for i, config in enumerate(configs):
+        config = dict(config)
+        name = config.setdefault("name", f"endpoint-{i}")
+        key_env = config.pop("api_key_env", None)
+        if key_env:
+            config["api_key"] = os.getenv(key_env)
+        if not config.get("api_base") or not config.get("api_key"):
+            raise ValueError(f"Endpoint {name} of {path} needs an api_base and a key")
+        config.setdefault("tpm", tpm)
+        config.setdefault("rpm", rpm)
+        try:
+            endpoints.append(Endpoint(**config))
+        except TypeError as e:
+            raise ValueError(f"Invalid endpoint {name} in {path}: {e}")
+    names = [endpoint.name for endpoint in endpoints]
+    if len(set(names)) != len(names):
+        raise ValueError(f"The endpoints of {path} should have different names")
+    return endpoints
+
+
+def configure_endpoints(path=None, tpm=None, rpm=None):
+    """
+    Sets where the endpoint pool is loaded from (see load_endpoints). The pool
+    is loaded by the first LLM request, so runs without one don't need an
+    endpoint.
+    """
+    global _endpoint_pool, _endpoint_options
+    _endpoint_pool = None
+    _endpoint_options = {"path": path, "tpm": tpm, "rpm": rpm}
+
+
+def set_endpoint_pool(pool):
+    """
+    Sets the EndpointPool create_stream sends the requests to, e.g. a pool of
+    fake endpoints. None loads it again from the configuration.
+    """
+    global _endpoint_pool
+    _endpoint_pool = pool
+
+
+def get_endpoint_pool():
+    """
+    Returns the EndpointPool create_stream sends the requests to.
+    """
+    global _endpoint_pool
+    if _endpoint_pool is None:
+        _endpoint_pool = EndpointPool(load_endpoints(**_endpoint_options))
+        names = ", ".join(endpoint.name for endpoint in _endpoint_pool.endpoints)
+        logger.info(f"LLM endpoints: {names}")
+    return _endpoint_pool
@@ -0,0 +1,202 @@
+import re
+import sys
+import asyncio
+import logging
+
+from llm import create_stream, fetch_response_with_streaiming, make_chatml
+from prompt_templates import get_paper_questions, make_messages
+from token_counter import count_paper_prompt_tokens, count_tokens_batch
+
+logger = logging.getLogger(__name__)
+
+
+def get_question_numbers():
+    """
+    Returns the numbers of the questions in paper_query.tpl, e.g. [1, ..., 19].
+    """
+    return [int(re.match(r"Q(\d+):", q).group(1)) for q in get_paper_questions()]
+
+
+def split_questions(num_groups):
+    """
+    Splits the questions of paper_query.tpl into num_groups groups of
+    consecutive questions of about the same size.
+    """
+    numbers = get_question_numbers()
+    num_groups = max(1, min(num_groups, len(numbers)))
+    size, extra = divmod(len(numbers), num_groups)
+    groups, start = [], 0
+    for i in range(num_groups):
+        end = start + size + (1 if i < extra else 0)
+        groups.append(numbers[start:end])
+        start = end
+    return groups
+
+
+def parse_question_groups(spec):
+    """
+    Parses question groups like "1-6,7-12,13-19": groups are separated by
+    commas, and are a range or a single question number, or several of them
+    joined with "+", e.g. "1-4+19".
+
+    Raises:
+    ValueError: If the spec is invalid, names an unknown question or puts a
+    question in two groups
+    """
+    known = set(get_question_numbers())
+    seen = set()
+    groups = []
+    for group_spec in spec.split(","):
+        group = []
+        for part in group_spec.split("+"):
+            m = re.fullmatch(r"\s*(\d+)\s*(?:-\s*(\d+)\s*)?", part)
+            if m is None:
+                raise ValueError(f"Invalid question group: {group_spec!r}")
+            first = int(m.group(1))
+            last = int(m.group(2) or first)
+            for number in range(first, last + 1):
+                if number not in known:
+                    raise ValueError(f"Unknown question: Q{number}")
+                if number in seen:
+                    raise ValueError(f"Q{number} is in more than one group")
+                seen.add(number)
+                group.append(number)
+        if not group:
+            raise ValueError(f"Empty question group: {group_spec!r}")
+        groups.append(group)
+    return groups
+
+
+def get_question_groups(fanout=0, spec=None):
+    """
+    Returns the question groups of the --fanout and --question-groups
+    options, or None to ask all questions in a single call.
+    """
+    if spec:
+        return parse_question_groups(spec)
+    if fanout > 1:
+        return split_questions(fanout)
+    return None
+
+
+def merge_answers(answers):
+    """
+    Merges the answers of the question groups in the order of the questions.
+
+    The answers are split at their "## Qn: ..." headings and the parts are
+    sorted by question number. Text before the first heading of an answer
+    stays in front of that answer's first question.
+    """
+    parts = []
+    for answer in answers:
+        blocks = re.split(r"(?m)^(?=#+\s*Q\d+\b)", answer.strip())
+        numbers = [
+            int(re.match(r"#+\s*Q(\d+)", block).group(1))
+            for block in blocks
+            if re.match(r"#+\s*Q\d+", block)
+        ]
+        first = min(numbers) if numbers else float("inf")
+        for block in blocks:
+            if not block.strip():
+                continue
+            m = re.match(r"#+\s*Q(\d+)", block)
+            parts.append((int(m.group(1)) if m else first, block.strip()))
+    # sorted is stable: parts with the same number keep their order
+    return "\n\n".join(block for _, block in sorted(parts, key=lambda p: p[0]))
+
+
+class _OrderedOutput:
+    """
+    Passes on the content of concurrent streams in the order of the streams:
+    the first stream is passed on live, the content of the others is held
+    back until the streams before them are finished.
+    """
+
+    def __init__(self, num_streams, write):
+        self.write = write
+        self.buffers = [[] for _ in range(num_streams)]
+        self.finished = [False] * num_streams
+        self.current = 0
+
+    def on_content(self, index, content):
+        if index == self.current:
+            self.write(content)
+        else:
+            self.buffers[index].append(content)
+
+    def finish(self, index):
+        self.finished[index] = True
+        while self.current < len(self.finished) and self.finished[self.current]:
+            self.current += 1
+            if self.current < len(self.finished):
+                self.write("\n\n")
+                for content in self.buffers[self.current]:
+                    self.write(content)
+                self.buffers[self.current] = []
+
+
+async def summarize_fanout(
+    paper_content, enc, groups, echo=True, on_content=None, paper_tokens=None
+):
+    """
+    Answers the questions of paper_query.tpl with one concurrent call per
+    question group, over the same paper, and merges the answers in question
+    order. The answers are generated in parallel, so the latency is the one of
+    the longest group instead of the whole answer, for more prompt tokens (the
+    paper is sent once per group).
+
+    Parameters:
+    paper_content (str): The reduced text of the paper, or the notes on it
+    enc (tiktoken.Encoding): The encoder used to count tokens
+    groups (list of list of int): The question numbers of each group
+    echo (bool): Whether to print the answers while they are generated
+    on_content (callable): If set, called with each piece of the answers while
+    they are generated
+    paper_tokens (int): If set, the number of tokens of paper_content, so that
+    the group prompts are sized without encoding the paper once per group
+
+    Returns:
+    content (str): The answers to the questions
+    num_prompt_tokens (int): The number of prompt tokens of all calls
+    num_generated_tokens (int): The number of generated tokens of all calls
+    """
+    group_messages = [make_messages(paper_content, questions=g) for g in groups]
+    if paper_tokens is not None:
+        group_tokens = [count_paper_prompt_tokens(paper_tokens, g, enc) for g in groups]
+    else:
+        group_tokens = count_tokens_batch(
+            [make_chatml(messages) for messages in group_messages], enc
+        )
+    logger.info(f"Answering {len(groups)} question groups concurrently")
+
+    def write(content):
+        if echo:
+            print(content, end="")
+            sys.stdout.flush()
+        if on_content is not None:
+            on_content(content)
+
+    # the answers are streamed in the order of the groups
+    output = _OrderedOutput(len(groups), write)
+
+    async def answer(index, messages, prompt_tokens):
+        try:
+            return await fetch_response_with_streaiming(
+                create_stream(messages=messages, prompt_tokens=prompt_tokens),
+                echo=False,
+                on_content=lambda content: output.on_content(index, content),
+            )
+        finally:
+            output.finish(index)
+
+    answers = await asyncio.gather(
+        *(
+            answer(i, messages, n)
+            for i, (messages, n) in enumerate(zip(group_messages, group_tokens))
+        )
+    )
+    if echo:
+        print("")
+
+    num_generated_tokens = sum(count_tokens_batch(answers, enc))
+    return merge_answers(answers), sum(group_tokens), num_generated_tokens
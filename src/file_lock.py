@@ -0,0 +1,173 @@
+import os
+import uuid
+import asyncio
+import hashlib
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # not on Windows, where the locks do nothing
+    fcntl = None
+
+# How often a lock held by another process is tried again by async waiters
+LOCK_POLL_INTERVAL = 0.05
+
+
+def atomic_write(path, data):
+    """
+    Writes a file through a temporary file in the same directory, which
+    replaces the file once it is complete. Readers see the old or the new
+    file, and a crash leaves no truncated file behind.
+
+    Parameters:
+    path (Path): The file
+    data (bytes or str): The content, str is encoded as UTF-8
+
+    Returns:
+    path (Path): The file
+    """
+    path = Path(path)
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex[:8]}.tmp")
+    try:
+        with open(tmp_path, "xb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    return path
+
+
+class FileLock:
+    """
+    An exclusive lock shared by the processes (and the threads and tasks of a
+    process) that use the same file, with flock.
+
+    Use it as a context manager, `with` blocks the thread and `async with`
+    polls the lock without blocking the event loop:
+
+        async with get_lock(lock_dir, key):
+            ...
+
+    A blocking acquire raises RuntimeError on the thread of a running event
+    loop, where the task holding the lock could never release it.
+
+    The holder removes the file when it releases the lock, so lock files
+    don't pile up. A waiter that gets the lock of a removed file opens the
+    new one and waits again.
+
+    Parameters:
+    path (Path): The lock file, created if needed
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._file = None
+
+    def acquire(self, blocking=True):
+        """
+        Takes the lock, returns False if blocking is False and another holder
+        has it.
+        """
+        if self._file is not None:
+            raise RuntimeError(f"{self.path} is already locked")
+        if blocking and _in_event_loop():
+            raise RuntimeError(f"Use `async with` to wait for {self.path}")
+        if fcntl is None:
+            self._file = True
+            return True
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        while True:
+            f = open(self.path, "a")
+            try:
+                fcntl.flock(f.fileno(), flags)
+                # the previous holder may have removed the file meanwhile
+                if os.path.samestat(os.fstat(f.fileno()), os.stat(self.path)):
+                    break
+            except BlockingIOError:
+                f.close()
+                return False
+            except FileNotFoundError:
+                pass
+            except BaseException:
+                f.close()
+                raise
+            f.close()
+        self._file = f
+        return True
+
+    async def acquire_async(self):
+        """
+        Takes the lock, polling it every LOCK_POLL_INTERVAL seconds while
+        another holder has it.
+        """
+        while not self.acquire(blocking=False):
+            await asyncio.sleep(LOCK_POLL_INTERVAL)
+        return True
+
+    def release(self):
+        if self._file is None:
+            return
+        if fcntl is not None:
+            # removed while it is held, see acquire. Closing the file
+            # releases the lock.
+            self.path.unlink(missing_ok=True)
+            self._file.close()
+        self._file = None
+
+    @property
+    def locked(self):
+        return self._file is not None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    async def __aenter__(self):
+        await self.acquire_async()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+
+def _in_event_loop():
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+def get_lock(lock_dir, name):
+    """
+    Returns the FileLock of a name, e.g. the key of a cached artifact, in
+    lock_dir. Every name has its own lock file, which only exists while the
+    lock is held.
+    """
+    digest = hashlib.sha256(name.encode("utf-8")).hexdigest()
+    return FileLock(Path(lock_dir) / f"{digest}.lock")
+
+
+def remove_stale_locks(lock_dir):
+    """
+    Removes the lock files that are not held, e.g. left by a process that
+    crashed, and the files of older versions. Returns the number removed.
+    """
+    if fcntl is None:
+        return 0
+    removed = 0
+    for path in Path(lock_dir).glob("*.lock"):
+        lock = FileLock(path)
+        if lock.acquire(blocking=False):
+            lock.release()
+            removed += 1
+    return removed
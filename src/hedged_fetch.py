@@ -0,0 +1,251 @@
+import json
+import time
+import asyncio
+import logging
+import statistics
+import contextvars
+
+import click
+
+from arxiv_loader import fetch_paper_html_async, has_paper_content, remove_cached_html
+from arxiv_loader import PaperFailedToRender, PaperRenderInProgress, PaperNotFound
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+# The sources a paper can be fetched from, see read_paper.get_paper_url
+PAPER_SOURCES = ("arxiv-vanity", "ar5iv")
+
+# How long the preferred source gets before the next one is also asked
+DEFAULT_HEDGE_DELAY = 5.0
+
+
+def describe_error(e):
+    """
+    Returns the short description of why a paper failed, as logged, reported
+    by the server and recorded in the fetch stats.
+    """
+    if isinstance(e, PaperNotFound):
+        return "not found"
+    if isinstance(e, PaperRenderInProgress):
+        return "render in progress"
+    if isinstance(e, PaperFailedToRender):
+        return "failed to render"
+    return str(e) or type(e).__name__
+
+
+def _check_paper_content(paper_url, html_path):
+    """
+    Raises PaperFailedToRender if the HTML file has no content to extract (see
+    has_paper_content), and removes the file from the cache so that it is
+    fetched again next time. The file is only parsed once, when the content is
+    extracted.
+    """
+    with span("check_render"):
+        usable = has_paper_content(html_path)
+    if not usable:
+        remove_cached_html(paper_url)
+        raise PaperFailedToRender
+
+
+async def fetch_paper_hedged(
+    paper_urls,
+    client,
+    hedge_delay=DEFAULT_HEDGE_DELAY,
+    force_refresh=False,
+    render_timeout=0,
+    stats_path=None,
+    arxiv_id=None,
+):
+    """
+    Fetches a paper from the first source that gives a usable render.
+
+    The preferred source is fetched first. If it fails, or has not given a
+    usable render after hedge_delay seconds, the next source is fetched too,
+    and so on. The first render that parse_paper_content can extract the
+    content from wins and the other requests are cancelled. With a single
+    source this is fetch_paper_html_async.
+
+    Parameters:
+    paper_urls (list of (str, str)): (source, url) pairs, the preferred first
+    client (HttpClient): The client used for the requests
+    hedge_delay (float): Seconds before the next source is asked, 0 to ask all
+    sources at once
+    force_refresh (bool): Whether to ignore the cached files
+    render_timeout (float): How long each source may be polled while rendering
+    stats_path (Path): If set, the winner and the latency and outcome of each
+    source are appended to this JSONL file
+    arxiv_id (str): The paper, for the stats and the cache index
+
+    Returns:
+    source (str): The source that won
+    html_path (Path): The path of the cached HTML file
+
+    Raises:
+    The error of the preferred source if no source gave a usable render
+    """
+    if len(paper_urls) == 1:
+        source, url = paper_urls[0]
+        html_path = await fetch_paper_html_async(
+            url,
+            client,
+            force_refresh=force_refresh,
+            render_timeout=render_timeout,
+            arxiv_id=arxiv_id,
+            source=source,
+        )
+        return source, html_path
+
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    outcomes = {}
+
+    async def attempt(source, url):
+        started = loop.time()
+        outcome = "cancelled"
+        try:
+            html_path = await fetch_paper_html_async(
+                url,
+                client,
+                force_refresh=force_refresh,
+                render_timeout=render_timeout,
+                arxiv_id=arxiv_id,
+                source=source,
+            )
+            # the check runs in the context of the attempt, so that its span
+            # is part of the paper's trace
+            context = contextvars.copy_context()
+            await loop.run_in_executor(
+                None, context.run, _check_paper_content, url, html_path
+            )
+            outcome = "ok"
+            return source, html_path
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            outcome = describe_error(e)
+            raise
+        finally:
+            outcomes[source] = {
+                "started": round(started - start, 3),
+                "latency": round(loop.time() - started, 3),
+                "outcome": outcome,
+            }
+
+    tasks = []
+
+    def start_next():
+        source, url = paper_urls[len(tasks)]
+        if tasks:
+            logger.info(f"Also fetching {arxiv_id or url} from {source}")
+        tasks.append(asyncio.ensure_future(attempt(source, url)))
+
+    start_next()
+    if hedge_delay <= 0:
+        while len(tasks) < len(paper_urls):
+            start_next()
+
+    winner = None
+    try:
+        while True:
+            pending = [t for t in tasks if not t.done()]
+            can_hedge = len(tasks) < len(paper_urls)
+            if not pending:
+                if not can_hedge:
+                    break
+                start_next()
+                continue
+
+            done, _ = await asyncio.wait(
+                pending,
+                timeout=hedge_delay if can_hedge else None,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            for t in done:
+                if t.exception() is None:
+                    winner = t.result()
+                    return winner
+            # the next source is asked when the running ones are too slow, or
+            # as soon as one of them failed
+            if can_hedge:
+                start_next()
+    finally:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if stats_path is not None:
+            _record_stats(stats_path, arxiv_id, winner, hedge_delay, outcomes)
+        if winner is not None:
+            logger.info(f"Using {winner[0]} for {arxiv_id or winner[1]}")
+
+    raise tasks[0].exception()
+
+
+def _record_stats(stats_path, arxiv_id, winner, hedge_delay, outcomes):
+    record = {
+        "time": time.time(),
+        "arxiv_id": arxiv_id,
+        "winner": winner[0] if winner else None,
+        "hedge_delay": hedge_delay,
+        "sources": outcomes,
+    }
+    with open(stats_path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def _percentile(values, q):
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+def summarize_fetch_stats(stats_path):
+    """
+    Returns, for each source, the number of fetches and wins and the latency
+    percentiles of the successful fetches, read from the stats file.
+    """
+    summary = {}
+    with open(stats_path, encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            for source, outcome in record["sources"].items():
+                s = summary.setdefault(
+                    source, {"fetches": 0, "wins": 0, "failures": 0, "latencies": []}
+                )
+                s["fetches"] += 1
+                if record["winner"] == source:
+                    s["wins"] += 1
+                if outcome["outcome"] == "ok":
+                    s["latencies"].append(outcome["latency"])
+                elif outcome["outcome"] != "cancelled":
+                    s["failures"] += 1
+
+    for s in summary.values():
+        latencies = sorted(s.pop("latencies"))
+        for q in (50, 90, 99):
+            s[f"p{q}"] = _percentile(latencies, q) if latencies else None
+    return summary
+
+
+@click.command()
+@click.argument("stats_file", type=click.Path(exists=True))
+def main(stats_file):
+    """
+    Prints the win rate and latency of each source in STATS_FILE.
+
+    The p90 latency of the preferred source is a good --hedge-delay: only the
+    slowest 10% of the papers are then fetched twice.
+    """
+    for source, s in summarize_fetch_stats(stats_file).items():
+        latencies = "  ".join(
+            f"p{q} {s[f'p{q}']:.2f}s" if s[f"p{q}"] is not None else f"p{q} -"
+            for q in (50, 90, 99)
+        )
+        print(
+            f"{source:<14} {s['fetches']:>5} fetches {s['wins']:>5} wins "
+            f"{s['failures']:>5} failures  {latencies}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+import random
+import asyncio
+import logging
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+# Statuses that are worth retrying: rate limits and overloaded gateways
+RETRY_STATUSES = (429, 502, 503, 504)
+
+# The arXiv API asks clients not to send concurrent requests
+DEFAULT_HOST_LIMITS = {"export.arxiv.org": 1}
+
+
+class HttpResponse:
+    """
+    A response whose body has already been read, so that the connection is
+    back in the pool as soon as the request returns.
+    """
+
+    def __init__(self, url, status, headers, text):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.text = text
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            import aiohttp
+
+            raise aiohttp.ClientResponseError(
+                None, (), status=self.status, message=self.text[:200], headers=self.headers
+            )
+
+
+class HttpClient:
+    """
+    An asyncio HTTP client with one pooled session shared by all hosts.
+
+    Every host has its own concurrency limit, and requests that fail with a
+    connection error or one of `retry_statuses` are retried with exponential
+    backoff (honouring Retry-After).
+
+    Use it as an async context manager:
+
+        async with HttpClient() as client:
+            response = await client.get(url)
+
+    Parameters:
+    limit (int): The maximum number of open connections
+    limit_per_host (int): The default maximum number of concurrent requests per host
+    host_limits (dict): host -> maximum number of concurrent requests, for
+    hosts that need a different limit
+    max_retries (int): The number of retries after the first attempt
+    backoff (float): The delay before the first retry in seconds, doubled on
+    every retry
+    max_backoff (float): The maximum delay between retries in seconds
+    timeout (float): The total timeout of a single attempt in seconds
+    """
+
+    def __init__(
+        self,
+        limit=32,
+        limit_per_host=4,
+        host_limits=None,
+        max_retries=4,
+        backoff=1.0,
+        max_backoff=30.0,
+        timeout=60.0,
+    ):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.host_limits = dict(DEFAULT_HOST_LIMITS)
+        self.host_limits.update(host_limits or {})
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self._session = None
+        self._host_sems = {}
+
+    async def __aenter__(self):
+        # aiohttp is imported when a client is opened, not by the runs that
+        # find everything in the cache
+        import aiohttp
+
+        connector = aiohttp.TCPConnector(
+            limit=self.limit, limit_per_host=self.limit_per_host
+        )
+        self._session = aiohttp.ClientSession(
+            connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout)
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _host_sem(self, url):
+        host = urlsplit(url).hostname or ""
+        if host not in self._host_sems:
+            limit = self.host_limits.get(host, self.limit_per_host)
+            self._host_sems[host] = asyncio.Semaphore(limit)
+        return self._host_sems[host]
+
+    def _retry_delay(self, attempt, retry_after=None):
+        if retry_after is not None:
+            try:
+                return min(float(retry_after), self.max_backoff)
+            except ValueError:
+                pass
+        delay = min(self.backoff * 2**attempt, self.max_backoff)
+        # jitter, so that papers that failed together don't retry together
+        return delay * random.uniform(0.5, 1.0)
+
+    async def request(self, method, url, retry_statuses=RETRY_STATUSES, **kwargs):
+        """
+        Sends a request, retrying on connection errors and retry_statuses.
+
+        Returns:
+        response (HttpResponse): The last response, whatever its status
+
+        Raises:
+        aiohttp.ClientError: If the last attempt failed to connect
+        asyncio.TimeoutError: If the last attempt timed out
+        """
+        if self._session is None:
+            raise RuntimeError("HttpClient is not open, use `async with HttpClient()`")
+        import aiohttp
+
+        attempt = 0
+        while True:
+            try:
+                async with self._host_sem(url):
+                    async with self._session.request(method, url, **kwargs) as r:
+                        response = HttpResponse(
+                            str(r.url), r.status, r.headers, await r.text()
+                        )
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._retry_delay(attempt)
+                logger.warning(
+                    f"{method} {url} failed ({type(e).__name__}: {e}), "
+                    f"retrying in {delay:.1f}s"
+                )
+            else:
+                if response.status not in retry_statuses or attempt >= self.max_retries:
+                    return response
+                delay = self._retry_delay(attempt, response.headers.get("Retry-After"))
+                logger.warning(
+                    f"{method} {url} returned {response.status}, retrying in {delay:.1f}s"
+                )
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def get(self, url, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request("POST", url, **kwargs)
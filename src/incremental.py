@@ -0,0 +1,177 @@
+import json
+import difflib
+import logging
+
+from llm import make_chatml
+from prompt_templates import make_update_messages
+from token_counter import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# Papers whose sections changed by fewer words than this keep their summary,
+# e.g. a fixed typo or a changed affiliation
+MIN_CHANGED_WORDS = 5
+
+
+def load_snapshot(cache, key):
+    """
+    Returns the snapshot of the last summarized version of a paper, or None.
+
+    A snapshot is a dict with the `updated` date of the version, its reduced
+    sections, the answers of the LLM and their token counts.
+    """
+    data = cache.get_text(key, "snapshot")
+    if data is None:
+        return None
+    try:
+        return json.loads(data)
+    except ValueError:
+        return None
+
+
+def save_snapshot(
+    cache,
+    key,
+    sections,
+    content,
+    num_prompt_tokens,
+    num_generated_tokens,
+    updated=None,
+    arxiv_id=None,
+):
+    """
+    Saves the snapshot of a summarized version of a paper in a PaperCache.
+    key is the text cache key of the preferred source, so that the snapshot
+    is kept per parse options.
+    """
+    snapshot = {
+        "updated": updated,
+        "sections": sections,
+        "content": content,
+        "num_prompt_tokens": num_prompt_tokens,
+        "num_generated_tokens": num_generated_tokens,
+    }
+    return cache.put(
+        key,
+        "snapshot",
+        json.dumps(snapshot, ensure_ascii=False),
+        arxiv_id=arxiv_id,
+        options=key.split(".", 1)[1],
+    )
+
+
+def is_paper_updated(snapshot, metadata):
+    """
+    Returns True if the arXiv metadata has another `updated` date than the
+    snapshot, or if it is missing.
+    """
+    return metadata is None or metadata["updated"] != snapshot["updated"]
+
+
+def _section_title(section):
+    return " ".join(section.strip().split("\n", 1)[0].split())
+
+
+def _count_changed_words(old, new):
+    matcher = difflib.SequenceMatcher(None, old.split(), new.split(), autojunk=False)
+    return sum(
+        max(i2 - i1, j2 - j1)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes()
+        if tag != "equal"
+    )
+
+
+def diff_sections(old_sections, new_sections):
+    """
+    Compares the sections of two versions of a paper. Sections are matched by
+    their title (their first line), whitespace changes are ignored.
+
+    Returns:
+    changes (list of dict): The added, changed and removed sections, with
+    their status, title, new text and number of changed words
+    """
+    old_titles = [_section_title(s) for s in old_sections]
+    new_titles = [_section_title(s) for s in new_sections]
+    matcher = difflib.SequenceMatcher(None, old_titles, new_titles, autojunk=False)
+
+    changes = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            for old, new in zip(old_sections[i1:i2], new_sections[j1:j2]):
+                changed_words = _count_changed_words(old, new)
+                if changed_words:
+                    changes.append(
+                        {
+                            "status": "changed",
+                            "title": _section_title(new),
+                            "text": new,
+                            "changed_words": changed_words,
+                        }
+                    )
+            continue
+        for old in old_sections[i1:i2]:
+            changes.append(
+                {
+                    "status": "removed",
+                    "title": _section_title(old),
+                    "text": "",
+                    "changed_words": len(old.split()),
+                }
+            )
+        for new in new_sections[j1:j2]:
+            changes.append(
+                {
+                    "status": "added",
+                    "title": _section_title(new),
+                    "text": new,
+                    "changed_words": len(new.split()),
+                }
+            )
+    return changes
+
+
+def format_changes(changes):
+    """
+    Formats the changed sections for paper_update.tpl: the full new text of
+    added and changed sections, and the titles of the removed ones.
+    """
+    blocks = []
+    for change in changes:
+        if change["status"] == "removed":
+            blocks.append(f"### Removed section: {change['title']}")
+        else:
+            label = "New" if change["status"] == "added" else "Changed"
+            blocks.append(f"### {label} section: {change['title']}\n{change['text']}")
+    return "\n\n".join(blocks)
+
+
+def plan_update(
+    snapshot, sections, enc, max_prompt_tokens, min_changed_words=MIN_CHANGED_WORDS
+):
+    """
+    Decides how to summarize the new version of a paper that was summarized
+    before.
+
+    Returns:
+    action (str): "reuse" if nothing material changed and the previous
+    answers are kept, "update" if the changed sections are sent with the
+    previous answers, or "full" if the update prompt would be too long
+    messages (list): The messages of the update pass, None otherwise
+    num_prompt_tokens (int): The length of the update prompt, 0 otherwise
+    """
+    changes = diff_sections(snapshot["sections"], sections)
+    changed_words = sum(change["changed_words"] for change in changes)
+    if changed_words < min_changed_words:
+        logger.info(f"{changed_words} words changed since the last summary, keeping it")
+        return "reuse", None, 0
+
+    messages = make_update_messages(snapshot["content"], format_changes(changes))
+    num_prompt_tokens = count_tokens(make_chatml(messages), enc)
+    logger.info(
+        f"{len(changes)} sections changed ({changed_words} words) since the last "
+        f"summary, update prompt: {num_prompt_tokens} tokens"
+    )
+    if num_prompt_tokens > max_prompt_tokens:
+        logger.info("The update prompt is too long, summarizing the whole paper")
+        return "full", None, 0
+    return "update", messages, num_prompt_tokens
@@ -1,31 +1,357 @@
+import sys
+import time
 import asyncio
-import openai
-import os
+import logging
 
 import dotenv
 
+from llm_cache import make_cache_key
+from tracing import span
+
 dotenv.load_dotenv()
 
-openai.api_key = os.environ["OPENAI_API_KEY"]
-openai.api_base = os.environ["OPENAI_API_BASE"]
-openai.api_type = os.environ["OPENAI_API_TYPE"]
-openai.api_version = os.environ["OPENAI_API_VERSION"]
+logger = logging.getLogger(__name__)
+
+# The ResponseCache used by create_stream, see set_response_cache
+_response_cache = None
+
+DEFAULT_MODEL = "gpt-4-32k"
+
+# Dollars per 1K (prompt, completion) tokens, used to estimate the cost
+MODEL_PRICES = {
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-32k": (0.06, 0.12),
+}
+
+
+def set_response_cache(cache):
+    """
+    Sets the llm_cache.ResponseCache that create_stream looks up before calling
+    the API. None disables the cache.
+    """
+    global _response_cache
+    _response_cache = cache
+
+
+# The priorities of the requests, lower first: the answer of a paper goes
+# before the notes on the chunks of other papers, so that papers finish sooner
+PRIORITY_ANSWER = 0
+PRIORITY_NOTES = 1
+
+
+def get_openai():
+    """
+    Returns the openai module. openai is slow to import, so it is imported by
+    the first request to the API and not by dry runs, cached responses or token
+    counts. The deployment settings are passed with each request, see
+    endpoints.Endpoint.
+    """
+    import openai
+
+    return openai
+
+
+def is_retry_error(e):
+    """
+    Returns True for the errors after which a request is sent again, to the
+    same or another endpoint: 429, 5xx, timeouts and connection errors.
+    """
+    # an error of openai means it is imported
+    openai = sys.modules.get("openai")
+    if openai is None or not isinstance(e, openai.error.OpenAIError):
+        return False
+    if isinstance(
+        e,
+        (
+            openai.error.RateLimitError,
+            openai.error.ServiceUnavailableError,
+            openai.error.Timeout,
+            openai.error.APIConnectionError,
+        ),
+    ):
+        return True
+    status = e.http_status or 0
+    return status == 429 or status >= 500
+
+
+class _Waiter:
+    def __init__(self, cost, priority, seq):
+        self.cost = cost
+        self.priority = priority
+        self.seq = seq
+        self.enqueued = time.monotonic()
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class LLMScheduler:
+    """
+    Admits LLM requests against the tokens-per-minute and requests-per-minute
+    limits of a deployment.
+
+    Both limits are token buckets that hold a minute of budget and refill
+    continuously. A request costs its prompt tokens plus
+    expected_completion_tokens (the completion is not known in advance). The
+    waiting requests are admitted by priority, then shortest prompt first, so
+    short prompts don't queue behind long ones; a request that waited more than
+    max_wait seconds goes first, so long prompts are not starved.
+
+    When the deployment refuses a request anyway, pause holds all requests
+    for a while (see endpoints.EndpointPool, which retries them).
+
+    Parameters:
+    tpm (int): Tokens per minute, None for no limit
+    rpm (int): Requests per minute, None for no limit
+    expected_completion_tokens (int): The tokens reserved for each completion
+    max_wait (float): The wait after which a request skips the ordering
+    """
 
+    def __init__(
+        self, tpm=None, rpm=None, expected_completion_tokens=1000, max_wait=120.0
+    ):
+        self.tpm = tpm
+        self.rpm = rpm
+        self.expected_completion_tokens = expected_completion_tokens
+        self.max_wait = max_wait
+        self._tokens = float(tpm or 0)
+        self._requests = float(rpm or 0)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._waiters = []
+        self._seq = 0
+        self._timer = None
 
-async def create_stream(*, prompt=None, messages=None):
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        if self.tpm:
+            self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+        if self.rpm:
+            self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+
+    def _wait_time(self, cost):
+        wait = self._paused_until - time.monotonic()
+        if self.tpm and self._tokens < cost:
+            wait = max(wait, (cost - self._tokens) * 60 / self.tpm)
+        if self.rpm and self._requests < 1:
+            wait = max(wait, (1 - self._requests) * 60 / self.rpm)
+        return wait
+
+    def _next_waiter(self):
+        oldest = min(self._waiters, key=lambda w: w.seq)
+        if time.monotonic() - oldest.enqueued > self.max_wait:
+            return oldest
+        return min(self._waiters, key=lambda w: (w.priority, w.cost, w.seq))
+
+    def _schedule(self):
+        """
+        Admits the next requests while the budget allows, then sets a timer
+        for when the next one can go.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._refill()
+        while self._waiters:
+            waiter = self._next_waiter()
+            wait = self._wait_time(waiter.cost)
+            if wait > 0:
+                loop = asyncio.get_running_loop()
+                self._timer = loop.call_later(wait, self._schedule)
+                return
+            self._waiters.remove(waiter)
+            if self.tpm:
+                self._tokens -= waiter.cost
+            if self.rpm:
+                self._requests -= 1
+            waiter.future.set_result(None)
+
+    def _cost(self, prompt_tokens):
+        cost = prompt_tokens + self.expected_completion_tokens
+        if self.tpm:
+            # a request larger than the bucket waits for a full bucket
+            cost = min(cost, self.tpm)
+        return cost
+
+    def estimate_wait(self, prompt_tokens):
+        """
+        Returns about how many seconds a request with prompt_tokens tokens
+        would wait before it is sent, behind the requests already waiting.
+        """
+        self._refill()
+        wait = self._paused_until - time.monotonic()
+        if self.tpm:
+            queued = sum(w.cost for w in self._waiters) + self._cost(prompt_tokens)
+            wait = max(wait, (queued - self._tokens) * 60 / self.tpm)
+        if self.rpm:
+            queued = len(self._waiters) + 1
+            wait = max(wait, (queued - self._requests) * 60 / self.rpm)
+        return max(wait, 0.0)
+
+    async def acquire(self, prompt_tokens, priority=PRIORITY_ANSWER):
+        """
+        Waits until a request with prompt_tokens tokens can be sent.
+        """
+        cost = self._cost(prompt_tokens)
+        self._seq += 1
+        waiter = _Waiter(cost, priority, self._seq)
+        self._waiters.append(waiter)
+        self._schedule()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+                self._schedule()
+            raise
+
+    def pause(self, delay):
+        """
+        Holds all requests for delay seconds, after the API refused one.
+        """
+        self._paused_until = max(self._paused_until, time.monotonic() + delay)
+
+
+async def create_stream(
+    *,
+    prompt=None,
+    messages=None,
+    model=DEFAULT_MODEL,
+    temperature=0,
+    use_cache=True,
+    prompt_tokens=None,
+    priority=PRIORITY_ANSWER,
+):
+    """
+    Returns the stream of a chat completion, replayed from the response cache
+    if it has one, otherwise requested from one of the deployments of the
+    endpoint pool (see endpoints.py).
+
+    prompt_tokens, the length of the prompt as counted with tiktoken, and
+    priority order the request in the queue of the deployment. The length is
+    estimated from the number of characters if it is not given. The request
+    goes to an endpoint that serves model, so the responses are cached by
+    model whichever deployment answered.
+
+    With the cache, a prompt is requested by one process (or task) at a time:
+    the others wait until its response is stored and replay it, so workers
+    reading the same paper make one call.
+    """
     if messages is None:
         messages = [{"role": "user", "content": prompt}]
 
-    stream = await openai.ChatCompletion.acreate(
-        model="gpt-4-32k",
-        engine="gpt-4-32k",
-        messages=messages,
-        temperature=0,
-        stream=True,
-    )
+    cache = _response_cache if use_cache else None
+    lock = None
+    if cache is not None:
+        params = {"model": model, "temperature": temperature}
+        key = make_cache_key(messages, **params)
+        content = cache.get(key)
+        if content is None and not cache.bypass:
+            lock = cache.lock(key)
+            if not lock.acquire(blocking=False):
+                logger.info(f"Waiting for the response {key[:12]} of another worker")
+                with span("llm_wait"):
+                    await lock.acquire_async()
+            content = cache.get(key)
+            if content is not None:
+                lock.release()
+        if content is not None:
+            logger.info(f"Using cached response {key[:12]}")
+            return cache.replay(content)
+
+    if prompt_tokens is None:
+        # about 4 characters per token, close enough for scheduling
+        prompt_tokens = sum(len(m["content"]) for m in messages) // 4
+
+    # endpoints imports this module
+    from endpoints import get_endpoint_pool
+
+    try:
+        stream = await get_endpoint_pool().run(
+            lambda endpoint: endpoint.create(
+                model=model, messages=messages, temperature=temperature
+            ),
+            prompt_tokens,
+            priority,
+            model=model,
+        )
+    except BaseException:
+        if lock is not None:
+            lock.release()
+        raise
+    if cache is not None:
+        return cache.record(stream, key, params, lock=lock)
     return stream
 
 
+def estimate_cost(model, prompt_tokens, completion_tokens):
+    """
+    Returns the cost in dollars of a call, or 0.0 for an unknown model.
+    """
+    prompt_price, completion_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+
+def get_usage(model, prompt_tokens, completion_tokens):
+    """
+    Returns the token counts and estimated cost of a call, as recorded on the
+    "llm" span.
+    """
+    return {
+        "model": model,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "cost": round(estimate_cost(model, prompt_tokens, completion_tokens), 6),
+    }
+
+
+async def fetch_response_with_streaiming(stream, echo=True, on_content=None):
+    # on_content, if set, is called with each piece of the content as it
+    # arrives, e.g. to stream it to a client of the server
+    #
+    # the stream is traced from the request, so the time to the first token
+    # includes the time the API took to answer
+    with span("llm_stream") as s:
+        start = time.perf_counter()
+        first_token = None
+        chunks = 0
+        stream = await stream
+        content = ""
+        try:
+            async for c in stream:
+                if not c["choices"][0]["finish_reason"]:
+                    if "role" in c["choices"][0]["delta"]:
+                        pass
+                    if "content" in c["choices"][0]["delta"]:
+                        if first_token is None:
+                            first_token = time.perf_counter()
+                        chunks += 1
+                        if echo:
+                            print(c["choices"][0]["delta"]["content"], end="")
+                            sys.stdout.flush()
+                        if on_content is not None:
+                            on_content(c["choices"][0]["delta"]["content"])
+                        content += c["choices"][0]["delta"]["content"]
+        except Exception as e:
+            logger.error(e)
+            s.set(error=type(e).__name__)
+        finally:
+            # every chunk of the stream carries one token
+            end = time.perf_counter()
+            s.set(chunks=chunks)
+            if first_token is not None:
+                s.set(ttft=round(first_token - start, 6))
+                if end > first_token:
+                    s.set(tokens_per_second=round(chunks / (end - first_token), 3))
+            if echo:
+                print("")
+            # a stream left early still holds its endpoint and cache lock
+            aclose = getattr(stream, "aclose", None)
+            if aclose is not None:
+                await aclose()
+            return content
+
+
 def make_chatml(messages, add_suffix=True, add_role=False):
     prompt = ""
     for msg in messages:
@@ -0,0 +1,218 @@
+import json
+import time
+import asyncio
+import hashlib
+import logging
+
+from file_lock import atomic_write, get_lock
+
+logger = logging.getLogger(__name__)
+
+# The puts between two scans of the cache directory, see ResponseCache.put
+EVICT_INTERVAL = 100
+
+
+def make_cache_key(messages, **params):
+    """
+    Returns the key of a completion: a hash of the messages and of every
+    parameter that changes the output (model, temperature, ...).
+    """
+    payload = json.dumps(
+        {"messages": messages, "params": params}, sort_keys=True, ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _make_chunk(content=None, finish_reason=None):
+    delta = {} if content is None else {"content": content}
+    return {"choices": [{"delta": delta, "finish_reason": finish_reason}]}
+
+
+async def replay_stream(content, chunk_size=None, delay=0.0):
+    """
+    Replays a stored completion in the same chunk format as
+    openai.ChatCompletion.acreate(stream=True).
+
+    Parameters:
+    content (str): The stored completion
+    chunk_size (int): If set, the number of characters per chunk, otherwise the
+    whole completion is sent in a single chunk
+    delay (float): Seconds to sleep between chunks
+    """
+    yield {"choices": [{"delta": {"role": "assistant"}, "finish_reason": None}]}
+    step = chunk_size or max(len(content), 1)
+    for i in range(0, len(content), step):
+        if delay:
+            await asyncio.sleep(delay)
+        yield _make_chunk(content[i : i + step])
+    yield _make_chunk(finish_reason="stop")
+
+
+class ResponseCache:
+    """
+    A persistent cache of LLM completions, one JSON file per completion.
+
+    Entries expire after `max_age` seconds, and the least recently used
+    entries are evicted when there are more than `max_entries` entries or they
+    take more than `max_bytes` bytes. The directory is scanned on the first
+    put, then when the entries added since the last scan may go over the
+    limits, and every EVICT_INTERVAL puts for the entries of other processes.
+
+    Entries are written atomically, so processes can share the cache, and
+    lock(key) lets one process call the API for a prompt while the others
+    wait for its response.
+    """
+
+    def __init__(
+        self,
+        cache_dir,
+        max_entries=10_000,
+        max_bytes=512 * 1024 * 1024,
+        max_age=90 * 24 * 3600,
+        bypass=False,
+        simulate_stream=True,
+        chunk_size=16,
+    ):
+        self.cache_dir = cache_dir
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        # skip lookups, but still store the new completions
+        self.bypass = bypass
+        # replay hits as a stream of small chunks instead of a single chunk
+        self.simulate_stream = simulate_stream
+        self.chunk_size = chunk_size
+        # the entries and bytes found by the last scan plus the puts since,
+        # None until the first scan
+        self._num_entries = None
+        self._num_bytes = 0
+        self._puts_since_evict = 0
+
+    def _path(self, key):
+        return self.cache_dir / f"{key}.json"
+
+    def lock(self, key):
+        """
+        Returns the FileLock of a completion, held while it is requested and
+        until it is stored, see record.
+        """
+        return get_lock(self.cache_dir / "locks", key)
+
+    def get(self, key):
+        """
+        Returns the stored completion for the key, or None.
+        """
+        if self.bypass:
+            return None
+        path = self._path(key)
+        try:
+            entry = json.loads(path.read_text(encoding="utf-8"))
+        except OSError:
+            return None
+        except ValueError:
+            # written by a version without atomic writes, or damaged
+            logger.warning(f"Removing damaged response {path}")
+            path.unlink(missing_ok=True)
+            return None
+        if time.time() - entry["created"] > self.max_age:
+            path.unlink(missing_ok=True)
+            return None
+        # mark as recently used
+        path.touch()
+        return entry["content"]
+
+    def put(self, key, content, params=None):
+        entry = {
+            "key": key,
+            "params": params or {},
+            "created": time.time(),
+            "content": content,
+        }
+        data = json.dumps(entry, ensure_ascii=False)
+        atomic_write(self._path(key), data)
+        if self._num_entries is None:
+            self.evict()
+            return
+        # an overwritten entry is counted twice, which only scans earlier
+        self._num_entries += 1
+        self._num_bytes += len(data.encode("utf-8"))
+        self._puts_since_evict += 1
+        if (
+            self._num_entries > self.max_entries
+            or self._num_bytes > self.max_bytes
+            or self._puts_since_evict >= EVICT_INTERVAL
+        ):
+            self.evict()
+
+    def replay(self, content):
+        if self.simulate_stream:
+            return replay_stream(content, chunk_size=self.chunk_size)
+        return replay_stream(content)
+
+    async def record(self, stream, key, params=None, lock=None):
+        """
+        Passes the chunks of a live stream through and stores the completion
+        once the stream finished normally. lock, if given, is released when
+        the stream ends, after the completion is stored.
+        """
+        try:
+            content = ""
+            finish_reason = None
+            async for c in stream:
+                choice = c["choices"][0]
+                if "content" in choice["delta"]:
+                    content += choice["delta"]["content"]
+                if choice["finish_reason"]:
+                    finish_reason = choice["finish_reason"]
+                yield c
+            if finish_reason == "stop":
+                self.put(key, content, params)
+            else:
+                logger.info(f"Not caching incomplete completion ({finish_reason})")
+        finally:
+            if lock is not None:
+                lock.release()
+
+    def evict(self):
+        """
+        Removes expired entries, then the least recently used ones until the
+        cache is within its size limits.
+        """
+        now = time.time()
+        # the temporary files of writes interrupted by a crash
+        for path in self.cache_dir.glob(".*.tmp"):
+            try:
+                if now - path.stat().st_mtime > 3600:
+                    path.unlink(missing_ok=True)
+            except OSError:
+                continue
+
+        entries = []
+        for path in self.cache_dir.glob("*.json"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        # entries that were not used for max_age are expired for sure
+        alive = []
+        for mtime, size, path in entries:
+            if now - mtime > self.max_age:
+                path.unlink(missing_ok=True)
+            else:
+                alive.append((mtime, size, path))
+
+        alive.sort()
+        num_entries = len(alive)
+        total_bytes = sum(size for _, size, _ in alive)
+        for _, size, path in alive:
+            if num_entries <= self.max_entries and total_bytes <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            num_entries -= 1
+            total_bytes -= size
+        self._num_entries = num_entries
+        self._num_bytes = total_bytes
+        self._puts_since_evict = 0
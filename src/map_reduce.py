@@ -0,0 +1,218 @@
+import math
+import asyncio
+import logging
+
+from llm import (
+    PRIORITY_NOTES,
+    create_stream,
+    fetch_response_with_streaiming,
+    make_chatml,
+)
+from prompt_templates import get_paper_questions, load_template, make_messages
+from fanout import summarize_fanout
+from token_counter import count_tokens, count_tokens_batch
+
+logger = logging.getLogger(__name__)
+
+# The default size of a chunk, smaller chunks are read faster and in parallel
+DEFAULT_CHUNK_TOKENS = 12_000
+
+
+def make_chunk_messages(chunk, part_index, num_parts):
+    tpl = load_template("paper_chunk_query.tpl")
+    query = tpl.format(
+        part_index=part_index,
+        num_parts=num_parts,
+        paper_content=chunk,
+        questions="\n".join(get_paper_questions()),
+    )
+    return [
+        {"role": "system", "content": load_template("paper_system.tpl")},
+        {"role": "user", "content": query},
+    ]
+
+
+def make_notes_content(notes):
+    """
+    Returns the notes on each chunk as the paper content of the final prompt.
+    """
+    tpl = load_template("paper_notes.tpl")
+    parts = [f"### Notes on part {i + 1}\n{note.strip()}" for i, note in enumerate(notes)]
+    return tpl.format(num_parts=len(notes), notes="\n\n".join(parts))
+
+
+def make_reduce_messages(notes):
+    """
+    Builds the final paper_query.tpl prompt from the notes on each chunk.
+    """
+    return make_messages(make_notes_content(notes))
+
+
+def _split_by_tokens(text, enc, max_tokens):
+    tokens = enc.encode_ordinary(text)
+    return [
+        enc.decode(tokens[i : i + max_tokens])
+        for i in range(0, len(tokens), max_tokens)
+    ]
+
+
+def split_section(section, enc, max_tokens):
+    """
+    Splits a section that is longer than max_tokens at line breaks. Lines that
+    are still too long are cut by tokens.
+    """
+    pieces = []
+    current, current_tokens = [], 0
+    for line in section.split("\n"):
+        num_tokens = count_tokens(line, enc)
+        if num_tokens > max_tokens:
+            pieces.extend(_split_by_tokens(line, enc, max_tokens))
+            continue
+        if current and current_tokens + num_tokens > max_tokens:
+            pieces.append("\n".join(current))
+            current, current_tokens = [], 0
+        current.append(line)
+        current_tokens += num_tokens
+    if current:
+        pieces.append("\n".join(current))
+    return pieces
+
+
+def plan_chunks(sections, enc, max_tokens=DEFAULT_CHUNK_TOKENS, section_tokens=None):
+    """
+    Packs consecutive sections into chunks of at most max_tokens tokens.
+
+    The number of chunks is the smallest that fits the paper, and the sections
+    are spread evenly over them, so that no chunk is much longer (and much
+    slower to read) than the others.
+
+    Parameters:
+    sections (list of str): The reduced text of each section
+    enc (tiktoken.Encoding): The encoder used to count tokens
+    max_tokens (int): The maximum number of tokens in a chunk
+    section_tokens (list of int): If set, the number of tokens of each section
+    (see token_counter.get_paper_tokens), so that only the sections that are
+    split are encoded
+
+    Returns:
+    chunks (list of str): The text of each chunk
+    """
+    if section_tokens is None:
+        section_tokens = count_tokens_batch(sections, enc)
+    pieces = []
+    for section, num_tokens in zip(sections, section_tokens):
+        if not section.strip():
+            continue
+        if num_tokens > max_tokens:
+            split = split_section(section, enc, max_tokens)
+            pieces.extend(zip(split, count_tokens_batch(split, enc)))
+        else:
+            pieces.append((section, num_tokens))
+
+    total_tokens = sum(n for _, n in pieces)
+    num_chunks = max(1, math.ceil(total_tokens / max_tokens))
+    target_tokens = total_tokens / num_chunks
+
+    chunks = []
+    current, current_tokens = [], 0
+    for piece, num_tokens in pieces:
+        if current and (
+            current_tokens + num_tokens > max_tokens
+            or current_tokens + num_tokens / 2 > target_tokens
+        ):
+            chunks.append("\n\n".join(current))
+            current, current_tokens = [], 0
+        current.append(piece)
+        current_tokens += num_tokens
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+
+async def summarize_chunked(
+    sections,
+    enc,
+    max_chunk_tokens=DEFAULT_CHUNK_TOKENS,
+    max_prompt_tokens=None,
+    echo=True,
+    on_content=None,
+    question_groups=None,
+    section_tokens=None,
+):
+    """
+    Summarizes a paper that is too long for a single prompt.
+
+    The sections are packed into chunks, notes are taken on all chunks
+    concurrently (map), then the questions in paper_query.tpl are answered from
+    the notes (reduce).
+
+    Parameters:
+    sections (list of str): The reduced text of each section
+    enc (tiktoken.Encoding): The encoder used to count tokens
+    max_chunk_tokens (int): The maximum number of tokens in a chunk
+    max_prompt_tokens (int): If set, the maximum length of the final prompt
+    echo (bool): Whether to print the final answer while it is generated
+    on_content (callable): If set, called with each piece of the final answer
+    while it is generated
+    question_groups (list of list of int): If set, the questions are answered
+    from the notes by one concurrent call per group, see summarize_fanout
+    section_tokens (list of int): If set, the number of tokens of each section
+
+    Returns:
+    content (str): The answer to the questions
+    num_prompt_tokens (int): The number of prompt tokens of all calls
+    num_generated_tokens (int): The number of generated tokens of all calls
+
+    Raises:
+    ValueError: If the notes are too long for the final prompt
+    """
+    chunks = plan_chunks(
+        sections, enc, max_tokens=max_chunk_tokens, section_tokens=section_tokens
+    )
+    logger.info(f"Reading the paper in {len(chunks)} chunks")
+
+    chunk_messages = [
+        make_chunk_messages(chunk, i + 1, len(chunks)) for i, chunk in enumerate(chunks)
+    ]
+    chunk_tokens = count_tokens_batch(
+        [make_chatml(messages) for messages in chunk_messages], enc
+    )
+    num_prompt_tokens = sum(chunk_tokens)
+
+    notes = await asyncio.gather(
+        *(
+            fetch_response_with_streaiming(
+                create_stream(
+                    messages=messages, prompt_tokens=n, priority=PRIORITY_NOTES
+                ),
+                echo=False,
+            )
+            for messages, n in zip(chunk_messages, chunk_tokens)
+        )
+    )
+    num_generated_tokens = sum(count_tokens_batch(notes, enc))
+
+    reduce_messages = make_reduce_messages(notes)
+    num_reduce_tokens = count_tokens(make_chatml(reduce_messages), enc)
+    logger.info(f"Notes prompt length: {num_reduce_tokens} tokens")
+    if max_prompt_tokens is not None and num_reduce_tokens > max_prompt_tokens:
+        raise ValueError(f"Notes prompt too long: {num_reduce_tokens}")
+
+    if question_groups:
+        content, num_reduce_tokens, num_answer_tokens = await summarize_fanout(
+            make_notes_content(notes),
+            enc,
+            question_groups,
+            echo=echo,
+            on_content=on_content,
+        )
+    else:
+        content = await fetch_response_with_streaiming(
+            create_stream(messages=reduce_messages, prompt_tokens=num_reduce_tokens),
+            echo=echo,
+            on_content=on_content,
+        )
+        num_answer_tokens = count_tokens(content, enc)
+    num_prompt_tokens += num_reduce_tokens
+    num_generated_tokens += num_answer_tokens
+    return content, num_prompt_tokens, num_generated_tokens
@@ -0,0 +1,129 @@
+import json
+import time
+import sqlite3
+import logging
+
+from arxiv_loader import fetch_metainfo_many, fetch_metainfo_many_async
+from tracing import current_span, traced
+
+logger = logging.getLogger(__name__)
+
+# Metadata fetched more recently than this is used without asking the API
+DEFAULT_MAX_AGE = 24 * 3600
+
+
+class MetadataStore:
+    """
+    A local store of arXiv metadata, keyed by arXiv ID and `updated` date.
+
+    Every version of the metadata seen for a paper is kept, lookups return the
+    one with the latest `updated` date.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS metadata (
+                    arxiv_id TEXT NOT NULL,
+                    updated TEXT NOT NULL,
+                    fetched_at REAL NOT NULL,
+                    metadata TEXT NOT NULL,
+                    PRIMARY KEY (arxiv_id, updated)
+                )
+                """
+            )
+
+    def _connect(self):
+        # one connection per call, so the store can be used from any thread
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, arxiv_id, max_age=None):
+        """
+        Returns the stored metadata of a paper, or None if it is not stored or
+        was fetched more than max_age seconds ago.
+        """
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT fetched_at, metadata FROM metadata WHERE arxiv_id = ? "
+                "ORDER BY updated DESC LIMIT 1",
+                (arxiv_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        fetched_at, metadata = row
+        if max_age is not None and time.time() - fetched_at > max_age:
+            return None
+        return json.loads(metadata)
+
+    def put_many(self, metadata):
+        """
+        Stores metadata, a dict of arxiv_id -> metadata.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?)",
+                [
+                    (arxiv_id, m["updated"], now, json.dumps(m, ensure_ascii=False))
+                    for arxiv_id, m in metadata.items()
+                ],
+            )
+
+    def _split_stored(self, arxiv_ids, max_age):
+        stored = {}
+        missing = []
+        for arxiv_id in arxiv_ids:
+            metadata = self.get(arxiv_id, max_age=max_age)
+            if metadata is None:
+                missing.append(arxiv_id)
+            else:
+                stored[arxiv_id] = metadata
+        return stored, missing
+
+    @traced("metadata")
+    def load_many(self, arxiv_ids, max_age=DEFAULT_MAX_AGE, batch_size=100):
+        """
+        Returns the metadata of many papers. Papers that are not stored, or
+        were fetched more than max_age seconds ago, are fetched from the arXiv
+        API in batches of batch_size IDs.
+
+        Returns:
+        metadata (dict): arxiv_id -> metadata, unknown IDs are missing
+        """
+        results, missing = self._split_stored(arxiv_ids, max_age)
+        current_span().set(papers=len(arxiv_ids), fetched=len(missing))
+        if missing:
+            logger.info(f"Fetching metadata for {len(missing)} papers")
+            fetched = fetch_metainfo_many(missing, batch_size=batch_size)
+            self.put_many(fetched)
+            results.update(fetched)
+        return results
+
+    @traced("metadata")
+    async def load_many_async(
+        self, arxiv_ids, client, max_age=DEFAULT_MAX_AGE, batch_size=100
+    ):
+        """
+        Like load_many, fetching the missing papers with an HttpClient.
+        """
+        results, missing = self._split_stored(arxiv_ids, max_age)
+        current_span().set(papers=len(arxiv_ids), fetched=len(missing))
+        if missing:
+            logger.info(f"Fetching metadata for {len(missing)} papers")
+            fetched = await fetch_metainfo_many_async(
+                missing, client, batch_size=batch_size
+            )
+            self.put_many(fetched)
+            results.update(fetched)
+        return results
+
+    def load(self, arxiv_id, max_age=DEFAULT_MAX_AGE):
+        """
+        Returns the metadata of a paper, fetching it if needed.
+
+        Raises:
+        KeyError: If the arXiv API does not know the paper
+        """
+        return self.load_many([arxiv_id], max_age=max_age)[arxiv_id]
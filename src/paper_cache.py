@@ -0,0 +1,611 @@
+import re
+import zlib
+import gzip
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import contextlib
+from pathlib import Path
+
+import click
+
+from file_lock import atomic_write, get_lock, remove_stale_locks
+
+try:
+    import zstandard
+except ImportError:  # optional, gzip is used without it
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# The kinds of artifacts stored for a paper
+ARTIFACT_KINDS = ("html", "text", "summary", "snapshot", "tokens", "compact")
+
+# The outputs of the tool, as opposed to the caches of what it fetched and
+# computed: they are never evicted, and don't count towards max_bytes
+KEPT_KINDS = ("summary", "snapshot")
+
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+# The options of the text files of the first versions, see PaperCache.migrate
+LEGACY_TEXT_OPTIONS = "legacy"
+
+# The file suffix of each kind of blob, before the compression suffix
+_KIND_SUFFIXES = {
+    "html": ".html",
+    "text": ".text.json",
+    "summary": ".summary.txt",
+    "snapshot": ".snapshot.json",
+    "tokens": ".tokens.json",
+    "compact": ".compact.json",
+}
+
+_GZIP_LEVEL = 6
+_ZSTD_LEVEL = 10
+
+# The errors of a blob that was damaged on disk, gzip and zstd check the
+# content with their checksum when it is decompressed
+_CORRUPT_BLOB_ERRORS = (OSError, EOFError, zlib.error) + (
+    (zstandard.ZstdError,) if zstandard is not None else ()
+)
+
+
+def _evictable(column):
+    # e.g. "kind NOT IN ('summary', 'snapshot')"
+    kinds = ", ".join(f"'{kind}'" for kind in KEPT_KINDS)
+    return f"{column} NOT IN ({kinds})"
+
+
+def _compress(data, codec):
+    if codec == "zst":
+        return zstandard.ZstdCompressor(
+            level=_ZSTD_LEVEL, write_checksum=True
+        ).compress(data)
+    if codec == "gz":
+        return gzip.compress(data, compresslevel=_GZIP_LEVEL, mtime=0)
+    return data
+
+
+def read_blob(path):
+    """
+    Reads a blob written by PaperCache, decompressing it by its suffix.
+
+    This does not touch the index, so it can be used from other processes.
+    """
+    path = Path(path)
+    data = path.read_bytes()
+    if path.suffix == ".zst":
+        if zstandard is None:
+            raise RuntimeError(f"zstandard is needed to read {path}")
+        return zstandard.ZstdDecompressor().decompress(data)
+    if path.suffix == ".gz":
+        return gzip.decompress(data)
+    return data
+
+
+def read_blob_text(path):
+    return read_blob(path).decode("utf-8")
+
+
+class PaperCache:
+    """
+    The on-disk cache of fetched and generated paper artifacts.
+
+    An SQLite index maps (key, kind) to a blob, together with the arXiv ID,
+    source and options the blob was made for, so the files of a paper can be
+    found without recomputing URL hashes. Blobs are compressed (zstd if
+    installed, gzip otherwise) and sharded into blobs/<ab>/<cd>/ by the hash
+    of their key. The least recently used blobs are evicted when the cache
+    grows over max_bytes, except the summaries and snapshots (KEPT_KINDS),
+    which are kept until they are deleted.
+
+    Several processes can share the cache: blobs are written atomically, a
+    blob whose size or checksum is wrong is ignored when it is read, and
+    lock(key, kind) lets one process make an artifact while the others wait
+    for it.
+
+    Parameters:
+    root (Path): The cache directory
+    max_bytes (int): The maximum size of the stored blobs that can be evicted,
+    None for no limit
+    codec (str): "zst", "gz" or None, defaults to the best one available
+    """
+
+    def __init__(self, root, max_bytes=DEFAULT_MAX_BYTES, codec="auto"):
+        self.root = Path(root)
+        self.blob_dir = self.root / "blobs"
+        self.blob_dir.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.root / "index.sqlite3"
+        self.lock_dir = self.root / "locks"
+        self.max_bytes = max_bytes
+        if codec == "auto":
+            codec = "zst" if zstandard is not None else "gz"
+        self.codec = codec
+        with self._connect() as conn:
+            # the processes sharing the cache create the index one at a time
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS blobs (
+                    key TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    arxiv_id TEXT,
+                    source TEXT,
+                    options TEXT,
+                    size INTEGER NOT NULL,
+                    stored_size INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    accessed REAL NOT NULL,
+                    PRIMARY KEY (key, kind)
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS blobs_arxiv_id ON blobs (arxiv_id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS blobs_accessed ON blobs (accessed)")
+            self._create_usage(conn)
+
+    def _create_usage(self, conn):
+        # the stored size of the blobs that can be evicted, kept up to date by
+        # triggers so that put does not sum the whole index
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS usage ("
+            "id INTEGER PRIMARY KEY CHECK (id = 0), stored_size INTEGER NOT NULL)"
+        )
+        conn.execute(
+            "INSERT OR IGNORE INTO usage SELECT 0, COALESCE(SUM(stored_size), 0) "
+            f"FROM blobs WHERE {_evictable('kind')}"
+        )
+        for name, event, condition, change in (
+            ("insert", "INSERT", "NEW", "+ NEW.stored_size"),
+            ("delete", "DELETE", "OLD", "- OLD.stored_size"),
+            (
+                "update",
+                "UPDATE OF stored_size",
+                "NEW",
+                "+ NEW.stored_size - OLD.stored_size",
+            ),
+        ):
+            conn.execute(
+                f"CREATE TRIGGER IF NOT EXISTS usage_{name} AFTER {event} ON blobs "
+                f"WHEN {_evictable(condition + '.kind')} BEGIN "
+                f"UPDATE usage SET stored_size = stored_size {change}; END"
+            )
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # one connection per call, so the cache can be used from any thread.
+        # The block commits (or rolls back) and the connection is closed, the
+        # with block of a connection alone leaves it open.
+        conn = sqlite3.connect(self.index_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _blob_path(self, key, kind, codec):
+        shard = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        suffix = _KIND_SUFFIXES.get(kind, f".{kind}") + (f".{codec}" if codec else "")
+        return self.blob_dir / shard[:2] / shard[2:4] / f"{key}{suffix}"
+
+    def lock(self, key, kind):
+        """
+        Returns the FileLock of an artifact, held by the process that makes
+        it so that the others wait and use its result instead of making it
+        again.
+        """
+        return get_lock(self.lock_dir, f"{kind}:{key}")
+
+    def get_path(self, key, kind, arxiv_id=None, source=None, since=None):
+        """
+        Returns the path of a stored blob and marks it as recently used, or
+        None if it is not stored, or was stored before the time `since`.
+        arxiv_id and source, if given, are stored for blobs that were saved
+        without them (e.g. migrated files).
+
+        A blob whose file is missing is removed from the index. A file that
+        does not have the stored size (e.g. truncated by a crash of an older
+        version) is not used, the next put replaces it.
+        """
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT path, stored_size, created FROM blobs "
+                "WHERE key = ? AND kind = ?",
+                (key, kind),
+            ).fetchone()
+            if row is None:
+                return None
+            path = self.root / row[0]
+            try:
+                size = path.stat().st_size
+            except FileNotFoundError:
+                conn.execute(
+                    "DELETE FROM blobs WHERE key = ? AND kind = ?", (key, kind)
+                )
+                return None
+            if size != row[1]:
+                logger.warning(f"Ignoring damaged cache file {path}")
+                return None
+            if since is not None and row[2] < since:
+                return None
+            conn.execute(
+                "UPDATE blobs SET accessed = ?, arxiv_id = COALESCE(arxiv_id, ?), "
+                "source = COALESCE(source, ?) WHERE key = ? AND kind = ?",
+                (time.time(), arxiv_id, source, key, kind),
+            )
+        return path
+
+    def get(self, key, kind):
+        """
+        Returns the (decompressed) content of a stored blob, or None if it is
+        not stored or cannot be decompressed.
+        """
+        path = self.get_path(key, kind)
+        if path is None:
+            return None
+        try:
+            return read_blob(path)
+        except FileNotFoundError:
+            return None
+        except _CORRUPT_BLOB_ERRORS as e:
+            logger.warning(f"Ignoring damaged cache file {path}: {e}")
+            return None
+
+    def get_text(self, key, kind):
+        data = self.get(key, kind)
+        return None if data is None else data.decode("utf-8")
+
+    def put(
+        self, key, kind, data, arxiv_id=None, source=None, options=None, compress=True
+    ):
+        """
+        Stores a blob, replacing the previous one, and returns its path.
+
+        Parameters:
+        key (str): The key of the blob, e.g. the URL hash of the paper
+        kind (str): The kind of artifact, one of ARTIFACT_KINDS
+        data (bytes or str): The content
+        arxiv_id, source, options (str): What the blob was made from, for lookups
+        compress (bool): False to store the blob as is, e.g. files that are
+        read by users
+        """
+        path, usage = self._put(
+            key,
+            kind,
+            data,
+            arxiv_id=arxiv_id,
+            source=source,
+            options=options,
+            compress=compress,
+        )
+        if self.max_bytes is not None and usage > self.max_bytes:
+            self.evict(self.max_bytes)
+        return path
+
+    def _put(
+        self, key, kind, data, arxiv_id=None, source=None, options=None, compress=True
+    ):
+        # stores the blob, returns its path and the stored size of the blobs
+        # that can be evicted
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        codec = self.codec if compress else None
+        path = self._blob_path(key, kind, codec)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        stored = _compress(data, codec)
+        # readers never see a partial blob, even if this process dies
+        atomic_write(path, stored)
+
+        now = time.time()
+        with self._connect() as conn:
+            old = conn.execute(
+                "SELECT path FROM blobs WHERE key = ? AND kind = ?", (key, kind)
+            ).fetchone()
+            # an upsert rather than a replace, so that the usage triggers see
+            # an update of the stored size
+            conn.execute(
+                "INSERT INTO blobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (key, kind) DO UPDATE SET path = excluded.path, "
+                "arxiv_id = excluded.arxiv_id, source = excluded.source, "
+                "options = excluded.options, size = excluded.size, "
+                "stored_size = excluded.stored_size, created = excluded.created, "
+                "accessed = excluded.accessed",
+                (
+                    key,
+                    kind,
+                    str(path.relative_to(self.root)),
+                    arxiv_id,
+                    source,
+                    options,
+                    len(data),
+                    len(stored),
+                    now,
+                    now,
+                ),
+            )
+            usage = conn.execute("SELECT stored_size FROM usage").fetchone()[0]
+        # the codec may have changed since the old blob was written
+        if old is not None and self.root / old[0] != path:
+            (self.root / old[0]).unlink(missing_ok=True)
+        return path, usage
+
+    def delete(self, key, kind):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT path FROM blobs WHERE key = ? AND kind = ?", (key, kind)
+            ).fetchone()
+            conn.execute("DELETE FROM blobs WHERE key = ? AND kind = ?", (key, kind))
+        if row is not None:
+            (self.root / row[0]).unlink(missing_ok=True)
+
+    def find(self, arxiv_id):
+        """
+        Returns the blobs stored for an arXiv ID, as dicts with the key, kind,
+        path, source, options and sizes.
+        """
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(
+                "SELECT * FROM blobs WHERE arxiv_id = ? ORDER BY kind, source",
+                (arxiv_id,),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def entries(self, kind):
+        """
+        Returns the blobs of a kind, as dicts like find, oldest first.
+        """
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(
+                "SELECT * FROM blobs WHERE kind = ? ORDER BY created", (kind,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def stats(self):
+        """
+        Returns the number of blobs, their size and their size on disk, for
+        each kind and in total.
+        """
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT kind, COUNT(*), SUM(size), SUM(stored_size) FROM blobs "
+                "GROUP BY kind ORDER BY kind"
+            ).fetchall()
+        stats = {
+            kind: {"count": count, "size": size, "stored_size": stored_size}
+            for kind, count, size, stored_size in rows
+        }
+        stats["total"] = {
+            field: sum(s[field] for s in stats.values())
+            for field in ("count", "size", "stored_size")
+        }
+        return stats
+
+    def _remove(self, conn, rows):
+        conn.executemany(
+            "DELETE FROM blobs WHERE key = ? AND kind = ?",
+            [(key, kind) for key, kind, _, _ in rows],
+        )
+        for _, _, path, _ in rows:
+            (self.root / path).unlink(missing_ok=True)
+        return len(rows), sum(stored_size for _, _, _, stored_size in rows)
+
+    def evict(self, max_bytes):
+        """
+        Removes the least recently used blobs until the stored size of the
+        blobs that can be evicted (all but KEPT_KINDS) is at most max_bytes.
+        Returns the number of blobs and bytes removed.
+        """
+        with self._connect() as conn:
+            total = conn.execute("SELECT stored_size FROM usage").fetchone()[0]
+            if total <= max_bytes:
+                return 0, 0
+            victims = []
+            for row in conn.execute(
+                "SELECT key, kind, path, stored_size FROM blobs "
+                f"WHERE {_evictable('kind')} ORDER BY accessed"
+            ):
+                if total <= max_bytes:
+                    break
+                victims.append(row)
+                total -= row[3]
+            return self._remove(conn, victims)
+
+    def gc(self, max_bytes=None, max_age=None):
+        """
+        Removes blobs not used for max_age seconds, then evicts down to
+        max_bytes, then drops index entries without a blob and blobs without
+        an index entry (including the temporary files of interrupted writes).
+        Summaries and snapshots (KEPT_KINDS) are only removed if their file is
+        missing. The lock files left by crashed processes are removed too.
+        Returns the number of blobs and bytes removed.
+        """
+        removed, removed_bytes = 0, 0
+        with self._connect() as conn:
+            if max_age is not None:
+                rows = conn.execute(
+                    "SELECT key, kind, path, stored_size FROM blobs "
+                    f"WHERE accessed < ? AND {_evictable('kind')}",
+                    (time.time() - max_age,),
+                ).fetchall()
+                n, b = self._remove(conn, rows)
+                removed, removed_bytes = removed + n, removed_bytes + b
+
+        if max_bytes is not None:
+            n, b = self.evict(max_bytes)
+            removed, removed_bytes = removed + n, removed_bytes + b
+
+        with self._connect() as conn:
+            known = set()
+            missing = []
+            for key, kind, path in conn.execute("SELECT key, kind, path FROM blobs"):
+                if (self.root / path).exists():
+                    known.add(path)
+                else:
+                    missing.append((key, kind))
+            conn.executemany("DELETE FROM blobs WHERE key = ? AND kind = ?", missing)
+            # repairs the usage if the index was changed without the triggers
+            conn.execute(
+                "UPDATE usage SET stored_size = (SELECT COALESCE(SUM(stored_size), 0) "
+                f"FROM blobs WHERE {_evictable('kind')})"
+            )
+
+        # files written in the last hour may be writes in progress, or blobs
+        # whose index entry is being added
+        recent = time.time() - 3600
+        for path in self.blob_dir.glob("*/*/*"):
+            if str(path.relative_to(self.root)) in known:
+                continue
+            # another process may remove the file at the same time
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            if stat.st_mtime < recent:
+                path.unlink(missing_ok=True)
+                removed += 1
+                removed_bytes += stat.st_size
+        remove_stale_locks(self.lock_dir)
+        return removed, removed_bytes
+
+    def migrate(self, legacy_dir):
+        """
+        Moves the files of the old flat cache layout ({url_hash}.html,
+        {key}.txt with {key}.sections.json, {url_hash}.summary.txt) from
+        legacy_dir into the cache. Returns the number of files moved.
+
+        The first versions wrote the text as {url_hash}.txt, without its parse
+        options or sections. It is kept as a text blob with the options
+        LEGACY_TEXT_OPTIONS, which no lookup matches, so the paper is parsed
+        again from its HTML and the old text is evicted like any other blob.
+
+        The cache is evicted down to max_bytes once all files are moved.
+        """
+        from text_cache import encode_paper_text
+
+        legacy_dir = Path(legacy_dir)
+        moved = 0
+        for path in sorted(legacy_dir.iterdir()):
+            if not path.is_file():
+                continue
+            name = path.name
+            if re.fullmatch(r"[0-9a-f]{64}\.html", name):
+                self._put(name[: -len(".html")], "html", path.read_bytes())
+                path.unlink()
+                moved += 1
+            elif re.fullmatch(r"[0-9a-f]{64}\.summary\.txt", name):
+                key = name[: -len(".summary.txt")]
+                self._put(key, "summary", path.read_bytes(), compress=False)
+                path.unlink()
+                moved += 1
+            elif re.fullmatch(r"[0-9a-f]{64}\.txt", name):
+                key = f"{name[: -len('.txt')]}.{LEGACY_TEXT_OPTIONS}"
+                data = encode_paper_text(path.read_text(encoding="utf-8"), [])
+                self._put(key, "text", data, options=LEGACY_TEXT_OPTIONS)
+                path.unlink()
+                moved += 1
+            elif name.endswith(".txt") and re.match(r"[0-9a-f]{64}\.v\d+-", name):
+                key = name[: -len(".txt")]
+                sections_path = legacy_dir / f"{key}.sections.json"
+                if not sections_path.exists():
+                    continue
+                data = encode_paper_text(
+                    path.read_text(encoding="utf-8"),
+                    json.loads(sections_path.read_text(encoding="utf-8")),
+                )
+                self._put(key, "text", data, options=key.split(".", 1)[1])
+                path.unlink()
+                sections_path.unlink()
+                moved += 2
+        if self.max_bytes is not None:
+            self.evict(self.max_bytes)
+        return moved
+
+
+def _format_bytes(n):
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024 or unit == "GB":
+            return f"{n:.1f} {unit}" if unit != "B" else f"{n} B"
+        n /= 1024
+
+
+def _default_cache():
+    from arxiv_loader import get_paper_cache
+
+    return get_paper_cache()
+
+
+@click.group(name="cache")
+def main():
+    """
+    Inspects and cleans the paper cache in src/.cached.
+    """
+
+
+@main.command()
+def stats():
+    """
+    Prints the number and size of the cached blobs of each kind.
+    """
+    for kind, s in _default_cache().stats().items():
+        ratio = s["size"] / s["stored_size"] if s["stored_size"] else 0.0
+        print(
+            f"{kind:<8} {s['count']:>7} blobs  {_format_bytes(s['size']):>10}  "
+            f"{_format_bytes(s['stored_size']):>10} on disk  ({ratio:.1f}x)"
+        )
+
+
+@main.command()
+@click.option(
+    "--max-size",
+    type=float,
+    default=None,
+    help="Evict the least recently used blobs until the cache is at most this many MB.",
+)
+@click.option(
+    "--max-age",
+    type=float,
+    default=None,
+    help="Remove the blobs that were not used for this many days.",
+)
+def gc(max_size, max_age):
+    """
+    Removes old blobs and files that are missing from the index.
+    """
+    removed, removed_bytes = _default_cache().gc(
+        max_bytes=None if max_size is None else int(max_size * 1024 * 1024),
+        max_age=None if max_age is None else max_age * 24 * 3600,
+    )
+    print(f"Removed {removed} files, {_format_bytes(removed_bytes)}")
+
+
+@main.command()
+@click.argument("arxiv_id")
+def find(arxiv_id):
+    """
+    Prints the cached files of ARXIV_ID.
+    """
+    cache = _default_cache()
+    for row in cache.find(arxiv_id):
+        print(
+            f"{row['kind']:<8} {row['source'] or '-':<13} {row['options'] or '-':<22} "
+            f"{cache.root / row['path']}"
+        )
+
+
+@main.command()
+def migrate():
+    """
+    Moves the files of the old flat cache layout into the indexed cache.
+    """
+    cache = _default_cache()
+    moved = cache.migrate(cache.root)
+    print(f"Moved {moved} files into {cache.blob_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+import os
+import re
+import gzip
+import json
+import logging
+
+import numpy as np
+from scipy import sparse
+
+from text_cache import load_paper_text
+
+logger = logging.getLogger(__name__)
+
+# Bumped when the chunking or the tokenization changes, to rebuild old indexes
+INDEX_VERSION = 1
+
+# The number of words in a chunk of a paper
+DEFAULT_CHUNK_WORDS = 200
+
+# BM25 parameters: term frequency saturation and length normalization
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_STOPWORDS = frozenset(
+    """
+    a an and are as at be by can for from has have in is it its of on or our
+    that the their these this to was we were which with not also than then
+    there they been into more such only other both each may using use used
+    """.split()
+)
+
+
+def tokenize(text):
+    """
+    Returns the terms of a text: lowercased words and numbers, without
+    stopwords and single letters.
+    """
+    return [
+        t
+        for t in re.findall(r"[a-z0-9]+", text.lower())
+        if len(t) > 1 and t not in _STOPWORDS
+    ]
+
+
+def split_chunks(sections, chunk_words=DEFAULT_CHUNK_WORDS):
+    """
+    Splits the sections of a paper into chunks of about chunk_words words.
+    Paragraphs are kept together unless they are longer than a chunk.
+
+    Returns:
+    chunks (list of (int, str)): The section index and the text of each chunk
+    """
+    chunks = []
+    for index, section in enumerate(sections):
+        current, current_words = [], 0
+        for paragraph in section.split("\n"):
+            words = paragraph.split()
+            if not words:
+                continue
+            if current and current_words + len(words) > chunk_words:
+                chunks.append((index, "\n".join(current)))
+                current, current_words = [], 0
+            while len(words) > chunk_words:
+                chunks.append((index, " ".join(words[:chunk_words])))
+                words = words[chunk_words:]
+            current.append(" ".join(words))
+            current_words += len(words)
+        if current:
+            chunks.append((index, "\n".join(current)))
+    return chunks
+
+
+def _section_title(section):
+    # the first line of a reduced section is its <h2> title
+    title = section.strip().split("\n", 1)[0].strip()
+    return title[:80]
+
+
+class PaperIndex:
+    """
+    A BM25 index of the chunks of the cached papers, for retrieval.
+
+    The term counts of the chunks are kept in a sparse matrix (chunks x
+    terms). The BM25 weights are computed from it when the index is loaded, a
+    query is the sum of the weight columns of its terms. The index is stored
+    in `<cache root>/search_index` and updated incrementally: only papers
+    whose cached text changed are chunked and counted again.
+
+    Parameters:
+    index_dir (Path): The directory the index is stored in
+    chunk_words (int): The number of words in a chunk
+    """
+
+    def __init__(self, index_dir, chunk_words=DEFAULT_CHUNK_WORDS):
+        self.index_dir = index_dir
+        self.chunk_words = chunk_words
+        self.clear()
+        self._load()
+
+    def clear(self):
+        """
+        Empties the index, the next update indexes all papers again.
+        """
+        # arxiv_id -> text cache key the paper was indexed from
+        self.papers = {}
+        # (arxiv_id, section index, section title, text) of each chunk
+        self.chunks = []
+        self.vocab = {}
+        self.counts = sparse.csr_matrix((0, 0), dtype=np.float32)
+        self._weights = None
+
+    @property
+    def _meta_path(self):
+        return self.index_dir / "meta.json.gz"
+
+    @property
+    def _counts_path(self):
+        return self.index_dir / "counts.npz"
+
+    def _load(self):
+        if not self._meta_path.exists() or not self._counts_path.exists():
+            return
+        try:
+            with gzip.open(self._meta_path, "rt", encoding="utf-8") as f:
+                meta = json.load(f)
+            counts = sparse.load_npz(self._counts_path).tocsr()
+        except (OSError, ValueError) as e:
+            logger.warning(f"Cannot load the search index, rebuilding it: {e}")
+            return
+        if (
+            meta.get("version") != INDEX_VERSION
+            or meta.get("chunk_words") != self.chunk_words
+        ):
+            logger.info("The search index is outdated, rebuilding it")
+            return
+        self.papers = meta["papers"]
+        self.chunks = [tuple(chunk) for chunk in meta["chunks"]]
+        self.vocab = {term: i for i, term in enumerate(meta["vocab"])}
+        self.counts = counts
+
+    def save(self):
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        meta = {
+            "version": INDEX_VERSION,
+            "chunk_words": self.chunk_words,
+            "papers": self.papers,
+            "chunks": self.chunks,
+            "vocab": sorted(self.vocab, key=self.vocab.get),
+        }
+        # written to temporary files first, so that a crash leaves the old
+        # index in place
+        tmp_meta = self._meta_path.with_suffix(".tmp")
+        with gzip.open(tmp_meta, "wt", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        tmp_counts = self.index_dir / "counts.tmp.npz"
+        sparse.save_npz(tmp_counts, self.counts)
+        os.replace(tmp_counts, self._counts_path)
+        os.replace(tmp_meta, self._meta_path)
+
+    def _count_terms(self, texts):
+        """
+        Returns the term counts of texts as a sparse matrix, adding the new
+        terms to the vocabulary.
+        """
+        rows, cols = [], []
+        for row, text in enumerate(texts):
+            for term in tokenize(text):
+                col = self.vocab.get(term)
+                if col is None:
+                    col = self.vocab[term] = len(self.vocab)
+                rows.append(row)
+                cols.append(col)
+        data = np.ones(len(rows), dtype=np.float32)
+        counts = sparse.csr_matrix(
+            (data, (rows, cols)), shape=(len(texts), len(self.vocab))
+        )
+        counts.sum_duplicates()
+        return counts
+
+    def update(self, cache):
+        """
+        Indexes the papers whose text is in the PaperCache and was not indexed
+        yet or changed since, and drops the papers that left the cache. The
+        newest text of each paper is used.
+
+        Returns:
+        changed (int): The number of papers added, updated or removed
+        """
+        current = {}
+        for entry in cache.entries("text"):
+            if entry["arxiv_id"]:
+                current[entry["arxiv_id"]] = entry["key"]
+
+        removed = {a for a, key in self.papers.items() if current.get(a) != key}
+        added = [a for a, key in current.items() if self.papers.get(a) != key]
+        if not removed and not added:
+            return 0
+
+        if removed:
+            keep = [
+                i for i, chunk in enumerate(self.chunks) if chunk[0] not in removed
+            ]
+            self.counts = self.counts[keep]
+            self.chunks = [self.chunks[i] for i in keep]
+            for arxiv_id in removed:
+                del self.papers[arxiv_id]
+
+        new_chunks = []
+        for arxiv_id in added:
+            text = load_paper_text(cache, current[arxiv_id])
+            if text is None:
+                continue
+            _, sections = text
+            for index, chunk in split_chunks(sections, self.chunk_words):
+                new_chunks.append(
+                    (arxiv_id, index, _section_title(sections[index]), chunk)
+                )
+            self.papers[arxiv_id] = current[arxiv_id]
+
+        new_counts = self._count_terms([chunk[3] for chunk in new_chunks])
+        # the old rows get the columns of the new terms
+        old_counts = self.counts.copy()
+        old_counts.resize((old_counts.shape[0], len(self.vocab)))
+        self.counts = sparse.vstack([old_counts, new_counts], format="csr")
+        self.chunks.extend(new_chunks)
+        self._weights = None
+        logger.info(
+            f"Indexed {len(added)} papers, removed {len(removed - set(added))}, "
+            f"{len(self.chunks)} chunks of {len(self.papers)} papers in total"
+        )
+        return len(removed | set(added))
+
+    def _get_weights(self):
+        """
+        Returns the BM25 weight of each term in each chunk, as a CSC matrix so
+        that the columns of the query terms are cheap to select.
+        """
+        if self._weights is None:
+            counts = self.counts.tocsr()
+            num_chunks = counts.shape[0]
+            lengths = np.asarray(counts.sum(axis=1)).ravel()
+            avg_length = lengths.mean() if num_chunks else 0.0
+            # every term appears once per row of a CSR matrix
+            df = np.bincount(counts.indices, minlength=counts.shape[1])
+            idf = np.log1p((num_chunks - df + 0.5) / (df + 0.5))
+
+            rows = np.repeat(np.arange(num_chunks), np.diff(counts.indptr))
+            tf = counts.data
+            relative_lengths = lengths[rows] / max(avg_length, 1)
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * relative_lengths)
+            data = tf * (BM25_K1 + 1) / (tf + norm) * idf[counts.indices]
+            self._weights = sparse.csr_matrix(
+                (data.astype(np.float32), counts.indices, counts.indptr),
+                shape=counts.shape,
+            ).tocsc()
+        return self._weights
+
+    def search(self, query, top_k=8, arxiv_ids=None):
+        """
+        Returns the chunks most relevant to the query.
+
+        With several arxiv_ids, each paper gets its share of the top_k chunks
+        (at least one), so that questions comparing papers get excerpts of all
+        of them.
+
+        Parameters:
+        query (str): The question
+        top_k (int): The number of chunks to return
+        arxiv_ids (list of str): The papers to search, None for all
+
+        Returns:
+        results (list of (float, tuple)): The score and the (arxiv_id,
+        section index, section title, text) of each chunk, best first
+        """
+        if not self.chunks:
+            return []
+        terms = [self.vocab[t] for t in tokenize(query) if t in self.vocab]
+        if terms:
+            scores = np.asarray(self._get_weights()[:, terms].sum(axis=1)).ravel()
+        else:
+            scores = np.zeros(len(self.chunks), dtype=np.float32)
+
+        chunk_papers = np.array([chunk[0] for chunk in self.chunks])
+        if not arxiv_ids:
+            # chunks without any term of the query are not relevant
+            groups = [(np.flatnonzero(scores > 0), top_k)]
+        else:
+            per_paper = max(1, -(-top_k // len(arxiv_ids)))
+            groups = [
+                (np.flatnonzero(chunk_papers == arxiv_id), per_paper)
+                for arxiv_id in arxiv_ids
+            ]
+
+        selected = []
+        for candidates, k in groups:
+            if len(candidates) > k:
+                best = np.argpartition(-scores[candidates], k - 1)[:k]
+                candidates = candidates[best]
+            selected.extend(candidates.tolist())
+        selected.sort(key=lambda i: -scores[i])
+        return [(float(scores[i]), self.chunks[i]) for i in selected]
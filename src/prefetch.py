@@ -0,0 +1,392 @@
+import re
+import sys
+import time
+import asyncio
+import logging
+import functools
+import contextlib
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import click
+
+from arxiv_loader import PaperRenderInProgress
+from arxiv_loader import get_listing_url, parse_listing_ids
+from http_client import HttpClient
+from hedged_fetch import DEFAULT_HEDGE_DELAY, describe_error, fetch_paper_hedged
+from metadata_store import MetadataStore
+from token_counter import LazyEncoder
+from batch_read_papers import StageStats
+from cli_options import (
+    compact_option,
+    force_refresh_option,
+    max_parsers_option,
+    render_timeout_option,
+    source_options,
+)
+from read_paper import (
+    FETCH_STATS_PATH,
+    METADATA_STORE_PATH,
+    extract_paper_content,
+    get_paper_urls,
+    load_or_fetch_text,
+    prepare_prompt,
+)
+
+logger = logging.getLogger(__name__)
+
+# The minimum time between the start of two downloads, in seconds. Papers
+# are prefetched ahead of demand, so there is no hurry.
+DEFAULT_DELAY = 3.0
+
+# How long a paper that is still rendering is fetched again, and how often
+DEFAULT_RENDER_TIMEOUT = 1800
+DEFAULT_RETRY_INTERVAL = 120
+
+# e.g. cs.CL, math, hep-th
+_CATEGORY_RE = re.compile(r"[a-z-]+(\.[A-Za-z-]+)?")
+
+
+class Prefetcher:
+    """
+    Warms the caches with the papers users are likely to ask for, e.g. the new
+    submissions of a category, so that their requests start at the LLM stage.
+
+    Every paper is downloaded, parsed, reduced, compacted and tokenized as
+    read_paper and batch_read_papers would, and stored in the same caches
+    (HTML, text, compacted text, token counts and metadata), with the same
+    options. Downloads start at least `delay` seconds apart. A paper that is
+    still rendering does not hold a download slot: it is fetched again every
+    `retry_interval` seconds, for up to `render_timeout` seconds.
+    """
+
+    def __init__(
+        self,
+        max_downloads=2,
+        max_parsers=None,
+        delay=DEFAULT_DELAY,
+        keep_ref=False,
+        keep_app=False,
+        keep_latex=False,
+        use_ar5iv=False,
+        auto_source=False,
+        hedge_delay=DEFAULT_HEDGE_DELAY,
+        parser="html5lib",
+        force_refresh=False,
+        render_timeout=DEFAULT_RENDER_TIMEOUT,
+        retry_interval=DEFAULT_RETRY_INTERVAL,
+        compact=False,
+    ):
+        self.max_downloads = max_downloads
+        self.max_parsers = max_parsers
+        self.delay = delay
+        self.keep_ref = keep_ref
+        self.keep_app = keep_app
+        self.keep_latex = keep_latex
+        self.use_ar5iv = use_ar5iv
+        self.auto_source = auto_source
+        self.hedge_delay = hedge_delay
+        self.parser = parser
+        self.force_refresh = force_refresh
+        self.render_timeout = render_timeout
+        self.retry_interval = retry_interval
+        self.compact = compact
+
+        self.enc = LazyEncoder()
+        self.metadata_store = MetadataStore(METADATA_STORE_PATH)
+        # the papers prefetched by this process, skipped by the next rounds
+        self.done = set()
+        self.cached = 0
+        self.stats = {
+            "fetch": StageStats("fetch", max_downloads),
+            "parse": StageStats("parse", max_parsers or 1),
+            "tokenize": StageStats("tokenize", 1),
+        }
+
+    async def _run_stage(self, name, coro):
+        start = time.perf_counter()
+        ok = False
+        try:
+            result = await coro
+            ok = True
+            return result
+        finally:
+            self.stats[name].record(start, time.perf_counter(), ok=ok)
+
+    async def _in_executor(self, executor, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, func, *args)
+
+    @contextlib.asynccontextmanager
+    async def open(self):
+        """
+        Starts the HTTP client and the worker pools, and stops them when the
+        block exits.
+        """
+        self._download_sem = asyncio.Semaphore(self.max_downloads)
+        self._rate_lock = asyncio.Lock()
+        self._next_download = 0.0
+        async with HttpClient(limit_per_host=self.max_downloads) as http:
+            with ProcessPoolExecutor(
+                self.max_parsers
+            ) as parse_pool, ThreadPoolExecutor(1) as tokenize_pool:
+                self._http = http
+                self._parse_pool = parse_pool
+                self._tokenize_pool = tokenize_pool
+                yield self
+
+    async def read_listing(self, listing):
+        """
+        Returns the arXiv IDs of a listing: a category (its new submissions,
+        see get_listing_url), the URL of a listing page or feed, a file, or
+        "-" for stdin. See parse_listing_ids for the formats.
+
+        Raises:
+        ValueError: If the listing is neither a URL, a file nor a category
+        """
+        if listing == "-":
+            return parse_listing_ids(sys.stdin.read())
+        if "://" not in listing:
+            path = Path(listing)
+            if path.exists():
+                return parse_listing_ids(path.read_text(encoding="utf-8"))
+            if not _CATEGORY_RE.fullmatch(listing):
+                raise ValueError(f"{listing} is not a URL, a file or a category")
+            listing = get_listing_url(listing)
+        response = await self._http.get(listing)
+        response.raise_for_status()
+        return parse_listing_ids(response.text)
+
+    async def _wait_turn(self):
+        # the downloads start at least `delay` seconds apart
+        async with self._rate_lock:
+            loop = asyncio.get_running_loop()
+            wait = self._next_download - loop.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self._next_download = loop.time() + self.delay
+
+    async def _fetch(self, arxiv_id, paper_urls):
+        """
+        Fetches the HTML of a paper, fetching it again later while it is
+        rendering. The first request also starts the render.
+
+        Returns:
+        source (str): The source that was used
+        html_path (Path): The path of the cached HTML file
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.render_timeout
+        while True:
+            async with self._download_sem:
+                await self._wait_turn()
+                try:
+                    return await self._run_stage(
+                        "fetch",
+                        fetch_paper_hedged(
+                            paper_urls,
+                            self._http,
+                            hedge_delay=self.hedge_delay,
+                            force_refresh=self.force_refresh,
+                            render_timeout=0,
+                            stats_path=FETCH_STATS_PATH,
+                            arxiv_id=arxiv_id,
+                        ),
+                    )
+                except PaperRenderInProgress:
+                    if loop.time() + self.retry_interval > deadline:
+                        raise
+            logger.info(
+                f"Paper {arxiv_id} is rendering, fetching it again in "
+                f"{self.retry_interval:.0f}s"
+            )
+            await asyncio.sleep(self.retry_interval)
+
+    async def _extract(self, html_path, source):
+        return await self._run_stage(
+            "parse",
+            self._in_executor(
+                self._parse_pool,
+                extract_paper_content,
+                html_path,
+                self.keep_ref,
+                self.keep_app,
+                self.keep_latex,
+                self.parser,
+                source,
+            ),
+        )
+
+    async def prefetch(self, arxiv_id):
+        """
+        Caches the HTML, the text and the token counts of a paper.
+
+        Returns:
+        "cached" if the text was already cached, otherwise "fetched"
+        """
+        paper_urls = get_paper_urls(
+            arxiv_id, use_ar5iv=self.use_ar5iv, auto_source=self.auto_source
+        )
+        options = (self.keep_ref, self.keep_app, self.keep_latex)
+        text_key, paper_content, sections, cached = await load_or_fetch_text(
+            paper_urls,
+            functools.partial(self._fetch, arxiv_id, paper_urls),
+            self._extract,
+            *options,
+            force_refresh=self.force_refresh,
+            arxiv_id=arxiv_id,
+        )
+
+        # the counts of a cached text are only computed if they are missing
+        await self._run_stage(
+            "tokenize",
+            self._in_executor(
+                self._tokenize_pool,
+                prepare_prompt,
+                text_key,
+                paper_content,
+                sections,
+                self.enc,
+                self.compact,
+                arxiv_id,
+                self.keep_latex,
+            ),
+        )
+        return "cached" if cached else "fetched"
+
+    async def _prefetch_safe(self, arxiv_id):
+        try:
+            outcome = await self.prefetch(arxiv_id)
+        except Exception as e:
+            error = describe_error(e)
+            logger.error(f"Paper {arxiv_id}: {error}")
+            return arxiv_id, error
+        if outcome == "cached":
+            self.cached += 1
+        else:
+            logger.info(f"Prefetched {arxiv_id}")
+        self.done.add(arxiv_id)
+        return arxiv_id, None
+
+    async def _load_metadata(self, arxiv_ids):
+        try:
+            await self.metadata_store.load_many_async(arxiv_ids, self._http)
+        except Exception as e:
+            logger.error(f"Cannot fetch the metadata of the listing: {e}")
+
+    async def run_once(self, listings):
+        """
+        Prefetches the papers of the listings that were not prefetched yet,
+        in the order of the listings. The pipeline must be open.
+
+        Returns:
+        results (dict): arxiv_id -> error (None on success)
+        """
+        arxiv_ids = []
+        for listing in listings:
+            try:
+                listing_ids = await self.read_listing(listing)
+            except Exception as e:
+                logger.error(f"Cannot read the listing {listing}: {describe_error(e)}")
+                continue
+            for arxiv_id in listing_ids:
+                if arxiv_id not in self.done and arxiv_id not in arxiv_ids:
+                    arxiv_ids.append(arxiv_id)
+        if not arxiv_ids:
+            return {}
+        logger.info(f"Prefetching {len(arxiv_ids)} papers")
+
+        # the metadata of all papers is fetched in bulk, while the papers are
+        # downloaded
+        metadata = asyncio.ensure_future(self._load_metadata(arxiv_ids))
+        results = await asyncio.gather(
+            *(self._prefetch_safe(arxiv_id) for arxiv_id in arxiv_ids)
+        )
+        await metadata
+        return dict(results)
+
+    async def run(self, listings, watch=0):
+        """
+        Prefetches the papers of the listings. With watch, reads the listings
+        again every watch seconds and prefetches the new papers, until
+        cancelled.
+
+        Returns:
+        results (dict): arxiv_id -> error (None on success), of the last round
+        """
+        async with self.open():
+            while True:
+                results = await self.run_once(listings)
+                if not watch:
+                    return results
+                logger.info(f"Reading the listings again in {watch}s")
+                await asyncio.sleep(watch)
+
+    def report(self):
+        return "\n".join(stats.report() for stats in self.stats.values())
+
+
+@click.command()
+@click.argument("listings", nargs=-1)
+@click.option(
+    "--watch",
+    default=0,
+    show_default=True,
+    help="Read the listings again every this many seconds and prefetch the new papers. 0 to prefetch once and exit.",
+)
+@click.option(
+    "--delay",
+    default=DEFAULT_DELAY,
+    show_default=True,
+    help="The minimum time between the start of two downloads, in seconds.",
+)
+@click.option(
+    "--max-downloads",
+    default=2,
+    show_default=True,
+    help="Maximum number of concurrent downloads.",
+)
+@max_parsers_option
+@source_options
+@force_refresh_option
+@render_timeout_option(DEFAULT_RENDER_TIMEOUT)
+@click.option(
+    "--retry-interval",
+    default=DEFAULT_RETRY_INTERVAL,
+    show_default=True,
+    help="The time between two fetches of a paper that is still rendering, in seconds.",
+)
+@compact_option
+def main(listings, watch, **options):
+    """
+    Downloads, parses and tokenizes the papers of LISTINGS ahead of demand, so
+    that read_paper.py, batch_read_papers.py and the server find them in the
+    cache.
+
+    A listing is an arXiv category (its new submissions, e.g. cs.CL), the URL
+    of a listing page or an RSS/Atom feed, or a file of arXiv IDs or listing
+    HTML. Defaults to the arXiv IDs on stdin.
+    """
+    pipeline = Prefetcher(**options)
+    start = time.perf_counter()
+    try:
+        results = asyncio.run(pipeline.run(listings or ["-"], watch=watch))
+    except KeyboardInterrupt:
+        results = {}
+    elapsed = time.perf_counter() - start
+
+    failed = {k: v for k, v in results.items() if v is not None}
+    logger.info(
+        f"Prefetched {len(results) - len(failed)}/{len(results)} papers "
+        f"({pipeline.cached} already cached) in {elapsed:.2f}s"
+    )
+    logger.info("Per-stage throughput:\n" + pipeline.report())
+    for arxiv_id, error in failed.items():
+        logger.error(f"Failed {arxiv_id}: {error}")
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
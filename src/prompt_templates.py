@@ -0,0 +1,91 @@
+import os
+import re
+import functools
+from pathlib import Path
+
+# current file path
+_CURRENT_DIR = Path(os.path.dirname(os.path.realpath(__file__)))
+PROMPTS_DIR = _CURRENT_DIR / "prompts"
+
+
+# templates are read once per process, the server keeps them in memory
+@functools.lru_cache(maxsize=None)
+def load_template(name):
+    return open(PROMPTS_DIR / name, "r").read()
+
+
+def _select_questions(tpl, questions):
+    """
+    Removes the question lines of the template whose number is not in
+    questions, e.g. {1, 2, 3}.
+    """
+
+    def keep(match):
+        return match.group(0) if int(match.group(1)) in questions else ""
+
+    return re.sub(r"^Q(\d+):.*\n", keep, tpl, flags=re.MULTILINE)
+
+
+def make_paper_query(paper_content, questions=None):
+    """
+    Returns the paper_query.tpl prompt. If questions (a collection of question
+    numbers) is given, only these questions are asked.
+    """
+    tpl = load_template("paper_query.tpl")
+    if questions is not None:
+        tpl = _select_questions(tpl, set(questions))
+    return tpl.format(paper_content=paper_content)
+
+
+def make_messages(paper_content, questions=None):
+    return [
+        {"role": "system", "content": load_template("paper_system.tpl")},
+        {"role": "user", "content": make_paper_query(paper_content, questions)},
+    ]
+
+
+def get_paper_questions():
+    """
+    Returns the questions asked in paper_query.tpl, e.g. ["Q1: What is ...", ...].
+    """
+    tpl = load_template("paper_query.tpl")
+    return re.findall(r"^Q\d+:.*$", tpl, flags=re.MULTILINE)
+
+
+def make_ask_messages(question, excerpts, num_papers, history=()):
+    """
+    Returns the ask.tpl messages answering a question from paper excerpts.
+
+    Parameters:
+    question (str): The question
+    excerpts (str): The formatted excerpts of the papers
+    num_papers (int): The number of papers the excerpts come from
+    history (list of (str, str)): The previous questions and answers, sent
+    before the question so that follow-up questions can refer to them
+    """
+    messages = [{"role": "system", "content": load_template("paper_system.tpl")}]
+    for previous_question, previous_answer in history:
+        messages.append({"role": "user", "content": previous_question})
+        messages.append({"role": "assistant", "content": previous_answer})
+    query = load_template("ask.tpl").format(
+        num_papers=num_papers, excerpts=excerpts, question=question
+    )
+    messages.append({"role": "user", "content": query})
+    return messages
+
+
+def make_update_messages(previous_answers, changed_sections):
+    """
+    Returns the paper_update.tpl messages, which update the answers to the
+    questions of paper_query.tpl from the sections that changed in a new
+    version of a paper.
+    """
+    query = load_template("paper_update.tpl").format(
+        previous_answers=previous_answers.strip(),
+        changed_sections=changed_sections,
+        questions="\n".join(get_paper_questions()),
+    )
+    return [
+        {"role": "system", "content": load_template("paper_system.tpl")},
+        {"role": "user", "content": query},
+    ]
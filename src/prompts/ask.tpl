@@ -0,0 +1,12 @@
+The following are excerpts of {num_papers} paper(s) from arXiv, selected as the most relevant to the question. Each excerpt starts with the arXiv ID and the title of its paper, and the section it comes from.
+
+{excerpts}
+----
+According to the excerpts, please answer the following question:
+
+{question}
+
+Note:
+1. Only use information from the excerpts. If they don't contain the answer, say so - never make one up!
+2. Cite the arXiv IDs of the papers you use, e.g. [2303.01469].
+3. Format your answer using Markdown style formatting. You must use LaTeX for mathematical equations, $E=mc^2$ for inline equations and $$y = \sum x$$ for block equations.
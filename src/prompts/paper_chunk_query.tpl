@@ -0,0 +1,13 @@
+The following is part {part_index} of {num_parts} of a paper. The paper is too long to be read at once, so it is read part by part.
+
+{paper_content}
+----
+Take notes on this part of the paper. The notes will be combined with the notes on the other parts to answer the following questions about the whole paper:
+
+{questions}
+
+Note:
+1. Only use information from this part of the paper. If this part is not relevant to a question, skip the question.
+2. Keep all the details that are needed to answer the questions: methods, equations, datasets, baselines, numbers in results and tables, limitations and links to resources.
+3. Be concise, the notes on all parts together should be much shorter than the paper.
+4. Format your notes using Markdown style formatting. You must use LaTeX for mathematical equations.
@@ -0,0 +1,3 @@
+The paper is too long to be read at once, so it was read in {num_parts} parts. The following are the notes taken on each part, in order.
+
+{notes}
@@ -0,0 +1,16 @@
+The following are the answers to questions about a paper, written for a previous version of the paper. A new version of the paper was published, and the sections below changed.
+
+## Previous answers
+{previous_answers}
+
+## Changed sections of the new version
+{changed_sections}
+----
+Update the previous answers according to the changed sections, and write all the answers again in the same format. The questions are:
+
+{questions}
+
+Note:
+1. Keep the parts of the answers that are not affected by the changes as they are.
+2. Make sure that the numbers, tables, methods and conclusions in the answers match the new version, and drop what was removed from the paper.
+3. Don't mention that the paper or the answers were updated.
@@ -1,23 +1,58 @@
 import os
-import sys
 import hashlib
 import logging
 import asyncio
+import functools
+import contextvars
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 import click
-import tiktoken
 
-from llm import create_stream, make_chatml
+from llm import (
+    DEFAULT_MODEL,
+    create_stream,
+    get_usage,
+    fetch_response_with_streaiming,
+    set_response_cache,
+)
+from llm_cache import ResponseCache
+from endpoints import configure_endpoints
 from arxiv_loader import (
-    fetch_metainfo,
-    fetch_paper_html,
-    parse_paper_content,
+    get_paper_cache,
+    parse_paper_sections,
     reduce_paper_content,
 )
 from arxiv_loader import PaperFailedToRender, PaperRenderInProgress, PaperNotFound
 
-from codimd_client import get_codimd_client
+from codimd_client import DEFAULT_UPDATE_INTERVAL, StreamingNote, get_codimd_client
+from http_client import HttpClient
+from hedged_fetch import DEFAULT_HEDGE_DELAY, PAPER_SOURCES, fetch_paper_hedged
+from prompt_templates import load_template, make_messages
+from metadata_store import DEFAULT_MAX_AGE, MetadataStore
+from text_cache import get_text_cache_key, load_paper_text, save_paper_text
+from compaction import compact_paper, format_report
+from map_reduce import DEFAULT_CHUNK_TOKENS, plan_chunks, summarize_chunked
+from fanout import get_question_groups, summarize_fanout
+from incremental import (
+    MIN_CHANGED_WORDS,
+    is_paper_updated,
+    load_snapshot,
+    plan_update,
+    save_snapshot,
+)
+from token_counter import LazyEncoder, count_tokens, get_paper_tokens
+from tracing import Tracer, set_tracer, span, trace
+from cli_options import (
+    compact_option,
+    endpoint_options,
+    force_refresh_option,
+    metrics_file_option,
+    render_timeout_option,
+    source_options,
+    summary_options,
+    trace_file_option,
+)
 
 logging.basicConfig(
     level=logging.INFO, format="%(levelname)s [%(filename)s]: %(message)s"
@@ -26,98 +61,541 @@ logger = logging.getLogger(__name__)
 
 # current file path
 _CURRENT_DIR = Path(os.path.dirname(os.path.realpath(__file__)))
-PROMPTS_DIR = _CURRENT_DIR / "prompts"
 TEXT_CACHE_DIR = _CURRENT_DIR / ".cached"
 TEXT_CACHE_DIR.mkdir(exist_ok=True)
+LLM_CACHE_DIR = TEXT_CACHE_DIR / "llm"
+METADATA_STORE_PATH = TEXT_CACHE_DIR / "metadata.sqlite3"
+FETCH_STATS_PATH = TEXT_CACHE_DIR / "fetch_stats.jsonl"
+
+MAX_PROMPT_TOKENS = 26_000
+
 
+def get_paper_url(arxiv_id, use_ar5iv=False):
+    if use_ar5iv:
+        return f"https://ar5iv.labs.arxiv.org/html/{arxiv_id}"
+    # default to arxiv-vanity
+    return f"https://www.arxiv-vanity.com/papers/{arxiv_id}/"
 
-def make_paper_query(paper_content):
-    tpl = open(PROMPTS_DIR / "paper_query.tpl", "r").read()
-    return tpl.format(paper_content=paper_content)
 
+def get_url_hash(paper_url):
+    return str(hashlib.sha256(paper_url.encode("utf-8")).hexdigest())
+
+
+def get_paper_source(use_ar5iv=False):
+    return "ar5iv" if use_ar5iv else "arxiv-vanity"
+
+
+def get_paper_urls(arxiv_id, use_ar5iv=False, auto_source=False):
+    """
+    Returns the (source, url) pairs a paper is fetched from, the preferred
+    source first. Without auto_source only the preferred source is used.
+    """
+    preferred = get_paper_source(use_ar5iv)
+    sources = [preferred]
+    if auto_source:
+        sources += [source for source in PAPER_SOURCES if source != preferred]
+    return [
+        (source, get_paper_url(arxiv_id, use_ar5iv=source == "ar5iv"))
+        for source in sources
+    ]
+
+
+def get_source_text_key(paper_url, keep_ref=False, keep_app=False, keep_latex=False):
+    return get_text_cache_key(
+        get_url_hash(paper_url),
+        keep_ref=keep_ref,
+        keep_app=keep_app,
+        keep_latex=keep_latex,
+    )
+
+
+def load_cached_text(paper_urls, keep_ref=False, keep_app=False, keep_latex=False):
+    """
+    Returns (source, paper_content, sections) from the text cache of the first
+    source that has the paper, or None.
+    """
+    for source, paper_url in paper_urls:
+        text_key = get_source_text_key(paper_url, keep_ref, keep_app, keep_latex)
+        cached_text = load_paper_text(get_paper_cache(), text_key)
+        if cached_text is not None:
+            return (source, *cached_text)
+    return None
+
+
+async def fetch_html(
+    paper_urls,
+    force_refresh=False,
+    render_timeout=0,
+    hedge_delay=DEFAULT_HEDGE_DELAY,
+    arxiv_id=None,
+):
+    """
+    Fetches and caches the HTML file of a single paper from the first source
+    that renders it, waiting up to render_timeout seconds for it to render.
+
+    Returns:
+    source (str): The source that was used
+    html_path (Path): The path of the cached HTML file
+    """
+    async with HttpClient() as client:
+        return await fetch_paper_hedged(
+            paper_urls,
+            client,
+            hedge_delay=hedge_delay,
+            force_refresh=force_refresh,
+            render_timeout=render_timeout,
+            stats_path=FETCH_STATS_PATH,
+            arxiv_id=arxiv_id,
+        )
+
+
+def extract_paper_content(
+    html_path,
+    keep_ref=False,
+    keep_app=False,
+    keep_latex=False,
+    parser="html5lib",
+    source="default",
+):
+    """
+    Parses and reduces the paper content from a cached HTML file.
+
+    Kept at module level so that it can be sent to a process pool.
+
+    Returns:
+    paper_content (str): The reduced text content of the paper
+    sections (list of str): The reduced text of each section, used when the
+    paper is too long to be summarized at once
+    """
+    sections = parse_paper_sections(
+        html_path,
+        keep_latex=keep_latex,
+        remove_references=not keep_ref,
+        remove_appendix=not keep_app,
+        backend=parser,
+    )
+    with span("reduce", source=source):
+        paper_content = reduce_paper_content(iter(sections), source=source)
+        sections = [
+            reduce_paper_content(section, source=source) for section in sections
+        ]
+    return paper_content, [section for section in sections if section]
+
+
+def format_metadata(metadata):
+    """
+    Formats the arXiv metadata as the markdown block used in the summary.
+
+    Returns:
+    paper_title (str): The title of the paper
+    arxiv_metadata (str): The formatted metadata
+    """
+    paper_title = metadata["title"]
+    arxiv_metadata = f"**Authors**: {', '.join(metadata['authors'])}\n"
+    arxiv_metadata += f"**Updated Dates**: {metadata['updated']}\n"
+    arxiv_metadata += f"**Published Dates**: {metadata['published']}\n"
+    arxiv_metadata += f"**Categories**: {', '.join(metadata['categories'])}\n"
+    arxiv_metadata += f"**Abstract**: {metadata['abstract']}\n"
+
+    arxiv_metadata = "----\n## Metadata\n" + arxiv_metadata
+    return paper_title, arxiv_metadata
+
+
+def make_summary(
+    arxiv_id,
+    content,
+    num_prompt_tokens,
+    num_generated_tokens,
+    paper_title=None,
+    arxiv_metadata="",
+):
+    if paper_title is None:
+        paper_title = f"Paper {arxiv_id}"
+    summary_tpl = load_template("summary.tpl")
+    return summary_tpl.format(
+        paper_title=paper_title,
+        paper_arxiv_id=arxiv_id,
+        num_prompt_tokens=num_prompt_tokens,
+        num_generated_tokens=num_generated_tokens,
+        arxiv_metadata=arxiv_metadata,
+        content=content,
+    )
+
+
+def save_summary(url_hash, summary, arxiv_id=None):
+    """
+    Saves a summary in the paper cache, uncompressed so that it can be read
+    directly, and returns its path.
+    """
+    return get_paper_cache().put(
+        url_hash, "summary", summary, arxiv_id=arxiv_id, compress=False
+    )
+
+
+def compact_text(text_key, sections, enc, arxiv_id=None, keep_latex=False):
+    """
+    Compacts the reduced text of a paper to fit in MAX_PROMPT_TOKENS if it
+    can (see compaction.py), and logs the tokens saved by each rule. The LaTeX
+    of the formulas is left as it is with keep_latex.
+
+    Returns:
+    paper_content (str): The compacted text content of the paper
+    sections (list of str): The compacted text of each section
+    """
+    with span("compact") as s:
+        paper_content, sections, report = compact_paper(
+            get_paper_cache() if text_key else None,
+            text_key,
+            sections,
+            enc,
+            max_prompt_tokens=MAX_PROMPT_TOKENS,
+            arxiv_id=arxiv_id,
+            keep_latex=keep_latex,
+        )
+        s.set(saved=report["saved"], pruned=report["pruned"])
+    if any(report["saved"].values()):
+        logger.info(f"Compaction saved {format_report(report)}")
+    return paper_content, sections
+
+
+async def load_or_fetch_text(
+    paper_urls,
+    fetch,
+    extract,
+    keep_ref=False,
+    keep_app=False,
+    keep_latex=False,
+    force_refresh=False,
+    arxiv_id=None,
+):
+    """
+    Loads the reduced text of a paper from the text cache, or fetches, extracts
+    and caches it. read_paper, batch_read_papers and prefetch each fetch and
+    parse in their own way, and pass it as fetch and extract.
+
+    Parameters:
+    paper_urls (list of tuple): The (source, url) of the paper, see
+    get_paper_urls
+    fetch (callable): Called without arguments when the text is not cached,
+    returns an awaitable of the source and the path of the HTML file
+    extract (callable): Called with the path of the HTML file and its source,
+    returns an awaitable of the text content and the sections
+    force_refresh (bool): If True, the cached text is not used
+
+    Returns:
+    text_key (str): The key of the text in the paper cache
+    paper_content (str): The text content of the paper
+    sections (list of str): The text of each section
+    cached (bool): True if the text was cached
+
+    Raises:
+    PaperNotFound, PaperRenderInProgress, PaperFailedToRender: As fetch
+    """
+    options = (keep_ref, keep_app, keep_latex)
+    cached_text = None
+    if not force_refresh:
+        cached_text = load_cached_text(paper_urls, *options)
+
+    if cached_text is not None:
+        source, paper_content, sections = cached_text
+    else:
+        source, html_path = await fetch()
+        paper_content, sections = await extract(html_path, source)
+
+    text_key = get_source_text_key(dict(paper_urls)[source], *options)
+    if cached_text is None:
+        text_path = save_paper_text(
+            get_paper_cache(),
+            text_key,
+            paper_content,
+            sections,
+            arxiv_id=arxiv_id,
+            source=source,
+        )
+        logger.info(f"Saved text file to {text_path}")
+    return text_key, paper_content, sections, cached_text is not None
+
+
+def prepare_prompt(
+    text_key,
+    paper_content,
+    sections,
+    enc,
+    compact=False,
+    arxiv_id=None,
+    keep_latex=False,
+):
+    """
+    Compacts the text of a paper (see compact_text) and makes its prompt.
+
+    Parameters:
+    text_key (str): The key of the text in the paper cache, or None if the
+    text is not cached
+    compact (bool): If False, the text is used as it is
+    keep_latex (bool): Whether the text has the LaTeX of the formulas, which
+    compaction then leaves as it is
+
+    Returns:
+    paper_content (str): The text content the prompt is made of
+    sections (list of str): The text of each section
+    messages (list): The messages of the prompt
+    token_counts (dict): The token counts, see get_paper_tokens
+    """
+    if compact:
+        paper_content, sections = compact_text(
+            text_key, sections, enc, arxiv_id=arxiv_id, keep_latex=keep_latex
+        )
+    with span("tokenize"):
+        messages = make_messages(paper_content)
+
+        # the token counts are cached with the text, so a paper read again is
+        # not encoded again
+        token_counts = get_paper_tokens(
+            get_paper_cache() if text_key else None,
+            text_key,
+            paper_content,
+            sections,
+            enc,
+            arxiv_id=arxiv_id,
+        )
+    return paper_content, sections, messages, token_counts
+
+
+async def run_llm(
+    paper_content,
+    sections,
+    messages,
+    token_counts,
+    enc,
+    update_messages=None,
+    num_update_tokens=0,
+    chunk_tokens=DEFAULT_CHUNK_TOKENS,
+    question_groups=None,
+    echo=True,
+    on_content=None,
+):
+    """
+    Generates the summary of a paper, as prepared by prepare_prompt: an update
+    of the previous summary if update_messages is set (see plan_update), in
+    chunks if the prompt is longer than MAX_PROMPT_TOKENS (see map_reduce.py),
+    with one call per question group if question_groups is set (see
+    fanout.py), or with a single call.
 
-async def fetch_response_with_streaiming(stream):
-    stream = await stream
-    content = ""
+    Parameters:
+    update_messages (list): The messages of the update pass, or None
+    num_update_tokens (int): The length of the update prompt
+    echo (bool): If True, the summary is printed while it is generated
+    on_content (callable): Called with each piece of the summary while it is
+    generated, or None
+
+    Returns:
+    content (str): The summary
+    num_prompt_tokens (int): The number of prompt tokens of all calls
+    num_generated_tokens (int): The number of generated tokens of all calls
+
+    Raises:
+    ValueError: If the paper cannot be split in chunks that fit in a prompt
+    """
+    num_prompt_tokens = token_counts["prompt"]
+    if update_messages is not None:
+        with span("llm", incremental=True) as s:
+            num_prompt_tokens = num_update_tokens
+            stream = create_stream(
+                messages=update_messages, prompt_tokens=num_prompt_tokens
+            )
+            content = await fetch_response_with_streaiming(
+                stream, echo=echo, on_content=on_content
+            )
+            num_generated_tokens = count_tokens(content, enc)
+            s.set(**get_usage(DEFAULT_MODEL, num_prompt_tokens, num_generated_tokens))
+    elif num_prompt_tokens > MAX_PROMPT_TOKENS:
+        with span("llm", chunked=True) as s:
+            content, num_prompt_tokens, num_generated_tokens = await summarize_chunked(
+                sections,
+                enc,
+                max_chunk_tokens=chunk_tokens,
+                max_prompt_tokens=MAX_PROMPT_TOKENS,
+                echo=echo,
+                on_content=on_content,
+                question_groups=question_groups,
+                section_tokens=token_counts["sections"],
+            )
+            s.set(**get_usage(DEFAULT_MODEL, num_prompt_tokens, num_generated_tokens))
+    elif question_groups:
+        with span("llm", groups=len(question_groups)) as s:
+            content, num_prompt_tokens, num_generated_tokens = await summarize_fanout(
+                paper_content,
+                enc,
+                question_groups,
+                echo=echo,
+                on_content=on_content,
+                paper_tokens=token_counts["paper_content"],
+            )
+            s.set(**get_usage(DEFAULT_MODEL, num_prompt_tokens, num_generated_tokens))
+    else:
+        with span("llm") as s:
+            stream = create_stream(messages=messages, prompt_tokens=num_prompt_tokens)
+            content = await fetch_response_with_streaiming(
+                stream, echo=echo, on_content=on_content
+            )
+            num_generated_tokens = count_tokens(content, enc)
+            s.set(**get_usage(DEFAULT_MODEL, num_prompt_tokens, num_generated_tokens))
+    return content, num_prompt_tokens, num_generated_tokens
+
+
+def open_streaming_note(codimd_client, arxiv_id, metadata_future, interval):
+    """
+    Publishes a note with the metadata of the paper, to be filled in while the
+    summary is generated.
+
+    Parameters:
+    codimd_client (CodimdClient): The client to publish with
+    arxiv_id (str): arXiv ID of the paper
+    metadata_future (Future): The metadata being fetched
+    interval (float): The minimum time between two updates of the note
+
+    Returns:
+    note (StreamingNote): The published note
+    metadata (dict): The metadata, or None if it could not be fetched
+    paper_title (str): The formatted title
+    arxiv_metadata (str): The formatted metadata
+    """
+    metadata, paper_title, arxiv_metadata = None, None, ""
     try:
-        async for c in stream:
-            if not c["choices"][0]["finish_reason"]:
-                if "role" in c["choices"][0]["delta"]:
-                    pass
-                if "content" in c["choices"][0]["delta"]:
-                    print(c["choices"][0]["delta"]["content"], end="")
-                    sys.stdout.flush()
-                    content += c["choices"][0]["delta"]["content"]
+        metadata = metadata_future.result()
+        paper_title, arxiv_metadata = format_metadata(metadata)
     except Exception as e:
         logger.error(e)
-    finally:
-        print("")
-        return content
+    note = StreamingNote(
+        codimd_client,
+        make_summary(arxiv_id, "", 0, 0, paper_title, arxiv_metadata),
+        interval=interval,
+    )
+    logger.info(f"Publishing summary to {note.url} while it is generated")
+    return note, metadata, paper_title, arxiv_metadata
 
 
-@click.command()
-@click.argument("arxiv_id")
-@click.option(
-    "--dry-run",
-    is_flag=True,
-    help="If True, don't actually generate a summary. The paper will still be downloaded and cached, but no calls will be made to the LLM.",
-)
-@click.option(
-    "--keep-ref",
-    is_flag=True,
-    help="If True, keep the references in the paper before summarizing.",
-)
-@click.option(
-    "--keep-app",
-    is_flag=True,
-    help="If True, keep the appendices in the paper before summarizing.",
-)
-@click.option(
-    "--keep-latex",
-    is_flag=True,
-    help="If True, keep the LaTeX in the paper before summarizing, otherwise it will be converted to plain text.",
-)
-@click.option(
-    "--use-ar5iv", is_flag=True, help="If True, use ar5iv instead of arxiv-vanity."
-)
-@click.option(
-    "--force-refresh",
-    is_flag=True,
-    help="If True, force the paper to be refreshed, ignoring the cache.",
-)
-def main(
+def summarize_paper(
     arxiv_id,
     dry_run=False,
     keep_ref=False,
     keep_app=False,
     keep_latex=False,
     use_ar5iv=False,
+    auto_source=False,
+    hedge_delay=DEFAULT_HEDGE_DELAY,
+    parser="html5lib",
     force_refresh=False,
+    render_timeout=0,
+    chunked=True,
+    chunk_tokens=DEFAULT_CHUNK_TOKENS,
+    question_groups=None,
+    no_llm_cache=False,
+    incremental=False,
+    min_changed_words=MIN_CHANGED_WORDS,
+    stream_publish=False,
+    publish_interval=DEFAULT_UPDATE_INTERVAL,
+    compact=False,
 ):
+    """
+    Summarizes a paper and publishes the summary to CodiMD, see main for the
+    options. question_groups is the list of question groups answered
+    concurrently (see fanout.py), or None. Exits with 1 if the paper cannot be
+    fetched or summarized.
+    """
     # read arxiv id from command line
     arxiv_id = arxiv_id.strip()
 
-    enc = tiktoken.encoding_for_model("gpt-4")
+    set_response_cache(ResponseCache(LLM_CACHE_DIR, bypass=no_llm_cache))
+
+    # the encoder is built when a text that is not in the cache is counted
+    enc = LazyEncoder()
+
+    # fetch the metadata in the background, while the paper is fetched and
+    # the summary is generated
+    metadata_pool = ThreadPoolExecutor(max_workers=1)
+    metadata_future = None
+    if arxiv_id != "test":
+        metadata_store = MetadataStore(METADATA_STORE_PATH)
+        # the thread runs in a copy of the context, so that it is traced
+        context = contextvars.copy_context()
+        # incremental runs check whether the paper has a new version
+        metadata_future = metadata_pool.submit(
+            context.run,
+            metadata_store.load,
+            arxiv_id,
+            max_age=0 if incremental else DEFAULT_MAX_AGE,
+        )
+
+    metadata = None
+    paper_title, arxiv_metadata = None, ""
 
+    # the note is published with the metadata before the paper is fetched,
+    # and filled in while the summary is generated. Incremental runs wait
+    # for the plan, as a kept summary is not published again.
+    note = None
+    codimd_client = None if dry_run else get_codimd_client()
+    stream_note = stream_publish and codimd_client and metadata_future is not None
+    if stream_note and not incremental:
+        note, metadata, paper_title, arxiv_metadata = open_streaming_note(
+            codimd_client, arxiv_id, metadata_future, publish_interval
+        )
     if arxiv_id != "test":
         # fetch paper html
+        paper_urls = get_paper_urls(
+            arxiv_id, use_ar5iv=use_ar5iv, auto_source=auto_source
+        )
+        # the summary is named after the preferred source, whichever was used
+        url_hash = get_url_hash(paper_urls[0][1])
+        snapshot_key = get_source_text_key(
+            paper_urls[0][1], keep_ref, keep_app, keep_latex
+        )
+
+        snapshot = None
+        if incremental:
+            snapshot = load_snapshot(get_paper_cache(), snapshot_key)
+        if snapshot is not None:
+            try:
+                metadata = metadata_future.result()
+            except Exception as e:
+                logger.error(e)
+            # the cached HTML and text are the ones of the previous version
+            if is_paper_updated(snapshot, metadata):
+                logger.info(f"Paper {arxiv_id} has a new version, fetching it")
+                force_refresh = True
 
-        if use_ar5iv:
-            paper_url = f"https://ar5iv.labs.arxiv.org/html/{arxiv_id}"
-        else:
-            # default to arxiv-vanity
-            paper_url = f"https://www.arxiv-vanity.com/papers/{arxiv_id}/"
+        fetch = functools.partial(
+            fetch_html,
+            paper_urls,
+            force_refresh=force_refresh,
+            render_timeout=render_timeout,
+            hedge_delay=hedge_delay,
+            arxiv_id=arxiv_id,
+        )
 
-        url_hash = str(hashlib.sha256(paper_url.encode("utf-8")).hexdigest())
-        text_path = TEXT_CACHE_DIR / f"{url_hash}.txt"
+        async def extract(html_path, source):
+            with span("extract"):
+                return extract_paper_content(
+                    html_path,
+                    keep_ref=keep_ref,
+                    keep_app=keep_app,
+                    keep_latex=keep_latex,
+                    parser=parser,
+                    source=source,
+                )
 
         try:
-            html_path = fetch_paper_html(paper_url, force_refresh=force_refresh)
-            paper_content = parse_paper_content(
-                html_path,
-                keep_latex=keep_latex,
-                remove_references=not keep_ref,
-                remove_appendix=not keep_app,
+            text_key, paper_content, sections, _ = asyncio.run(
+                load_or_fetch_text(
+                    paper_urls,
+                    fetch,
+                    extract,
+                    keep_ref=keep_ref,
+                    keep_app=keep_app,
+                    keep_latex=keep_latex,
+                    force_refresh=force_refresh,
+                    arxiv_id=arxiv_id,
+                )
             )
         except PaperNotFound:
             logger.error(f"Paper {arxiv_id} not found")
@@ -128,73 +606,178 @@ def main(
         except PaperFailedToRender:
             logger.error(f"Paper {arxiv_id} failed to render")
             exit(1)
-
-        paper_content = reduce_paper_content(paper_content)
-        text_path.write_text(paper_content)
-        logging.info(f"Saved text file to {text_path}")
     else:
         url_hash = "test"
         paper_content = "Hello!"
+        sections = [paper_content]
+        snapshot = None
+        text_key = None
 
-    messages = [
-        {"role": "system", "content": open(PROMPTS_DIR / "paper_system.tpl", "r").read()},
-        {"role": "user", "content": make_paper_query(paper_content)},
-    ]
-
-    prompt = make_chatml(messages)
+    paper_content, sections, messages, token_counts = prepare_prompt(
+        text_key,
+        paper_content,
+        sections,
+        enc,
+        compact=compact,
+        arxiv_id=arxiv_id,
+        keep_latex=keep_latex,
+    )
+    num_prompt_tokens = token_counts["prompt"]
+    logger.info(f"Prompt length: {num_prompt_tokens} tokens")
 
-    tokens = enc.encode(prompt)
-    logger.info(f"Prompt length: {len(tokens)} tokens")
+    action, update_messages, num_update_tokens = "full", None, 0
+    if snapshot is not None:
+        action, update_messages, num_update_tokens = plan_update(
+            snapshot,
+            sections,
+            enc,
+            max_prompt_tokens=MAX_PROMPT_TOKENS,
+            min_changed_words=min_changed_words,
+        )
+    if stream_note and incremental and action != "reuse":
+        note, metadata, paper_title, arxiv_metadata = open_streaming_note(
+            codimd_client, arxiv_id, metadata_future, publish_interval
+        )
 
-    if len(tokens) > 26_000:
-        logger.error(f"Prompt too long: {len(tokens)}")
+    too_long = num_prompt_tokens > MAX_PROMPT_TOKENS
+    if too_long and not chunked and action == "full":
+        logger.error(f"Prompt too long: {num_prompt_tokens}")
         exit(1)
+    if note is not None:
+        note.header = make_summary(
+            arxiv_id, "", num_prompt_tokens, 0, paper_title, arxiv_metadata
+        )
 
-    if not dry_run:
-        stream = create_stream(messages=messages)
-        content = asyncio.run(fetch_response_with_streaiming(stream))
-    else:
+    if action == "reuse":
+        content = snapshot["content"]
+        num_prompt_tokens = snapshot["num_prompt_tokens"]
+        num_generated_tokens = snapshot["num_generated_tokens"]
+    elif dry_run:
+        if too_long:
+            chunks = plan_chunks(
+                sections,
+                enc,
+                max_tokens=chunk_tokens,
+                section_tokens=token_counts["sections"],
+            )
+            logger.info(f"The paper would be read in {len(chunks)} chunks")
         content = ""
-
-    num_prompt_tokens = len(tokens)
-    num_generated_tokens = len(enc.encode(content))
+        num_generated_tokens = 0
+    else:
+        if too_long and action == "full":
+            logger.info(f"Prompt too long: {num_prompt_tokens}, summarizing in chunks")
+        try:
+            content, num_prompt_tokens, num_generated_tokens = asyncio.run(
+                run_llm(
+                    paper_content,
+                    sections,
+                    messages,
+                    token_counts,
+                    enc,
+                    update_messages=update_messages if action == "update" else None,
+                    num_update_tokens=num_update_tokens,
+                    chunk_tokens=chunk_tokens,
+                    question_groups=question_groups,
+                    on_content=note.on_content if note is not None else None,
+                )
+            )
+        except ValueError as e:
+            logger.error(e)
+            exit(1)
     logger.info(f"Generated length: {num_generated_tokens} tokens")
 
-    arxiv_metadata = ""
-    paper_title = f"Paper {arxiv_id}"
-    if arxiv_id != "test":
+    if metadata_future is not None:
         try:
-            metadata = fetch_metainfo(arxiv_id)
-            paper_title = metadata["title"]
-            arxiv_metadata = f"**Authors**: {', '.join(metadata['authors'])}\n"
-            arxiv_metadata += f"**Updated Dates**: {metadata['updated']}\n"
-            arxiv_metadata += f"**Published Dates**: {metadata['published']}\n"
-            arxiv_metadata += f"**Categories**: {', '.join(metadata['categories'])}\n"
-            arxiv_metadata += f"**Abstract**: {metadata['abstract']}\n"
-
-            arxiv_metadata = "----\n## Metadata\n" + arxiv_metadata
+            metadata = metadata_future.result()
+            paper_title, arxiv_metadata = format_metadata(metadata)
         except Exception as e:
             logger.error(e)
+    metadata_pool.shutdown()
 
-    summary_path = TEXT_CACHE_DIR / f"{url_hash}.summary.txt"
-    summary_tpl = open(PROMPTS_DIR / "summary.tpl", "r").read()
-    summary = summary_tpl.format(
+    if not dry_run and arxiv_id != "test":
+        # the sections the answers were made from, so that small changes add
+        # up over versions until they are worth an update
+        if action == "reuse":
+            sections = snapshot["sections"]
+        save_snapshot(
+            get_paper_cache(),
+            snapshot_key,
+            sections,
+            content,
+            num_prompt_tokens,
+            num_generated_tokens,
+            updated=metadata["updated"] if metadata is not None else None,
+            arxiv_id=arxiv_id,
+        )
+
+    summary = make_summary(
+        arxiv_id,
+        content,
+        num_prompt_tokens,
+        num_generated_tokens,
         paper_title=paper_title,
-        paper_arxiv_id=arxiv_id,
-        num_prompt_tokens=num_prompt_tokens,
-        num_generated_tokens=num_generated_tokens,
         arxiv_metadata=arxiv_metadata,
-        content=content,
     )
-    summary_path.write_text(summary)
+    summary_path = save_summary(url_hash, summary, arxiv_id=arxiv_id)
     logger.info(f"Saved summary to {summary_path}")
 
-    # upload to codimd
-    if not dry_run:
-        codimd_client = get_codimd_client()
-        if codimd_client:
-            url = codimd_client.create_and_publish(summary.strip())
-            logger.info(f"Published summary to {url}")
+    # upload to codimd, a kept summary was published before
+    if note is not None:
+        url = note.close(summary.strip())
+        logger.info(f"Published summary to {url} ({note.updates} updates)")
+    elif codimd_client and action != "reuse":
+        url = codimd_client.create_and_publish(summary.strip())
+        logger.info(f"Published summary to {url}")
+
+
+@click.command()
+@click.argument("arxiv_id")
+@source_options
+@force_refresh_option
+@render_timeout_option()
+@compact_option
+@summary_options
+@click.option(
+    "--stream-publish",
+    is_flag=True,
+    help="If True, publish the note to CodiMD with the paper metadata at once, and update it while the summary is generated.",
+)
+@click.option(
+    "--publish-interval",
+    default=DEFAULT_UPDATE_INTERVAL,
+    show_default=True,
+    help="With --stream-publish, the minimum time between two updates of the note, in seconds.",
+)
+@endpoint_options
+@trace_file_option
+@metrics_file_option
+def main(
+    arxiv_id,
+    fanout,
+    question_groups,
+    endpoints_file,
+    tpm,
+    rpm,
+    trace_file,
+    metrics_file,
+    **options,
+):
+    """
+    Summarizes the arXiv paper ARXIV_ID and publishes the summary to CodiMD.
+    """
+    try:
+        question_groups = get_question_groups(fanout, question_groups)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--question-groups")
+    configure_endpoints(endpoints_file, tpm=tpm, rpm=rpm)
+    tracer = Tracer(trace_file, metrics_file)
+    set_tracer(tracer)
+    try:
+        with trace(arxiv_id.strip()):
+            summarize_paper(arxiv_id, question_groups=question_groups, **options)
+    finally:
+        set_tracer(None)
+        tracer.close()
 
 
 if __name__ == "__main__":
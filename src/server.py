@@ -0,0 +1,307 @@
+import json
+import time
+import asyncio
+import logging
+
+import click
+from aiohttp import web
+
+from llm import set_response_cache
+from endpoints import configure_endpoints, get_endpoint_pool
+from llm_cache import ResponseCache
+from fanout import get_question_groups
+from tracing import Tracer, get_tracer, set_tracer, trace
+from read_paper import LLM_CACHE_DIR
+from batch_read_papers import BatchPipeline
+from hedged_fetch import describe_error
+from cli_options import (
+    compact_option,
+    endpoint_options,
+    pipeline_options,
+    render_timeout_option,
+    source_options,
+    summary_options,
+    trace_file_option,
+)
+
+logger = logging.getLogger(__name__)
+
+# Jobs summarized at the same time, the stages of the pipeline have their own
+# limits (downloads, parsers, LLM calls)
+DEFAULT_MAX_JOBS = 4
+
+
+class Job:
+    """
+    A paper being summarized, and the events it sent so far.
+
+    The events are JSON objects: {"status": ...} when the job is queued and
+    when it starts, {"content": ...} for each piece of the summary and a last
+    {"done": true, ...} with the summary path or the error. Clients that
+    subscribe late get the events they missed first.
+    """
+
+    def __init__(self, arxiv_id):
+        self.arxiv_id = arxiv_id
+        self.status = "queued"
+        self.created = time.time()
+        self.events = [{"status": "queued"}]
+        self._subscribers = set()
+
+    def publish(self, event):
+        self.events.append(event)
+        for queue in self._subscribers:
+            queue.put_nowait(event)
+
+    def on_content(self, content):
+        self.publish({"content": content})
+
+    def set_status(self, status, **attrs):
+        self.status = status
+        if status in ("done", "failed"):
+            self.publish({"done": True, "status": status, **attrs})
+        else:
+            self.publish({"status": status})
+
+    async def subscribe(self):
+        """
+        Yields the events of the job until it is done.
+        """
+        queue = asyncio.Queue()
+        # no await between the copy and the registration, so no event is
+        # missed or sent twice
+        missed = list(self.events)
+        self._subscribers.add(queue)
+        try:
+            for event in missed:
+                yield event
+                if "done" in event:
+                    return
+            while True:
+                event = await queue.get()
+                yield event
+                if "done" in event:
+                    return
+        finally:
+            self._subscribers.discard(queue)
+
+
+class SummaryServer:
+    """
+    Summarizes papers on request, keeping the state that read_paper.py builds
+    for every paper warm: the imports, the tiktoken encoder, the prompt
+    templates, the HTTP connection pool, the parser processes and the CodiMD
+    session (see BatchPipeline).
+
+    Jobs wait in a queue for one of max_jobs workers. A request for a paper
+    that is already queued or being summarized joins the running job instead
+    of starting another one.
+    """
+
+    def __init__(self, pipeline, max_jobs=DEFAULT_MAX_JOBS):
+        self.pipeline = pipeline
+        self.max_jobs = max_jobs
+        self.jobs = {}
+        self._queue = None
+        self._workers = []
+
+    def submit(self, arxiv_id):
+        """
+        Returns the job of a paper, queueing it if it is not running.
+        """
+        job = self.jobs.get(arxiv_id)
+        if job is None:
+            job = Job(arxiv_id)
+            self.jobs[arxiv_id] = job
+            self._queue.put_nowait(job)
+            logger.info(f"Queued {arxiv_id} ({self._queue.qsize()} waiting)")
+        else:
+            logger.info(f"Joining the running job of {arxiv_id}")
+        return job
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._run(job)
+            finally:
+                self._queue.task_done()
+                # the next request for the paper starts a new job, which
+                # finds the paper text and the LLM response in the cache
+                self.jobs.pop(job.arxiv_id, None)
+
+    async def _run(self, job):
+        job.set_status("running")
+        with trace(job.arxiv_id, server=True) as s:
+            try:
+                summary_path = await self.pipeline.process(
+                    job.arxiv_id, on_content=job.on_content
+                )
+            except Exception as e:
+                error = describe_error(e)
+                logger.error(f"Paper {job.arxiv_id}: {error}")
+                s.set(error=error)
+                job.set_status("failed", error=error)
+                return
+        logger.info(f"Saved summary of {job.arxiv_id} to {summary_path}")
+        job.set_status("done", summary_path=str(summary_path))
+
+    async def _lifespan(self, app):
+        async with self.pipeline.open():
+            self._queue = asyncio.Queue()
+            self._workers = [
+                asyncio.ensure_future(self._worker()) for _ in range(self.max_jobs)
+            ]
+            logger.info("Ready")
+            yield
+            for worker in self._workers:
+                worker.cancel()
+            await asyncio.gather(*self._workers, return_exceptions=True)
+
+    async def handle_summarize(self, request):
+        """
+        POST /summarize {"arxiv_id": "2303.01469"}
+
+        Streams the events of the job as JSON lines.
+        """
+        try:
+            body = await request.json()
+            arxiv_id = str(body["arxiv_id"]).strip()
+        except (ValueError, KeyError, TypeError):
+            raise web.HTTPBadRequest(text='Expected {"arxiv_id": "..."}')
+        if not arxiv_id:
+            raise web.HTTPBadRequest(text="Empty arxiv_id")
+
+        job = self.submit(arxiv_id)
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        try:
+            async for event in job.subscribe():
+                await response.write((json.dumps(event) + "\n").encode("utf-8"))
+        except ConnectionResetError:
+            # the job goes on, its result is cached for the next request
+            logger.info(f"Client of {arxiv_id} disconnected")
+            return response
+        await response.write_eof()
+        return response
+
+    async def handle_jobs(self, request):
+        """
+        GET /jobs, the queued and running jobs.
+        """
+        return web.json_response(
+            [
+                {"arxiv_id": job.arxiv_id, "status": job.status, "created": job.created}
+                for job in self.jobs.values()
+            ]
+        )
+
+    async def handle_metrics(self, request):
+        """
+        GET /metrics, the tracing metrics in the Prometheus text format.
+        """
+        tracer = get_tracer()
+        text = tracer.metrics.render() if tracer is not None else ""
+        return web.Response(text=text, content_type="text/plain")
+
+    async def handle_endpoints(self, request):
+        """
+        GET /endpoints, the health of the LLM deployments.
+        """
+        try:
+            pool = get_endpoint_pool()
+        except ValueError as e:
+            return web.json_response({"error": str(e)}, status=500)
+        return web.json_response(pool.health())
+
+    async def handle_health(self, request):
+        return web.json_response({"ok": True, "jobs": len(self.jobs)})
+
+    def make_app(self):
+        app = web.Application()
+        app.cleanup_ctx.append(self._lifespan)
+        app.add_routes(
+            [
+                web.post("/summarize", self.handle_summarize),
+                web.get("/jobs", self.handle_jobs),
+                web.get("/metrics", self.handle_metrics),
+                web.get("/endpoints", self.handle_endpoints),
+                web.get("/healthz", self.handle_health),
+            ]
+        )
+        return app
+
+
+@click.command()
+@click.option(
+    "--host", default="127.0.0.1", show_default=True, help="The address to listen on."
+)
+@click.option("--port", default=8080, show_default=True, help="The port to listen on.")
+@click.option(
+    "--socket",
+    type=click.Path(dir_okay=False),
+    help="Listen on this Unix socket instead of --host and --port.",
+)
+@click.option(
+    "--max-jobs",
+    default=DEFAULT_MAX_JOBS,
+    show_default=True,
+    help="Maximum number of papers summarized at the same time, the others wait in a queue.",
+)
+@pipeline_options
+@source_options
+@render_timeout_option()
+@compact_option
+@summary_options
+@endpoint_options
+@trace_file_option
+def main(
+    host,
+    port,
+    socket,
+    max_jobs,
+    max_downloads,
+    max_parsers,
+    max_llm_calls,
+    endpoints_file,
+    tpm,
+    rpm,
+    fanout,
+    question_groups,
+    no_llm_cache,
+    trace_file,
+    **options,
+):
+    """
+    Runs the summarizer as a server that keeps its state warm between papers.
+    """
+    try:
+        question_groups = get_question_groups(fanout, question_groups)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--question-groups")
+    set_response_cache(ResponseCache(LLM_CACHE_DIR, bypass=no_llm_cache))
+    configure_endpoints(endpoints_file, tpm=tpm, rpm=rpm)
+    # the metrics are served at /metrics
+    tracer = Tracer(trace_file)
+    set_tracer(tracer)
+
+    pipeline = BatchPipeline(
+        max_downloads=max_downloads,
+        max_parsers=max_parsers,
+        max_llm_calls=max_llm_calls,
+        question_groups=question_groups,
+        **options,
+    )
+    server = SummaryServer(pipeline, max_jobs=max_jobs)
+    try:
+        if socket:
+            web.run_app(server.make_app(), path=socket)
+        else:
+            web.run_app(server.make_app(), host=host, port=port)
+    finally:
+        set_tracer(None)
+        tracer.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import json
+import logging
+
+from arxiv_loader import PARSER_VERSION
+
+logger = logging.getLogger(__name__)
+
+
+def get_text_cache_key(url_hash, keep_ref=False, keep_app=False, keep_latex=False):
+    """
+    Returns the key of the parsed and reduced text of a paper. Different parse
+    options and parser versions get different keys, e.g.
+    "<url_hash>.v1-ref0-app0-latex0".
+    """
+    options = f"v{PARSER_VERSION}-ref{int(keep_ref)}-app{int(keep_app)}-latex{int(keep_latex)}"
+    return f"{url_hash}.{options}"
+
+
+def encode_paper_text(paper_content, sections):
+    return json.dumps(
+        {"paper_content": paper_content, "sections": sections}, ensure_ascii=False
+    )
+
+
+def load_paper_text(cache, key):
+    """
+    Loads the cached text of a paper from a PaperCache.
+
+    Returns:
+    (paper_content, sections) or None if the text is not cached
+    """
+    data = cache.get_text(key, "text")
+    if data is None:
+        return None
+    try:
+        text = json.loads(data)
+    except ValueError:
+        return None
+    logger.info(f"Using cached text of {key}")
+    return text["paper_content"], text["sections"]
+
+
+def save_paper_text(cache, key, paper_content, sections, arxiv_id=None, source=None):
+    """
+    Saves the text of a paper in a PaperCache, returns the path of the blob.
+    """
+    return cache.put(
+        key,
+        "text",
+        encode_paper_text(paper_content, sections),
+        arxiv_id=arxiv_id,
+        source=source,
+        options=key.split(".", 1)[1],
+    )
@@ -0,0 +1,158 @@
+import json
+import hashlib
+import logging
+import functools
+
+from llm import make_chatml
+from prompt_templates import make_messages
+
+logger = logging.getLogger(__name__)
+
+# The threads tiktoken encodes a batch of texts with
+DEFAULT_NUM_THREADS = 8
+
+
+# building an encoder parses its BPE ranks, so it is done once per process,
+# and tiktoken is only imported by the runs that count tokens
+@functools.lru_cache(maxsize=None)
+def get_encoder(model="gpt-4"):
+    import tiktoken
+
+    return tiktoken.encoding_for_model(model)
+
+
+def get_encoding_name(model="gpt-4"):
+    """
+    Returns the name of the encoding of a model, e.g. "cl100k_base", without
+    building the encoder.
+    """
+    from tiktoken.model import MODEL_PREFIX_TO_ENCODING, MODEL_TO_ENCODING
+
+    if model in MODEL_TO_ENCODING:
+        return MODEL_TO_ENCODING[model]
+    for prefix, name in MODEL_PREFIX_TO_ENCODING.items():
+        if model.startswith(prefix):
+            return name
+    # the error of tiktoken for unknown models
+    return get_encoder(model).name
+
+
+class LazyEncoder:
+    """
+    The encoder of a model, built the first time it encodes a text. Runs that
+    find all token counts in the cache, e.g. dry runs of papers read before,
+    don't load the encoder.
+    """
+
+    def __init__(self, model="gpt-4"):
+        self.model = model
+        self.name = get_encoding_name(model)
+
+    def __getattr__(self, name):
+        return getattr(get_encoder(self.model), name)
+
+
+def count_tokens(text, enc=None):
+    """
+    Returns the number of tokens of a text. Special tokens like <|endoftext|>
+    in the text are counted as plain text instead of raising an error.
+    """
+    enc = enc or get_encoder()
+    return len(enc.encode_ordinary(text))
+
+
+def count_tokens_batch(texts, enc=None, num_threads=DEFAULT_NUM_THREADS):
+    """
+    Returns the number of tokens of each text, encoding the texts in parallel
+    threads (tiktoken releases the GIL while it encodes).
+    """
+    enc = enc or get_encoder()
+    batch = enc.encode_ordinary_batch(texts, num_threads=num_threads)
+    return [len(tokens) for tokens in batch]
+
+
+@functools.lru_cache(maxsize=None)
+def _get_prompt_overhead(enc, questions):
+    return count_tokens(make_chatml(make_messages("", questions)), enc)
+
+
+def count_paper_prompt_tokens(paper_tokens, questions=None, enc=None):
+    """
+    Returns the length of the paper_query.tpl prompt of a paper from the
+    number of tokens of the paper, without encoding the paper again. The
+    length can be off by a token or two where the paper joins the template.
+
+    Parameters:
+    paper_tokens (int): The number of tokens of the paper content
+    questions (collection of int): The questions asked, None for all
+    enc (tiktoken.Encoding): The encoder, defaults to the gpt-4 one
+    """
+    enc = enc or get_encoder()
+    if questions is not None:
+        questions = tuple(sorted(questions))
+    return _get_prompt_overhead(enc, questions) + paper_tokens
+
+
+def _get_text_hash(texts):
+    h = hashlib.sha256()
+    for text in texts:
+        h.update(text.encode("utf-8") + b"\0")
+    return h.hexdigest()
+
+
+def get_paper_tokens(cache, key, paper_content, sections, enc=None, arxiv_id=None):
+    """
+    Returns the number of tokens of the paper_query.tpl prompt of a paper, of
+    the paper and of each of its sections.
+
+    The counts are stored in the PaperCache next to the cached text (same key,
+    kind "tokens"), and reused as long as the prompt, the sections and the
+    encoding are the same, so that a paper is tokenized once and not on every
+    run.
+
+    Parameters:
+    cache (PaperCache): The cache of the paper text, or None to not store
+    the counts
+    key (str): The text cache key of the paper
+    paper_content (str): The reduced text of the paper
+    sections (list of str): The reduced text of each section
+    enc (tiktoken.Encoding or LazyEncoder): The encoder, only used to count
+    the tokens that are not cached
+
+    Returns:
+    counts (dict): The number of tokens of the "prompt", of the
+    "paper_content" and of each of the "sections" (a list)
+    """
+    enc = enc or get_encoder()
+    prompt = make_chatml(make_messages(paper_content))
+    # the prompt contains the paper and the templates
+    text_hash = _get_text_hash([prompt] + sections)
+    if cache is not None:
+        data = cache.get_text(key, "tokens")
+        if data is not None:
+            try:
+                counts = json.loads(data)
+            except ValueError:
+                counts = {}
+            if counts.get("encoding") == enc.name and counts.get("hash") == text_hash:
+                return counts
+
+    prompt_tokens, paper_tokens, *section_tokens = count_tokens_batch(
+        [prompt, paper_content] + sections, enc
+    )
+    counts = {
+        "encoding": enc.name,
+        "hash": text_hash,
+        "prompt": prompt_tokens,
+        "paper_content": paper_tokens,
+        "sections": section_tokens,
+    }
+    if cache is not None:
+        cache.put(
+            key,
+            "tokens",
+            json.dumps(counts),
+            arxiv_id=arxiv_id,
+            options=key.split(".", 1)[1] if "." in key else None,
+        )
+    return counts
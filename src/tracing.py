@@ -0,0 +1,332 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# The trace (paper) and span the current code runs in. asyncio tasks copy the
+# context when they are created, so spans of concurrent papers don't mix.
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+# The Tracer spans are sent to, see set_tracer
+_tracer = None
+
+# Histogram buckets in seconds, from fast parses to long LLM streams
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300
+)
+
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # labels -> [bucket counts..., sum, count]
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        if key not in self.values:
+            self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+        v = self.values[key]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                v[i] += 1
+        v[-2] += value
+        v[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, v in sorted(self.values.items()):
+            for bound, count in zip(self.buckets, v):
+                labels = _format_labels(key + (("le", f"{bound:g}"),))
+                lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = _format_labels(key + (("le", "+Inf"),))
+            lines.append(f"{self.name}_bucket{labels} {v[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {v[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {v[-1]}")
+        return lines
+
+
+def _format_labels(key):
+    if not key:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in key) + "}"
+
+
+class Metrics:
+    """
+    Prometheus-style counters and histograms fed from the finished spans.
+    """
+
+    def __init__(self):
+        self.stage_seconds = Histogram(
+            "paper_stage_duration_seconds", "Duration of each stage of a paper"
+        )
+        self.papers = Counter("papers_total", "Papers processed, by status")
+        self.ttft = Histogram(
+            "llm_time_to_first_token_seconds", "Time from the request to the first token"
+        )
+        self.tokens_per_second = Histogram(
+            "llm_tokens_per_second",
+            "Generation speed after the first token",
+            buckets=(1, 2, 5, 10, 20, 30, 50, 75, 100, 200),
+        )
+        self.prompt_tokens = Counter("llm_prompt_tokens_total", "Prompt tokens sent")
+        self.completion_tokens = Counter(
+            "llm_completion_tokens_total", "Completion tokens received"
+        )
+        self.cost = Counter("llm_cost_dollars_total", "Estimated cost of the LLM calls")
+        self.endpoint_requests = Counter(
+            "llm_endpoint_requests_total", "LLM requests sent to each endpoint"
+        )
+        self.endpoint_ttft = Histogram(
+            "llm_endpoint_time_to_first_token_seconds",
+            "Time from sending a request to an endpoint to its first token",
+        )
+        self.compaction_saved = Counter(
+            "compaction_saved_tokens_total", "Tokens saved by each compaction rule"
+        )
+
+    def record(self, span):
+        attrs = span.attrs
+        self.stage_seconds.observe(span.duration, stage=span.name)
+        if span.name == "paper":
+            self.papers.inc(status="error" if "error" in attrs else "ok")
+        if span.name == "llm_stream":
+            if attrs.get("ttft") is not None:
+                self.ttft.observe(attrs["ttft"])
+            if attrs.get("tokens_per_second") is not None:
+                self.tokens_per_second.observe(attrs["tokens_per_second"])
+        if span.name == "llm_request":
+            endpoint = attrs.get("endpoint", "")
+            status = attrs.get("error", "ok")
+            self.endpoint_requests.inc(endpoint=endpoint, status=status)
+            if attrs.get("ttft") is not None:
+                self.endpoint_ttft.observe(attrs["ttft"], endpoint=endpoint)
+        if span.name == "llm":
+            model = attrs.get("model", "")
+            self.prompt_tokens.inc(attrs.get("prompt_tokens", 0), model=model)
+            self.completion_tokens.inc(attrs.get("completion_tokens", 0), model=model)
+            self.cost.inc(attrs.get("cost", 0.0), model=model)
+        if span.name == "compact":
+            for rule, saved in attrs.get("saved", {}).items():
+                self.compaction_saved.inc(saved, rule=rule)
+
+    def render(self):
+        lines = []
+        for metric in (
+            self.stage_seconds,
+            self.papers,
+            self.ttft,
+            self.tokens_per_second,
+            self.prompt_tokens,
+            self.completion_tokens,
+            self.cost,
+            self.endpoint_requests,
+            self.endpoint_ttft,
+            self.compaction_saved,
+        ):
+            if metric.values:
+                lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class Span:
+    def __init__(self, name, trace, parent, attrs):
+        self.name = name
+        self.trace = trace
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attrs = attrs
+        self.start = time.time()
+        self._start = time.perf_counter()
+        self.duration = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def end(self):
+        self.duration = time.perf_counter() - self._start
+
+    def to_dict(self):
+        record = {
+            "trace_id": self.trace["trace_id"] if self.trace else None,
+            "arxiv_id": self.trace["arxiv_id"] if self.trace else None,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": round(self.start, 6),
+            "duration": round(self.duration, 6),
+        }
+        record.update(self.attrs)
+        return record
+
+
+class _NullSpan:
+    def set(self, **attrs):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Tracer:
+    """
+    Writes finished spans as JSON lines and feeds them into Metrics.
+
+    Only the process that created the tracer records spans, so code that runs
+    in a process pool (e.g. parsing) is traced by the span around the pool
+    call in the parent.
+
+    Parameters:
+    trace_path (Path): The JSONL file spans are appended to, or None
+    metrics_path (Path): The file the metrics are written to (in the
+    Prometheus text format) by write_metrics, or None
+    """
+
+    def __init__(self, trace_path=None, metrics_path=None):
+        self.trace_path = trace_path
+        self.metrics_path = metrics_path
+        self.metrics = Metrics()
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._file = open(trace_path, "a", encoding="utf-8") if trace_path else None
+
+    @property
+    def active(self):
+        return os.getpid() == self._pid
+
+    def emit(self, span):
+        with self._lock:
+            self.metrics.record(span)
+            if self._file is not None:
+                self._file.write(json.dumps(span.to_dict(), ensure_ascii=False) + "\n")
+                self._file.flush()
+
+    def write_metrics(self):
+        if self.metrics_path is not None:
+            with self._lock:
+                text = self.metrics.render()
+            with open(self.metrics_path, "w", encoding="utf-8") as f:
+                f.write(text)
+
+    def close(self):
+        self.write_metrics()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def set_tracer(tracer):
+    """
+    Sets the Tracer spans are sent to. None (the default) disables tracing.
+    """
+    global _tracer
+    _tracer = tracer
+
+
+def get_tracer():
+    return _tracer
+
+
+@contextmanager
+def span(name, **attrs):
+    """
+    Records the time spent in the block as a span of the current trace.
+
+    The yielded span takes more attributes with span.set(key=value). Errors
+    are recorded in the "error" attribute and re-raised. Does nothing when
+    tracing is disabled.
+    """
+    tracer = _tracer
+    if tracer is None or not tracer.active:
+        yield _NULL_SPAN
+        return
+
+    s = Span(name, _current_trace.get(), _current_span.get(), attrs)
+    token = _current_span.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.attrs["error"] = type(e).__name__
+        raise
+    finally:
+        _current_span.reset(token)
+        s.end()
+        tracer.emit(s)
+
+
+@contextmanager
+def trace(arxiv_id, **attrs):
+    """
+    Starts the trace of a paper: the spans in the block share a trace ID and
+    the arXiv ID, under a root "paper" span.
+    """
+    token = _current_trace.set({"trace_id": uuid.uuid4().hex, "arxiv_id": arxiv_id})
+    try:
+        with span("paper", **attrs) as s:
+            yield s
+    finally:
+        _current_trace.reset(token)
+
+
+def current_span():
+    """
+    Returns the innermost open span, to add attributes to it. Returns a span
+    that ignores them when tracing is disabled.
+    """
+    if _tracer is None or not _tracer.active:
+        return _NULL_SPAN
+    return _current_span.get() or _NULL_SPAN
+
+
+def traced(name):
+    """
+    Decorates a function (sync or async) to run in a span.
+    """
+
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
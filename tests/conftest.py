@@ -0,0 +1,111 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+# the modules of src are imported as top-level modules, as the scripts do
+SRC_DIR = Path(__file__).resolve().parent.parent / "src"
+BENCH_DIR = SRC_DIR.parent / "benchmarks"
+sys.path.insert(0, str(SRC_DIR))
+sys.path.insert(0, str(BENCH_DIR))
+
+
+class WordEncoder:
+    """
+    A tiktoken-like encoder with one token per word, so that the tests don't
+    need the BPE ranks (which are downloaded on first use).
+    """
+
+    name = "words"
+
+    def encode(self, text, **kwargs):
+        return text.split()
+
+    def encode_ordinary(self, text):
+        return text.split()
+
+    def encode_ordinary_batch(self, texts, num_threads=8):
+        return [text.split() for text in texts]
+
+    def decode(self, tokens):
+        return " ".join(tokens)
+
+
+@pytest.fixture
+def enc():
+    return WordEncoder()
+
+
+@pytest.fixture
+def paper_cache(tmp_path):
+    from paper_cache import PaperCache
+
+    return PaperCache(tmp_path / "cache")
+
+
+@pytest.fixture
+def loader_cache(paper_cache):
+    """
+    The paper_cache, as the cache arxiv_loader fetches papers into.
+    """
+    import arxiv_loader
+
+    arxiv_loader.set_paper_cache(paper_cache)
+    yield paper_cache
+    arxiv_loader.set_paper_cache(None)
+
+
+# What the fake OpenAI endpoint of fake_services answers
+SUMMARY = "1. The paper studies a problem.\n2. It solves it."
+
+
+@pytest.fixture
+def fake_services(tmp_path, monkeypatch, loader_cache):
+    """
+    Points the pipeline and the prefetcher at a FakeServer and at a fake
+    OpenAI endpoint that streams SUMMARY, and yields both servers. The
+    FakeServer serves the arXiv API, the HTML fixtures under their names
+    (e.g. "ar5iv-small"), and the listing fixture at /list/<category>/new
+    with its papers under their arXiv IDs (see LISTING_PAPERS). Nothing is
+    published to CodiMD or written outside tmp_path.
+    """
+    import arxiv_loader
+    import batch_read_papers
+    import codimd_client
+    import prefetch
+    import read_paper
+    from endpoints import EndpointPool, set_endpoint_pool
+    from fakes import FakeOpenAIServer, FakeServer
+    from llm import set_response_cache
+    from make_fixtures import LISTING_PAPERS
+    from paper_cache import read_blob_text
+    from run_benchmarks import LISTING_FIXTURE, load_fixtures
+
+    pages = {name: read_blob_text(path) for name, _, path in load_fixtures()}
+    for arxiv_id, name, _ in LISTING_PAPERS:
+        pages[arxiv_id] = pages[name]
+    listing = LISTING_FIXTURE.read_text(encoding="utf-8")
+    with FakeServer(pages, listing=listing) as papers, FakeOpenAIServer(
+        content=SUMMARY, num_chunks=10
+    ) as llm:
+        monkeypatch.setattr(arxiv_loader, "ARXIV_API_URL", f"{papers.url}/api/query")
+        monkeypatch.setattr(
+            arxiv_loader, "ARXIV_LISTING_URL", papers.url + "/list/{category}/new"
+        )
+        monkeypatch.setattr(
+            read_paper,
+            "get_paper_url",
+            lambda arxiv_id, use_ar5iv=False: f"{papers.url}/papers/{arxiv_id}/",
+        )
+        for module in (batch_read_papers, prefetch):
+            monkeypatch.setattr(
+                module, "METADATA_STORE_PATH", tmp_path / "metadata.sqlite3"
+            )
+            monkeypatch.setattr(
+                module, "FETCH_STATS_PATH", tmp_path / "fetch_stats.jsonl"
+            )
+        monkeypatch.setattr(codimd_client, "CODIMD_HOST", None)
+        set_endpoint_pool(EndpointPool([llm.endpoint("fake")]))
+        set_response_cache(None)
+        yield papers, llm
+    set_endpoint_pool(None)
@@ -0,0 +1,89 @@
+import itertools
+
+import pytest
+
+from arxiv_loader import PaperFailedToRender, has_paper_content, parse_paper_content
+from run_benchmarks import load_fixtures
+
+# keep_ref, keep_app and keep_latex
+PARSE_OPTIONS = list(itertools.product([False, True], repeat=3))
+
+PAGES = {
+    "sections": """<html><body><div class="ltx_page_content">
+<section><h2>1 Introduction</h2><p>Text with
+<math alttext="x^2"><semantics><mi>x</mi>
+<annotation encoding="application/x-tex">x^2</annotation></semantics></math>
+and <span class="mjx-math" aria-label="y+1"><span>y</span></span>.</p>
+<pre>
+code</pre><!-- a comment --></section>
+<section><h2>A Appendix</h2><p>Proofs.</p></section>
+<section><h2>References</h2><p>[1] A reference.</p></section>
+</div></body></html>""",
+    "nested": """<html><body><div class="ltx_page">
+<div class="ltx_page_content"><p>Body.</p>
+<div><h2>Bibliography</h2><p>[1] ref</p></div></div></div></body></html>""",
+    # the parent of the References title is the content itself
+    "flat": """<html><body><div class="ltx_page_content">
+<p>Body text here.</p><h2>References</h2><p>[1] ref</p></div></body></html>""",
+}
+
+
+def parse(path, keep_ref, keep_app, keep_latex, backend):
+    try:
+        return parse_paper_content(
+            path,
+            keep_latex=keep_latex,
+            remove_references=not keep_ref,
+            remove_appendix=not keep_app,
+            backend=backend,
+        )
+    except PaperFailedToRender:
+        return PaperFailedToRender
+
+
+@pytest.mark.parametrize("name, path", [(n, p) for n, _, p in load_fixtures()])
+def test_fixtures_have_content(name, path):
+    assert has_paper_content(path)
+    assert parse_paper_content(path, backend="lxml")
+
+
+@pytest.mark.parametrize("options", PARSE_OPTIONS)
+@pytest.mark.parametrize("name", list(PAGES))
+def test_backends_agree_on_pages(tmp_path, name, options):
+    path = tmp_path / "paper.html"
+    path.write_text(PAGES[name])
+    assert parse(path, *options, "lxml") == parse(path, *options, "html5lib")
+
+
+def test_removed_section_around_the_content_fails_to_render(tmp_path):
+    path = tmp_path / "paper.html"
+    path.write_text(PAGES["flat"])
+    for backend in ["html5lib", "lxml"]:
+        assert parse(path, False, True, False, backend) is PaperFailedToRender
+        assert "References" in parse(path, True, True, False, backend)
+
+
+# html5lib takes seconds on the larger fixtures, the benchmarks compare them
+@pytest.mark.parametrize("options", PARSE_OPTIONS)
+@pytest.mark.parametrize(
+    "path", [p for n, _, p in load_fixtures() if n.endswith("-small")]
+)
+def test_backends_agree_on_fixtures(path, options):
+    assert parse(path, *options, "lxml") == parse(path, *options, "html5lib")
+
+
+@pytest.mark.parametrize(
+    "html, expected",
+    [
+        ("", False),
+        ("<div class='ltx_page_main'>Text</div>", False),
+        ('<div class="ltx_page_content_x">Text</div>', False),
+        ('<div class="ltx_page_content"> <div> </div></div>', False),
+        ("<DIV id=x class=ltx_page_content><p>\n Text</p></DIV>", True),
+        ('<div class="ltx_page ltx_page_content">\n<span>Text</span></div>', True),
+    ],
+)
+def test_has_paper_content(tmp_path, html, expected):
+    path = tmp_path / "paper.html"
+    path.write_text(html)
+    assert has_paper_content(path) == expected
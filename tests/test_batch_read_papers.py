@@ -0,0 +1,85 @@
+import io
+import asyncio
+
+import pytest
+
+from arxiv_loader import PaperFailedToRender, PaperNotFound, PaperRenderInProgress
+from batch_read_papers import BatchPipeline, StageStats, read_arxiv_ids
+from conftest import SUMMARY
+from hedged_fetch import describe_error
+from paper_cache import read_blob_text
+
+# a paper the fake server does not have between two it has
+WITH_MISSING = ["ar5iv-small", "missing", "arxiv-vanity-small"]
+
+
+@pytest.fixture
+def pipeline(fake_services, enc):
+    pipeline = BatchPipeline(max_parsers=1, parser="lxml")
+    pipeline.enc = enc
+    return pipeline
+
+
+def test_results_follow_the_order_of_the_ids(pipeline, loader_cache):
+    # the large paper is parsed last, but comes first
+    arxiv_ids = ["ar5iv-large", "arxiv-vanity-small", "ar5iv-small"]
+    results = asyncio.run(pipeline.run(arxiv_ids))
+    assert list(results) == arxiv_ids
+    assert list(results.values()) == [None, None, None]
+
+
+def test_failed_paper_does_not_stop_the_others(pipeline, loader_cache):
+    results = asyncio.run(pipeline.run(WITH_MISSING))
+    assert results == {
+        "ar5iv-small": None,
+        "missing": "not found",
+        "arxiv-vanity-small": None,
+    }
+    summaries = list(loader_cache.root.rglob("*.summary.txt"))
+    assert len(summaries) == 2
+    assert all(SUMMARY in read_blob_text(p) for p in summaries)
+
+
+def test_stage_stats_of_a_run(pipeline, loader_cache):
+    asyncio.run(pipeline.run(WITH_MISSING))
+    stats = pipeline.stats
+    assert (stats["fetch"].count, stats["fetch"].failed) == (3, 1)
+    # the missing paper never reaches the later stages
+    for name in ("parse", "tokenize", "llm", "publish"):
+        assert (stats[name].count, stats[name].failed) == (2, 0)
+        assert stats[name].busy > 0
+    assert "fetch" in pipeline.report()
+
+
+def test_stage_stats():
+    stats = StageStats("llm", concurrency=2)
+    assert (stats.wall, stats.throughput, stats.utilization) == (0.0, 0.0, 0.0)
+
+    # two overlapping calls and one that failed later
+    stats.record(10.0, 14.0)
+    stats.record(11.0, 13.0)
+    stats.record(16.0, 18.0, ok=False)
+    assert (stats.count, stats.failed) == (3, 1)
+    assert stats.busy == 8.0
+    assert stats.wall == 8.0
+    assert stats.throughput == 3 / 8
+    assert stats.utilization == 8.0 / (8.0 * 2)
+
+
+@pytest.mark.parametrize(
+    "error,description",
+    [
+        (PaperNotFound(), "not found"),
+        (PaperRenderInProgress(), "render in progress"),
+        (PaperFailedToRender(), "failed to render"),
+        (ValueError("Prompt too long: 30000"), "Prompt too long: 30000"),
+        (TimeoutError(), "TimeoutError"),
+    ],
+)
+def test_describe_error(error, description):
+    assert describe_error(error) == description
+
+
+def test_read_arxiv_ids():
+    f = io.StringIO("2303.01469\n\n# later\n2304.00001  # a comment\n2303.01469\n")
+    assert read_arxiv_ids(f) == ["2303.01469", "2304.00001"]
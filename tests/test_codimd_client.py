@@ -0,0 +1,181 @@
+import stat
+import time
+import asyncio
+
+import pytest
+
+import codimd_client
+from codimd_client import CodimdClient, CodimdError, CodimdStore, StreamingNote
+from fakes import FakeServer
+
+
+@pytest.fixture
+def codimd():
+    with FakeServer({}) as server:
+        yield server
+
+
+@pytest.fixture
+def store(tmp_path):
+    return CodimdStore(tmp_path / "codimd.sqlite3")
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """
+    The delays the client waits between retries, without waiting them.
+    """
+    delays = []
+    monkeypatch.setattr(codimd_client.random, "uniform", lambda a, b: b)
+    monkeypatch.setattr(codimd_client.time, "sleep", delays.append)
+    return delays
+
+
+def make_client(codimd, store=None, **kwargs):
+    return CodimdClient(codimd.url, "me@example.com", "secret", store=store, **kwargs)
+
+
+def wait_for_update(note):
+    if note._pending is not None:
+        note._pending.result()
+
+
+def test_session_cookie_is_reused_by_the_next_runs(codimd, store):
+    make_client(codimd, store)
+    assert codimd.logins == 1
+    assert stat.S_IMODE(store.path.stat().st_mode) == 0o600
+
+    client = make_client(codimd, store)
+    assert codimd.logins == 1
+    assert client.is_logged_in()
+
+
+def test_expired_session_logs_in_again(codimd, store):
+    cookie = {"name": "sid", "value": "0", "domain": "", "path": "/"}
+    store.save_cookies(codimd.url, "me@example.com", [cookie])
+    make_client(codimd, store)
+    assert codimd.logins == 1
+    cookies = store.load_cookies(codimd.url, "me@example.com")
+    assert [(c["name"], c["value"]) for c in cookies] == [("sid", "1")]
+
+
+def test_requests_are_retried_with_backoff(codimd, sleeps):
+    codimd.failures["/new"] = 3
+    client = make_client(codimd, max_retries=3, backoff=1.0, max_backoff=3.0)
+    note_id = client.create_new("# A note")
+    assert codimd.notes[note_id] == "# A note"
+    assert codimd.requests["POST /new"] == 4
+    assert sleeps == [1.0, 2.0, 3.0]
+
+
+def test_requests_fail_after_the_last_retry(codimd, sleeps):
+    codimd.failures["/new"] = 3
+    client = make_client(codimd, max_retries=2)
+    with pytest.raises(CodimdError, match="returned 503"):
+        client.create_new("# A note")
+    assert codimd.requests["POST /new"] == 3
+
+
+def test_publish_many(codimd, store, sleeps):
+    codimd.failures["/new"] = 2
+    client = make_client(codimd, store)
+    contents = [f"# Summary {i}" for i in range(5)]
+    urls = asyncio.run(client.publish_many(contents, max_concurrency=3))
+    assert len(set(urls)) == 5
+    assert sorted(codimd.notes.values()) == contents
+    for url, content in zip(urls, contents):
+        note_id = url.rsplit("/", 1)[1]
+        assert codimd.notes[note_id] == content
+    assert codimd.logins == 1
+    assert len(sleeps) == 2
+
+
+def test_publish_many_returns_the_errors(codimd, sleeps):
+    client = make_client(codimd, max_retries=1)
+    codimd.failures["/new"] = 2
+    results = asyncio.run(client.publish_many(["# A", "# B"], max_concurrency=1))
+    # the first note fails after its retry, the second is published
+    assert isinstance(results[0], CodimdError)
+    assert codimd.notes[results[1].rsplit("/", 1)[1]] == "# B"
+
+
+def test_unchanged_summary_is_not_published_again(codimd, store):
+    client = make_client(codimd, store)
+    url = client.create_and_publish("# Summary")
+    assert client.create_and_publish("# Summary") == url
+    assert client.create_and_publish("# Summary") == url
+    assert codimd.requests["POST /new"] == 1
+    # the history is read once for the papers of a run
+    assert codimd.requests["GET /history"] == 1
+
+    # the next run checks the history again
+    client = make_client(codimd, store)
+    assert client.create_and_publish("# Summary") == url
+    assert codimd.requests["GET /history"] == 2
+
+    assert client.create_and_publish("# Summary", skip_unchanged=False) != url
+    assert codimd.requests["POST /new"] == 2
+
+
+def test_deleted_note_is_published_again(codimd, store):
+    url = make_client(codimd, store).create_and_publish("# Summary")
+    codimd.notes.clear()
+    new_url = make_client(codimd, store).create_and_publish("# Summary")
+    assert new_url != url
+    assert codimd.requests["POST /new"] == 2
+
+
+def test_streaming_note_updates_are_throttled(codimd, store):
+    client = make_client(codimd, store)
+    note = StreamingNote(client, "# Title", interval=0.2)
+    assert note.url.startswith(codimd.url)
+    assert "being generated" in codimd.notes[note.note_id]
+
+    for piece in ["A1: ", "yes. ", "A2: "]:
+        note.on_content(piece)
+    # within the interval of the creation of the note
+    assert codimd.note_updates.get(note.note_id, 0) == 0
+
+    time.sleep(0.25)
+    note.on_content("no.")
+    note.on_content(" A3: ")
+    wait_for_update(note)
+    assert codimd.note_updates[note.note_id] == 1
+    assert codimd.notes[note.note_id] == "# Title\n\nA1: yes. A2: no."
+
+    assert note.close("# Title\n\nDone") == note.url
+    assert codimd.notes[note.note_id] == "# Title\n\nDone"
+    assert note.updates == 1
+    # the final note counts as published
+    assert client.create_and_publish("# Title\n\nDone") == note.url
+    assert codimd.requests["POST /new"] == 1
+
+
+def test_streaming_note_without_note_api(store):
+    with FakeServer({}, note_api=False) as codimd:
+        client = make_client(codimd, store)
+        note = StreamingNote(client, "# Title", interval=0)
+        note.on_content("A1: yes.")
+        wait_for_update(note)
+        note.on_content(" A2: no.")
+        # the updates stop at the first one the server rejects
+        assert codimd.requests[f"PUT /api/notes/{note.note_id}"] == 1
+
+        url = note.close("# Title\n\nDone")
+        assert url != note.url
+        assert codimd.notes[url.rsplit("/", 1)[1]] == "# Title\n\nDone"
+        assert codimd.requests[f"PUT /api/notes/{note.note_id}"] == 1
+
+
+def test_streaming_note_falls_back_to_a_new_note(codimd, store, sleeps):
+    client = make_client(codimd, store, max_retries=0)
+    note = StreamingNote(client, "# Title", interval=0)
+    codimd.failures[f"/api/notes/{note.note_id}"] = 2
+    note.on_content("A1: yes.")
+    wait_for_update(note)
+    assert note.updates == 0
+
+    # a failed update is not final, but a failed last write is
+    url = note.close("# Title\n\nDone")
+    assert url != note.url
+    assert codimd.notes[url.rsplit("/", 1)[1]] == "# Title\n\nDone"
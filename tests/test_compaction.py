@@ -0,0 +1,181 @@
+import pytest
+
+from compaction import (
+    COMPACTION_RULES,
+    CompactionRule,
+    compact_paper,
+    compact_sections,
+    format_report,
+)
+
+
+def apply_rule(name, text, index=1):
+    rule = next(rule for rule in COMPACTION_RULES if rule.name == name)
+    spans = rule.find(text, index)
+    out = []
+    pos = 0
+    for start, end, repl in sorted(spans):
+        out.append(text[pos:start] + repl)
+        pos = end
+    return "".join(out) + text[pos:]
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("equal work11footnote 1Equal contribution.", "equal work Equal contribution."),
+        ("1footnote 1Work done at X", "Work done at X"),
+        ("Also footnotemark: 2 x and 3footnotetext: 3 here", "Also x and here"),
+        ("footnotetext: 1Work done at X", "Work done at X"),
+    ],
+)
+def test_footnote_marks_are_removed(text, expected):
+    assert apply_rule("footnotes", text) == expected
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "see 2 footnotes below",
+        "we add 3 footnotes to the table",
+        "footnote 3 shows the proof",
+        "the footnotemark command of LaTeX",
+    ],
+)
+def test_footnote_rule_keeps_prose(text):
+    assert apply_rule("footnotes", text) == text
+
+
+def test_latex_formatting_is_removed():
+    text = r"\displaystyle\mathrm{d}x \left( a\,b \right) \label{eq:1}\leftarrow"
+    assert apply_rule("latex", text) == r"dx ( ab ) \leftarrow"
+
+
+def test_latex_is_kept_with_keep_latex(enc):
+    sections = [r"1 Intro\nWe set \mathrm{d}x = \left( a\,b \right)."]
+    assert compact_sections(sections, enc, keep_latex=True)[0] == sections
+    assert compact_sections(sections, enc)[0] != sections
+
+
+def test_rules_must_find_spans():
+    with pytest.raises(TypeError):
+        CompactionRule("empty")
+
+
+def test_repeated_affiliations_and_emails_are_removed():
+    text = (
+        "Title\nAlice\nGoogle Research alice@google.com\nBob\nGoogle Research\n"
+        "Abstract text\nGoogle Research\n"
+    )
+    assert apply_rule("affiliations", text, index=0) == (
+        "Title\nAlice\nGoogle Research\nBob\nAbstract text\nGoogle Research\n"
+    )
+    # only the title block of the first section
+    assert apply_rule("affiliations", text, index=1) == text
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("as shown in [3, 7-9].", "as shown in."),
+        ("prior work [4]", "prior work"),
+        ("results [1][2], then", "results, then"),
+    ],
+)
+def test_citations_are_removed(text, expected):
+    assert apply_rule("citations", text) == expected
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        (
+            "normalized to [0, 1] and the window is [2-5] tokens [12].",
+            "normalized to [0, 1] and the window is [2-5] tokens.",
+        ),
+        ("see [12] and more", "see [12] and more"),
+        ("[3] starts the line", "[3] starts the line"),
+    ],
+)
+def test_citation_rule_keeps_intervals(text, expected):
+    assert apply_rule("citations", text) == expected
+
+
+def test_tables_keep_their_first_cells_and_caption():
+    cells = "\n".join(f"0.{i:03d}" for i in range(20))
+    text = f"A paragraph long enough to not be a cell.\n{cells}\nTable 1: Results"
+    compacted = apply_rule("tables", text)
+    assert "0.005\n[14 more table cells]\nTable 1: Results" in compacted
+    assert "0.006" not in compacted
+
+
+def make_paper():
+    cells = "\n".join(f"0.{i:03d}" for i in range(20))
+    return [
+        "T\nAlice\nU\nBob\nU\nAbstract x",
+        "1 Intro\n" + "word word [1]. " * 100 + "\n" + cells,
+        "2 More\n" + "text " * 200,
+    ]
+
+
+def count(sections, enc):
+    return len(enc.encode_ordinary("\n".join(sections)))
+
+
+def test_noise_is_removed_without_a_budget(enc):
+    sections = make_paper()
+    compacted, report = compact_sections(sections, enc)
+    assert report == {"saved": {"affiliations": 1}, "pruned": False}
+    assert count(compacted, enc) == count(sections, enc) - 1
+
+
+def test_pruning_stops_when_the_paper_fits(enc):
+    sections = make_paper()
+    max_tokens = count(sections, enc) - 51
+    compacted, report = compact_sections(sections, enc, max_tokens=max_tokens)
+    assert report["pruned"]
+    # citations are pruned before tables
+    assert "tables" not in report["saved"]
+    assert max_tokens - 5 <= count(compacted, enc) <= max_tokens
+    assert "0.019" in compacted[1]
+
+
+def test_tables_are_pruned_after_citations(enc):
+    sections = make_paper()
+    # 1 token of noise and 100 of citations, the rest from the table
+    max_tokens = count(sections, enc) - 1 - 100 - 5
+    compacted, report = compact_sections(sections, enc, max_tokens=max_tokens)
+    assert report["pruned"]
+    assert report["saved"]["citations"] == 100
+    assert "more table cells" in compacted[1]
+    assert count(compacted, enc) <= max_tokens
+
+
+def test_nothing_is_pruned_if_the_paper_cannot_fit(enc):
+    sections = make_paper()
+    compacted, report = compact_sections(sections, enc, max_tokens=10)
+    assert not report["pruned"]
+    assert "[1]" in compacted[1]
+    assert "format" not in format_report(report)
+
+
+def test_compact_paper_is_cached(enc, paper_cache):
+    calls = []
+
+    class CountingEncoder(type(enc)):
+        def encode_ordinary_batch(self, texts, num_threads=8):
+            calls.append(len(texts))
+            return super().encode_ordinary_batch(texts, num_threads)
+
+    counting = CountingEncoder()
+    first = compact_paper(paper_cache, "key.v1", make_paper(), counting)
+    num_calls = len(calls)
+    assert num_calls > 0
+    second = compact_paper(paper_cache, "key.v1", make_paper(), counting)
+    assert second == first
+    assert len(calls) == num_calls
+    # another budget is compacted again
+    compact_paper(
+        paper_cache, "key.v1", make_paper(), counting, max_prompt_tokens=10**6
+    )
+    assert len(calls) > num_calls
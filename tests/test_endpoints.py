@@ -0,0 +1,81 @@
+import gc
+import asyncio
+
+import pytest
+
+from endpoints import EndpointPool
+from fakes import FakeOpenAIServer
+
+
+@pytest.fixture
+def server():
+    with FakeOpenAIServer(num_chunks=5) as server:
+        yield server
+
+
+def request(endpoint):
+    return endpoint.create(messages=[{"role": "user", "content": "Hello"}])
+
+
+def test_stream_counts_as_active_until_exhausted(server):
+    endpoint = server.endpoint("fake")
+    pool = EndpointPool([endpoint])
+
+    async def read():
+        stream = await pool.run(request, prompt_tokens=10)
+        assert endpoint.active == 1
+        return [chunk async for chunk in stream]
+
+    assert len(asyncio.run(read())) > 1
+    assert endpoint.active == 0
+
+
+@pytest.mark.parametrize("how", ["unread", "abandoned", "closed"])
+def test_stream_not_read_to_the_end_releases_endpoint(server, how):
+    endpoint = server.endpoint("fake")
+    pool = EndpointPool([endpoint])
+
+    async def read():
+        stream = await pool.run(request, prompt_tokens=10)
+        if how != "unread":
+            async for _ in stream:
+                break
+        if how == "closed":
+            await stream.aclose()
+            assert endpoint.active == 0
+
+    asyncio.run(read())
+    gc.collect()
+    assert endpoint.active == 0
+
+
+def test_requests_go_to_the_endpoints_of_their_model(server):
+    gpt4 = server.endpoint("gpt4")
+    gpt35 = server.endpoint("gpt35", model="gpt-35-turbo")
+    pool = EndpointPool([gpt4, gpt35])
+
+    async def read(model):
+        stream = await pool.run(request, prompt_tokens=10, model=model)
+        return [chunk async for chunk in stream]
+
+    asyncio.run(read("gpt-35-turbo"))
+    assert (gpt4.requests, gpt35.requests) == (0, 1)
+    with pytest.raises(ValueError):
+        asyncio.run(read("gpt-4"))
+
+
+def test_failed_request_goes_to_another_endpoint(server):
+    with FakeOpenAIServer(num_chunks=5, fail_status=429, retry_after=30) as busy:
+        first, second = busy.endpoint("busy"), server.endpoint("free")
+        pool = EndpointPool([first, second])
+
+        async def read():
+            stream = await pool.run(request, prompt_tokens=10)
+            return [chunk async for chunk in stream]
+
+        assert len(asyncio.run(read())) > 1
+        assert (busy.requests, server.requests) == (1, 1)
+        assert first.health()["healthy"] is False
+        # the busy endpoint is paused for its Retry-After
+        assert pool.choose(10) is second
+        assert first.expected_wait(10) > 20
@@ -0,0 +1,39 @@
+import pytest
+
+from fanout import merge_answers, parse_question_groups
+
+
+def test_merge_answers_orders_questions():
+    answers = [
+        "## Q3: Results\nGood.\n\n## Q4: Limits\nFew.",
+        "## Q1: Title\nA paper.\n## Q2: Authors\nSomeone.",
+    ]
+    assert merge_answers(answers) == (
+        "## Q1: Title\nA paper.\n\n## Q2: Authors\nSomeone.\n\n"
+        "## Q3: Results\nGood.\n\n## Q4: Limits\nFew."
+    )
+
+
+def test_merge_answers_keeps_preambles_with_their_answer():
+    answers = [
+        "Part two.\n## Q5: Code\nNone.",
+        "Part one.\n## Q2: Authors\nSomeone.\n## Q1: Title\nA paper.",
+    ]
+    assert merge_answers(answers).split("\n\n") == [
+        "Part one.",
+        "## Q1: Title\nA paper.",
+        "## Q2: Authors\nSomeone.",
+        "Part two.",
+        "## Q5: Code\nNone.",
+    ]
+
+
+def test_merge_answers_without_headings():
+    assert merge_answers(["First.", "", "Second."]) == "First.\n\nSecond."
+
+
+def test_parse_question_groups():
+    assert parse_question_groups("1-3, 4+19") == [[1, 2, 3], [4, 19]]
+    for spec in ["1-3,3-5", "1-20", "1,,2", "x"]:
+        with pytest.raises(ValueError):
+            parse_question_groups(spec)
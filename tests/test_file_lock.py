@@ -0,0 +1,37 @@
+import asyncio
+
+import pytest
+
+from file_lock import get_lock, remove_stale_locks
+
+
+def test_names_have_their_own_lock(tmp_path):
+    with get_lock(tmp_path, "a"):
+        other = get_lock(tmp_path, "b")
+        assert other.acquire(blocking=False)
+        assert not get_lock(tmp_path, "a").acquire(blocking=False)
+        other.release()
+
+
+def test_lock_file_is_removed_on_release(tmp_path):
+    lock = get_lock(tmp_path, "a")
+    with lock:
+        assert lock.path.exists()
+    assert list(tmp_path.glob("*.lock")) == []
+
+
+def test_blocking_acquire_in_event_loop_raises(tmp_path):
+    async def take():
+        with pytest.raises(RuntimeError):
+            get_lock(tmp_path, "a").acquire()
+        async with get_lock(tmp_path, "a") as lock:
+            return lock.locked
+
+    assert asyncio.run(take())
+
+
+def test_remove_stale_locks_keeps_held_locks(tmp_path):
+    (tmp_path / "0000.lock").touch()
+    with get_lock(tmp_path, "a") as held:
+        assert remove_stale_locks(tmp_path) == 1
+        assert list(tmp_path.glob("*.lock")) == [held.path]
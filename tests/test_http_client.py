@@ -0,0 +1,149 @@
+import time
+import socket
+import asyncio
+import contextlib
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+from arxiv_loader import PaperRenderInProgress, fetch_paper_html_async
+from http_client import HttpClient
+from paper_cache import read_blob_text
+
+PAGE = "<html><body><div class='ltx_page_content'>Text</div></body></html>"
+
+
+class Server:
+    """
+    Answers the first requests with `statuses` (a status, or a status and
+    its headers), then with PAGE.
+    """
+
+    def __init__(self, statuses=(), delay=0.0):
+        self.statuses = list(statuses)
+        self.delay = delay
+        self.requests = 0
+        self.active = 0
+        self.max_active = 0
+
+    async def handle(self, request):
+        self.requests += 1
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+            if not self.statuses:
+                return web.Response(text=PAGE, content_type="text/html")
+            status = self.statuses.pop(0)
+            headers = {}
+            if isinstance(status, tuple):
+                status, headers = status
+            return web.Response(status=status, text="Not yet", headers=headers)
+        finally:
+            self.active -= 1
+
+    @contextlib.asynccontextmanager
+    async def run(self):
+        app = web.Application()
+        app.router.add_get("/{path:.*}", self.handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = runner.addresses[0][:2]
+        try:
+            yield f"http://{host}:{port}"
+        finally:
+            await runner.cleanup()
+
+
+async def get(server, path="/paper", **kwargs):
+    async with server.run() as url, HttpClient(backoff=0.01, **kwargs) as client:
+        return await client.get(url + path)
+
+
+def test_retries_overloaded_responses():
+    server = Server([503, 502, 429])
+    response = asyncio.run(get(server))
+    assert (response.status, response.text) == (200, PAGE)
+    assert server.requests == 4
+
+
+def test_honours_retry_after():
+    server = Server([(429, {"Retry-After": "0.3"})])
+    start = time.monotonic()
+    assert asyncio.run(get(server)).status == 200
+    assert time.monotonic() - start >= 0.3
+
+
+def test_returns_the_last_response_after_max_retries():
+    server = Server([503] * 5)
+    assert asyncio.run(get(server, max_retries=2)).status == 503
+    assert server.requests == 3
+
+
+def test_other_errors_are_not_retried():
+    server = Server([404])
+    assert asyncio.run(get(server)).status == 404
+    assert server.requests == 1
+
+
+def test_connection_errors_are_retried_then_raised():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+
+    async def main():
+        async with HttpClient(backoff=0.01, max_retries=1) as client:
+            await client.get(f"http://127.0.0.1:{port}/paper")
+
+    with pytest.raises(aiohttp.ClientConnectionError):
+        asyncio.run(main())
+
+
+def test_limits_concurrent_requests_per_host():
+    server = Server(delay=0.05)
+
+    async def main():
+        async with server.run() as url, HttpClient(
+            host_limits={"127.0.0.1": 2}
+        ) as client:
+            await asyncio.gather(*(client.get(f"{url}/{i}") for i in range(6)))
+
+    asyncio.run(main())
+    assert (server.requests, server.max_active) == (6, 2)
+
+
+def fetch(server, render_timeout):
+    async def main():
+        async with server.run() as url, HttpClient(backoff=0.01) as client:
+            return await fetch_paper_html_async(
+                f"{url}/paper",
+                client,
+                render_timeout=render_timeout,
+                poll_interval=0.05,
+            )
+
+    return asyncio.run(main())
+
+
+def test_rendering_paper_fails_at_once_by_default(loader_cache):
+    server = Server([503])
+    with pytest.raises(PaperRenderInProgress):
+        fetch(server, render_timeout=0)
+    assert server.requests == 1
+
+
+def test_rendering_paper_is_polled_until_it_renders(loader_cache):
+    server = Server([503, 503])
+    path = fetch(server, render_timeout=5)
+    assert server.requests == 3
+    assert read_blob_text(path) == PAGE
+
+
+def test_rendering_paper_is_polled_until_the_timeout(loader_cache):
+    server = Server([503] * 100)
+    with pytest.raises(PaperRenderInProgress):
+        fetch(server, render_timeout=0.2)
+    assert 3 <= server.requests <= 6
@@ -0,0 +1,61 @@
+from incremental import diff_sections, plan_update
+
+INTRO = "Introduction\nWe study the reading of papers by language models."
+METHOD = "Method\nWe split the paper into sections and ask questions about each."
+RESULTS = "Results\nThe summaries are as good as those of the full paper."
+
+
+def make_snapshot(sections):
+    return {
+        "updated": "2023-01-01T00:00:00Z",
+        "sections": sections,
+        "content": "## Q1: What is the paper about?\nReading papers.",
+        "num_prompt_tokens": 1000,
+        "num_generated_tokens": 100,
+    }
+
+
+def test_diff_ignores_whitespace():
+    reflowed = METHOD.replace(" the paper", "\n  the   paper")
+    assert diff_sections([INTRO, METHOD], [INTRO, reflowed]) == []
+
+
+def test_diff_matches_sections_by_title():
+    changed = METHOD + " Then the answers are merged."
+    changes = diff_sections([INTRO, METHOD, RESULTS], [changed, INTRO, METHOD])
+    assert [(c["status"], c["title"]) for c in changes] == [
+        ("added", "Method"),
+        ("removed", "Results"),
+    ]
+
+    changes = diff_sections([INTRO, METHOD], [INTRO, changed, RESULTS])
+    assert [(c["status"], c["title"], c["changed_words"]) for c in changes] == [
+        ("changed", "Method", 5),
+        ("added", "Results", len(RESULTS.split())),
+    ]
+    assert changes[0]["text"] == changed
+
+
+def test_plan_reuses_summary_of_small_changes(enc):
+    typo = INTRO.replace("language", "langauge")
+    snapshot = make_snapshot([INTRO, METHOD])
+    assert plan_update(snapshot, [typo, METHOD], enc, 10_000) == ("reuse", None, 0)
+
+
+def test_plan_sends_only_the_changed_sections(enc):
+    snapshot = make_snapshot([INTRO, METHOD])
+    action, messages, num_tokens = plan_update(
+        snapshot, [INTRO, METHOD, RESULTS], enc, 10_000
+    )
+    assert action == "update"
+    assert num_tokens > 0
+    prompt = "\n".join(m["content"] for m in messages)
+    assert RESULTS in prompt
+    assert snapshot["content"] in prompt
+    assert METHOD not in prompt
+
+
+def test_plan_summarizes_again_if_the_update_is_too_long(enc):
+    snapshot = make_snapshot([INTRO])
+    sections = [INTRO, METHOD, RESULTS]
+    assert plan_update(snapshot, sections, enc, 10) == ("full", None, 0)
@@ -0,0 +1,130 @@
+import os
+import time
+import asyncio
+
+import pytest
+from openai.error import InvalidRequestError
+
+from endpoints import EndpointPool, set_endpoint_pool
+from fakes import FakeOpenAIServer
+from llm import create_stream, fetch_response_with_streaiming, set_response_cache
+from llm_cache import EVICT_INTERVAL, ResponseCache, make_cache_key
+
+MESSAGES = [{"role": "user", "content": "Summarize the paper"}]
+
+
+@pytest.fixture
+def server():
+    with FakeOpenAIServer(content="A short summary.", num_chunks=4, ttft=0.2) as server:
+        set_endpoint_pool(EndpointPool([server.endpoint("fake")]))
+        yield server
+    set_endpoint_pool(None)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = ResponseCache(tmp_path / "responses")
+    set_response_cache(cache)
+    yield cache
+    set_response_cache(None)
+
+
+def ask(messages=MESSAGES):
+    stream = create_stream(messages=messages, prompt_tokens=10)
+    return fetch_response_with_streaiming(stream, echo=False)
+
+
+def test_repeated_prompt_is_replayed(server, cache):
+    assert asyncio.run(ask()) == "A short summary."
+    assert asyncio.run(ask()) == "A short summary."
+    assert server.requests == 1
+
+    cache.bypass = True
+    assert asyncio.run(ask()) == "A short summary."
+    assert server.requests == 2
+
+
+def test_responses_are_cached_by_model_and_temperature(server, cache):
+    asyncio.run(ask())
+    key = make_cache_key(MESSAGES, model="gpt-4-32k", temperature=0)
+    assert cache.get(key) == "A short summary."
+    assert cache.get(make_cache_key(MESSAGES, model="gpt-4", temperature=0)) is None
+def test_concurrent_requests_make_one_call(server, cache):
+    async def main():
+        return await asyncio.gather(*(ask() for _ in range(3)))
+
+    answers = asyncio.run(main())
+    assert answers == ["A short summary."] * 3
+    assert server.requests == 1
+
+    assert asyncio.run(ask()) == "A short summary."
+    assert server.requests == 1
+
+
+def test_failed_request_releases_the_prompt(server, cache):
+    server.fail_status = 400
+    with pytest.raises(InvalidRequestError):
+        asyncio.run(ask())
+    key = make_cache_key(MESSAGES, model="gpt-4-32k", temperature=0)
+    assert cache.get(key) is None
+    lock = cache.lock(key)
+    assert lock.acquire(blocking=False)
+    lock.release()
+
+    server.fail_status = None
+    assert asyncio.run(ask()) == "A short summary."
+
+
+def count_scans(cache, monkeypatch):
+    scans = []
+    evict = cache.evict
+
+    def counting_evict():
+        scans.append(len(list(cache.cache_dir.glob("*.json"))))
+        evict()
+
+    monkeypatch.setattr(cache, "evict", counting_evict)
+    return scans
+
+
+def test_put_scans_the_cache_every_interval(tmp_path, monkeypatch):
+    cache = ResponseCache(tmp_path / "responses")
+    scans = count_scans(cache, monkeypatch)
+    for i in range(2 * EVICT_INTERVAL + 50):
+        cache.put(f"key{i}", "A short summary.")
+    # the first put, then one scan per EVICT_INTERVAL puts
+    assert scans == [1, EVICT_INTERVAL + 1, 2 * EVICT_INTERVAL + 1]
+
+
+def test_put_evicts_least_recently_used_at_the_limit(tmp_path, monkeypatch):
+    cache = ResponseCache(tmp_path / "responses", max_entries=5)
+    scans = count_scans(cache, monkeypatch)
+    now = time.time()
+    for i in range(5):
+        cache.put(f"key{i}", "A short summary.")
+        os.utime(cache._path(f"key{i}"), (now - 100 + i, now - 100 + i))
+    # key0 is used again
+    assert cache.get("key0") == "A short summary."
+    assert len(scans) == 1
+
+    cache.put("key5", "A short summary.")
+    cache.put("key6", "A short summary.")
+    assert len(scans) == 3
+    assert sorted(p.stem for p in cache.cache_dir.glob("*.json")) == [
+        "key0",
+        "key3",
+        "key4",
+        "key5",
+        "key6",
+    ]
+
+
+def test_put_evicts_at_the_size_limit(tmp_path, monkeypatch):
+    cache = ResponseCache(tmp_path / "responses", max_bytes=2000)
+    scans = count_scans(cache, monkeypatch)
+    for i in range(10):
+        cache.put(f"key{i}", "x" * 500)
+    # the bytes put since the last scan trigger the next one
+    assert 1 < len(scans) < 10
+    total = sum(p.stat().st_size for p in cache.cache_dir.glob("*.json"))
+    assert total <= 2000
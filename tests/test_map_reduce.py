@@ -0,0 +1,36 @@
+from map_reduce import plan_chunks
+
+
+def words(n, word="word"):
+    return " ".join([word] * n)
+
+
+def test_small_paper_is_one_chunk(enc):
+    sections = ["Introduction\n" + words(10), "Method\n" + words(10)]
+    assert plan_chunks(sections, enc, max_tokens=100) == ["\n\n".join(sections)]
+
+
+def test_sections_are_spread_evenly(enc):
+    # 5 sections of 30 tokens fill 2 chunks of 100: 3 + 2 sections, not 3 + 3
+    sections = [f"S{i} " + words(29) for i in range(5)]
+    chunks = plan_chunks(sections, enc, max_tokens=100)
+    assert [len(chunk.split()) for chunk in chunks] == [90, 60]
+    assert "\n\n".join(chunks) == "\n\n".join(sections)
+
+
+def test_long_sections_are_split(enc):
+    section = "\n".join(["Title"] + [words(20, f"line{i}") for i in range(10)])
+    chunks = plan_chunks(["", section], enc, max_tokens=50)
+    assert all(len(chunk.split()) <= 50 for chunk in chunks)
+    assert " ".join(chunks).split() == section.split()
+
+    # a line longer than a chunk is cut by tokens
+    chunks = plan_chunks([words(120)], enc, max_tokens=50)
+    assert [len(chunk.split()) for chunk in chunks] == [50, 50, 20]
+
+
+def test_uses_the_given_section_tokens(enc):
+    sections = ["a " * 10, "b " * 10]
+    # the counts are trusted, so the sections don't fit in one chunk
+    assert len(plan_chunks(sections, enc, max_tokens=15, section_tokens=[10, 10])) == 2
+    assert len(plan_chunks(sections, enc, max_tokens=25, section_tokens=[10, 10])) == 1
@@ -0,0 +1,71 @@
+import asyncio
+
+import pytest
+
+import arxiv_loader
+from fakes import FakeServer
+from http_client import HttpClient
+from metadata_store import MetadataStore
+
+ARXIV_IDS = [f"2301.{i:05d}" for i in range(1, 251)]
+
+
+@pytest.fixture
+def arxiv_api(monkeypatch):
+    with FakeServer({}) as server:
+        monkeypatch.setattr(arxiv_loader, "ARXIV_API_URL", f"{server.url}/api/query")
+        yield server
+
+
+@pytest.fixture
+def store(tmp_path):
+    return MetadataStore(tmp_path / "metadata.sqlite3")
+
+
+def metadata(updated, title="A paper"):
+    return {"updated": updated, "title": title}
+
+
+def test_round_trip(store, tmp_path):
+    assert store.get("2303.01469") is None
+    store.put_many(
+        {
+            "2303.01469": metadata("2023-03-02T00:00:00Z", "Version 1"),
+            "2304.00001": metadata("2023-04-01T00:00:00Z"),
+        }
+    )
+    store.put_many({"2303.01469": metadata("2023-05-01T00:00:00Z", "Version 2")})
+    # the latest version wins, and the store is kept between runs
+    store = MetadataStore(tmp_path / "metadata.sqlite3")
+    assert store.get("2303.01469")["title"] == "Version 2"
+    assert store.get("2304.00001") == metadata("2023-04-01T00:00:00Z")
+    assert store.get("2303.01469", max_age=-1) is None
+
+
+def test_load_many_in_batches(store, arxiv_api):
+    results = store.load_many(ARXIV_IDS, batch_size=100)
+    assert list(results) == ARXIV_IDS
+    assert results["2301.00042"]["title"] == "Benchmark paper 2301.00042"
+    assert arxiv_api.requests["GET /api/query"] == 3
+
+    # stored papers are not fetched again, unless they are too old
+    more = ARXIV_IDS[:10] + ["2302.00001"]
+    assert set(store.load_many(more, batch_size=100)) == set(more)
+    assert arxiv_api.requests["GET /api/query"] == 4
+    store.load_many(ARXIV_IDS[:10], max_age=0)
+    assert arxiv_api.requests["GET /api/query"] == 5
+    assert store.load("2301.00001")["updated"] == "2023-01-02T00:00:00Z"
+    assert arxiv_api.requests["GET /api/query"] == 5
+
+
+def test_load_many_async_in_batches(store, arxiv_api):
+    async def main():
+        async with HttpClient() as client:
+            first = await store.load_many_async(ARXIV_IDS, client, batch_size=100)
+            second = await store.load_many_async(ARXIV_IDS, client, batch_size=100)
+            return first, second
+
+    first, second = asyncio.run(main())
+    assert first == second
+    assert list(first) == ARXIV_IDS
+    assert arxiv_api.requests["GET /api/query"] == 3
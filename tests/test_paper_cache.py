@@ -0,0 +1,143 @@
+import os
+import json
+import time
+import sqlite3
+from pathlib import Path
+
+from paper_cache import LEGACY_TEXT_OPTIONS, PaperCache
+from text_cache import get_text_cache_key, load_paper_text
+
+
+def make_cache(tmp_path, max_bytes):
+    return PaperCache(tmp_path / "cache", max_bytes=max_bytes, codec=None)
+
+
+def usage(cache):
+    with cache._connect() as conn:
+        return conn.execute("SELECT stored_size FROM usage").fetchone()[0]
+
+
+def test_put_evicts_least_recently_used(tmp_path):
+    cache = make_cache(tmp_path, max_bytes=3000)
+    for i in range(5):
+        cache.put(f"paper{i}", "html", "x" * 1000)
+        time.sleep(0.01)
+    cache.get("paper2", "html")
+    cache.put("paper5", "html", "x" * 1000)
+    assert sorted(e["key"] for e in cache.entries("html")) == [
+        "paper2",
+        "paper4",
+        "paper5",
+    ]
+
+
+def test_summaries_and_snapshots_are_not_evicted(tmp_path):
+    cache = make_cache(tmp_path, max_bytes=1500)
+    cache.put("paper", "summary", "s" * 2000, compress=False)
+    cache.put("paper", "snapshot", "s" * 2000)
+    cache.put("paper", "html", "x" * 1000)
+    cache.put("other", "html", "x" * 1000)
+    assert [e["key"] for e in cache.entries("html")] == ["other"]
+
+    cache.gc(max_bytes=0, max_age=0)
+    assert cache.entries("html") == []
+    assert cache.get_text("paper", "summary") == "s" * 2000
+    assert cache.get_text("paper", "snapshot") == "s" * 2000
+
+
+def test_usage_follows_puts_and_deletes(tmp_path):
+    cache = make_cache(tmp_path, max_bytes=None)
+    cache.put("a", "html", "x" * 100)
+    cache.put("b", "text", "x" * 200)
+    cache.put("a", "html", "x" * 50)
+    cache.put("a", "summary", "x" * 1000, compress=False)
+    assert usage(cache) == 250
+    cache.delete("b", "text")
+    assert usage(cache) == 50
+
+    # a new process counts the index it opens
+    assert usage(PaperCache(cache.root, max_bytes=None, codec=None)) == 50
+
+
+def test_migrate_evicts_once(tmp_path):
+    legacy = tmp_path / "legacy"
+    legacy.mkdir()
+    for i in range(4):
+        (legacy / f"{i:064x}.html").write_text("x" * 1000)
+    cache = make_cache(tmp_path, max_bytes=2500)
+    assert cache.migrate(legacy) == 4
+    assert len(cache.entries("html")) == 2
+    assert usage(cache) == 2000
+
+
+def test_migrate_baseline_files(tmp_path):
+    # the files the first versions wrote to src/.cached
+    legacy = tmp_path / "legacy"
+    legacy.mkdir()
+    url_hash = "ab" * 32
+    (legacy / f"{url_hash}.html").write_text("<html>paper</html>")
+    (legacy / f"{url_hash}.txt").write_text("The reduced text")
+    (legacy / f"{url_hash}.summary.txt").write_text("The summary")
+    cache = make_cache(tmp_path, max_bytes=None)
+    assert cache.migrate(legacy) == 3
+    assert list(legacy.iterdir()) == []
+
+    assert cache.get_text(url_hash, "html") == "<html>paper</html>"
+    assert cache.get_text(url_hash, "summary") == "The summary"
+    [text] = cache.entries("text")
+    assert text["options"] == LEGACY_TEXT_OPTIONS
+    data = json.loads(cache.get_text(text["key"], "text"))
+    assert data == {"paper_content": "The reduced text", "sections": []}
+    # no parse options match the old text, the paper is parsed again
+    assert load_paper_text(cache, get_text_cache_key(url_hash)) is None
+
+
+def test_gc_ignores_files_removed_meanwhile(tmp_path, monkeypatch):
+    cache = make_cache(tmp_path, max_bytes=None)
+    orphans = []
+    for i in range(3):
+        path = cache.blob_dir / "ab" / "cd" / f"orphan{i}.html.gz"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"x" * 100)
+        os.utime(path, (0, 0))
+        orphans.append(path)
+
+    # another process removes the first orphan while gc lists them
+    glob = Path.glob
+
+    def racing_glob(self, pattern):
+        paths = list(glob(self, pattern))
+        if self == cache.blob_dir:
+            orphans[0].unlink()
+        return paths
+
+    monkeypatch.setattr(Path, "glob", racing_glob)
+    assert cache.gc() == (2, 200)
+    assert not any(path.exists() for path in orphans)
+
+
+def test_connections_are_closed(tmp_path, monkeypatch):
+    opened = []
+    connect = sqlite3.connect
+
+    class Connection(sqlite3.Connection):
+        closed = False
+
+        def close(self):
+            self.closed = True
+            super().close()
+
+    def tracking_connect(*args, **kwargs):
+        conn = connect(*args, factory=Connection, **kwargs)
+        opened.append(conn)
+        return conn
+
+    monkeypatch.setattr(sqlite3, "connect", tracking_connect)
+    cache = make_cache(tmp_path, max_bytes=1500)
+    for i in range(3):
+        cache.put(f"{i:064x}", "html", "x" * 1000)
+    cache.get(f"{2:064x}", "html")
+    cache.stats()
+    cache.gc(max_age=3600)
+    assert opened
+    assert all(conn.closed for conn in opened)
@@ -0,0 +1,64 @@
+import pytest
+
+from paper_index import PaperIndex, split_chunks, tokenize
+from text_cache import get_text_cache_key, save_paper_text
+
+PAPERS = {
+    "2301.00001": [
+        "Introduction\nTransformers read long documents slowly.",
+        "Method\nWe compress the attention of transformers with sparse kernels.",
+    ],
+    "2301.00002": [
+        "Introduction\nGraph neural networks classify molecules.",
+        "Results\nThe molecules are classified with high accuracy.",
+    ],
+}
+
+
+@pytest.fixture
+def index(paper_cache, tmp_path):
+    for arxiv_id, sections in PAPERS.items():
+        key = get_text_cache_key(arxiv_id)
+        save_paper_text(
+            paper_cache, key, "\n".join(sections), sections, arxiv_id=arxiv_id
+        )
+    index = PaperIndex(tmp_path / "search_index")
+    index.update(paper_cache)
+    return index
+
+
+def test_tokenize_drops_stopwords_and_single_letters():
+    assert tokenize("The x-ray of a GPT-4 model") == ["ray", "gpt", "model"]
+
+
+def test_split_chunks_keeps_paragraphs_together():
+    section = "one two three\nfour five\nsix seven eight nine ten eleven"
+    assert split_chunks([section], chunk_words=5) == [
+        (0, "one two three\nfour five"),
+        (0, "six seven eight nine ten"),
+        (0, "eleven"),
+    ]
+
+
+def test_search_ranks_matching_chunks(index):
+    results = index.search("sparse attention kernels")
+    assert [chunk[:3] for _, chunk in results] == [("2301.00001", 1, "Method")]
+
+    results = index.search("molecules")
+    assert sorted(chunk[:2] for _, chunk in results) == [
+        ("2301.00002", 0),
+        ("2301.00002", 1),
+    ]
+    assert index.search("unrelated words") == []
+
+
+def test_search_shares_results_between_papers(index):
+    results = index.search("transformers", top_k=2, arxiv_ids=list(PAPERS))
+    assert sorted(chunk[0] for _, chunk in results) == list(PAPERS)
+
+
+def test_update_drops_removed_papers(index, paper_cache):
+    paper_cache.delete(get_text_cache_key("2301.00002"), "text")
+    assert index.update(paper_cache) == 1
+    assert index.search("molecules") == []
+    assert index.update(paper_cache) == 0
@@ -0,0 +1,113 @@
+import io
+import asyncio
+
+import pytest
+
+from arxiv_loader import PaperRenderInProgress, parse_listing_ids
+from make_fixtures import LISTING_PAPERS
+from prefetch import Prefetcher
+from read_paper import get_paper_urls
+from run_benchmarks import LISTING_FIXTURE
+
+LISTING_IDS = [arxiv_id for arxiv_id, _, _ in LISTING_PAPERS]
+
+
+@pytest.fixture
+def prefetcher(fake_services, enc):
+    prefetcher = Prefetcher(
+        max_parsers=1, delay=0, parser="lxml", retry_interval=0.05, render_timeout=5
+    )
+    prefetcher.enc = enc
+    return prefetcher
+
+
+def test_parse_listing_page():
+    text = LISTING_FIXTURE.read_text(encoding="utf-8")
+    assert parse_listing_ids(text) == LISTING_IDS
+
+
+def test_parse_listing_feed_and_ids():
+    feed = (
+        "<feed><entry><id>http://arxiv.org/abs/2303.01469v2</id></entry>"
+        "<entry><id>http://arxiv.org/abs/hep-th/9901001v1</id></entry>"
+        "<entry><summary>Extends arXiv:2303.01469</summary></entry></feed>"
+    )
+    assert parse_listing_ids(feed) == ["2303.01469", "hep-th/9901001"]
+    ids = "# today\n2303.01469v3\n\n2304.00001  # a comment\n2303.01469\n"
+    assert parse_listing_ids(ids) == ["2303.01469", "2304.00001"]
+
+
+def read_listing(prefetcher, listing):
+    async def main():
+        async with prefetcher.open():
+            return await prefetcher.read_listing(listing)
+
+    return asyncio.run(main())
+
+
+def test_read_listing(prefetcher, fake_services, tmp_path, monkeypatch):
+    papers, _ = fake_services
+    # a category, the URL of its listing, a file and stdin
+    assert read_listing(prefetcher, "cs.CL") == LISTING_IDS
+    assert read_listing(prefetcher, f"{papers.url}/list/cs.CL/new") == LISTING_IDS
+    assert read_listing(prefetcher, str(LISTING_FIXTURE)) == LISTING_IDS
+    monkeypatch.setattr("sys.stdin", io.StringIO("2303.01469\n2304.00001\n"))
+    assert read_listing(prefetcher, "-") == ["2303.01469", "2304.00001"]
+
+    with pytest.raises(ValueError):
+        read_listing(prefetcher, str(tmp_path / "missing" / "ids.txt"))
+
+
+def fetch(prefetcher, arxiv_id):
+    async def main():
+        async with prefetcher.open():
+            return await prefetcher._fetch(arxiv_id, get_paper_urls(arxiv_id))
+
+    return asyncio.run(main())
+
+
+def test_rendering_paper_is_fetched_again(prefetcher, fake_services):
+    papers, _ = fake_services
+    papers.rendering["2301.00001"] = 2
+    _, html_path = fetch(prefetcher, "2301.00001")
+    assert html_path.exists()
+    assert papers.requests["GET /papers/2301.00001/"] == 3
+    stats = prefetcher.stats["fetch"]
+    assert (stats.count, stats.failed) == (3, 2)
+
+
+def test_rendering_paper_gives_up_at_the_timeout(prefetcher, fake_services):
+    papers, _ = fake_services
+    papers.rendering["2301.00001"] = 100
+    # fetched at 0, 0.2 and 0.4s, a fetch at 0.6s would be past the timeout
+    prefetcher.retry_interval = 0.2
+    prefetcher.render_timeout = 0.5
+    with pytest.raises(PaperRenderInProgress):
+        fetch(prefetcher, "2301.00001")
+    assert papers.requests["GET /papers/2301.00001/"] == 3
+
+
+def test_watch_rounds_skip_the_prefetched_papers(prefetcher, fake_services):
+    papers, _ = fake_services
+    # one paper of the listing is still rendering
+    papers.rendering["2301.00002"] = 100
+    prefetcher.render_timeout = 0
+
+    async def main():
+        async with prefetcher.open():
+            first = await prefetcher.run_once(["cs.CL"])
+            papers.rendering.clear()
+            second = await prefetcher.run_once(["cs.CL"])
+            third = await prefetcher.run_once(["cs.CL"])
+            return first, second, third
+
+    first, second, third = asyncio.run(main())
+    assert list(first) == LISTING_IDS
+    assert first["2301.00002"] == "render in progress"
+    # the failed paper is tried again by the next round, and only it
+    assert second == {"2301.00002": None}
+    assert third == {}
+    assert prefetcher.done == set(LISTING_IDS)
+    for arxiv_id in LISTING_IDS:
+        expected = 2 if arxiv_id == "2301.00002" else 1
+        assert papers.requests[f"GET /papers/{arxiv_id}/"] == expected
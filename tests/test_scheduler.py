@@ -0,0 +1,70 @@
+import time
+import asyncio
+
+from llm import PRIORITY_ANSWER, PRIORITY_NOTES, LLMScheduler
+
+
+def admission_order(scheduler, requests):
+    """
+    Queues the requests (name, prompt tokens, priority) while the scheduler
+    is paused and returns the names in the order they are admitted.
+    """
+    order = []
+
+    async def request(name, prompt_tokens, priority):
+        await scheduler.acquire(prompt_tokens, priority)
+        order.append(name)
+
+    async def main():
+        scheduler.pause(0.05)
+        await asyncio.gather(*(request(*r) for r in requests))
+
+    asyncio.run(main())
+    return order
+
+
+REQUESTS = [
+    ("notes", 100, PRIORITY_NOTES),
+    ("long", 5000, PRIORITY_ANSWER),
+    ("short", 100, PRIORITY_ANSWER),
+    ("short2", 100, PRIORITY_ANSWER),
+]
+
+
+def test_admits_by_priority_then_shortest_then_oldest():
+    order = admission_order(LLMScheduler(), REQUESTS)
+    assert order == ["short", "short2", "long", "notes"]
+
+
+def test_requests_that_waited_too_long_go_first():
+    order = admission_order(LLMScheduler(max_wait=0), REQUESTS)
+    assert order == ["notes", "long", "short", "short2"]
+
+
+def test_waits_for_the_token_budget():
+    # 1000 tokens per second, the first request empties the bucket
+    scheduler = LLMScheduler(tpm=60_000, expected_completion_tokens=0)
+
+    async def main():
+        await scheduler.acquire(60_000)
+        assert scheduler.estimate_wait(100) > 0.05
+        start = time.monotonic()
+        await scheduler.acquire(100)
+        return time.monotonic() - start
+
+    assert 0.05 < asyncio.run(main()) < 1.0
+
+
+def test_cancelled_request_leaves_the_queue():
+    scheduler = LLMScheduler()
+
+    async def main():
+        scheduler.pause(0.05)
+        task = asyncio.create_task(scheduler.acquire(100))
+        await asyncio.sleep(0)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        assert not scheduler._waiters
+        await scheduler.acquire(100)
+
+    asyncio.run(main())
@@ -0,0 +1,151 @@
+import json
+import asyncio
+import contextlib
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+from batch_read_papers import BatchPipeline
+from conftest import SUMMARY
+from paper_cache import read_blob_text
+from server import SummaryServer
+
+PAPER = "ar5iv-small"
+
+
+@pytest.fixture
+def server(fake_services, monkeypatch, enc):
+    """
+    A SummaryServer running the real BatchPipeline on the fake services, with
+    an LLM that streams slowly enough for a second request to join the job.
+    server.calls counts the papers processed.
+    """
+    _, llm = fake_services
+    llm.chunk_delay = 0.05
+    pipeline = BatchPipeline(max_parsers=1, parser="lxml")
+    pipeline.enc = enc
+    summary_server = SummaryServer(pipeline, max_jobs=2)
+    summary_server.calls = []
+    process = pipeline.process
+
+    async def counting_process(arxiv_id, on_content=None):
+        summary_server.calls.append(arxiv_id)
+        return await process(arxiv_id, on_content=on_content)
+
+    monkeypatch.setattr(pipeline, "process", counting_process)
+    return summary_server
+
+
+@contextlib.asynccontextmanager
+async def running(summary_server):
+    runner = web.AppRunner(summary_server.make_app())
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    try:
+        async with aiohttp.ClientSession() as session:
+            yield session, f"http://{host}:{port}"
+    finally:
+        await runner.cleanup()
+
+
+async def summarize(session, url, arxiv_id=PAPER):
+    async with session.post(f"{url}/summarize", json={"arxiv_id": arxiv_id}) as r:
+        assert r.status == 200
+        return [json.loads(line) async for line in r.content]
+
+
+async def wait_for_jobs(summary_server):
+    while summary_server.jobs:
+        await asyncio.sleep(0.05)
+
+
+def content_of(events):
+    return "".join(event["content"] for event in events if "content" in event)
+
+
+def test_request_streams_the_summary(server):
+    async def main():
+        async with running(server) as (session, url):
+            return await summarize(session, url)
+
+    events = asyncio.run(main())
+    assert events[0] == {"status": "queued"}
+    assert events[1] == {"status": "running"}
+    assert content_of(events) == SUMMARY
+    # the summary came in several pieces, not at the end
+    assert sum("content" in event for event in events) > 1
+    assert events[-1]["done"] is True
+    assert events[-1]["status"] == "done"
+    assert SUMMARY in read_blob_text(events[-1]["summary_path"])
+
+
+def test_concurrent_requests_join_one_job(server):
+    async def main():
+        async with running(server) as (session, url):
+            return await asyncio.gather(
+                summarize(session, url), summarize(session, url)
+            )
+
+    first, second = asyncio.run(main())
+    assert server.calls == [PAPER]
+    # the late subscriber gets the events it missed first
+    assert first == second
+    assert content_of(first) == SUMMARY
+    assert first[-1]["status"] == "done"
+
+
+def test_job_is_dropped_when_done(server):
+    async def main():
+        async with running(server) as (session, url):
+            await summarize(session, url)
+            await wait_for_jobs(server)
+            async with session.get(f"{url}/jobs") as r:
+                jobs = await r.json()
+            await summarize(session, url)
+            return jobs
+
+    assert asyncio.run(main()) == []
+    # a finished job is not joined, the next request runs the paper again
+    assert server.calls == [PAPER, PAPER]
+
+
+def test_client_disconnect_does_not_stop_the_job(server):
+    async def main():
+        async with running(server) as (session, url):
+            async with session.post(
+                f"{url}/summarize", json={"arxiv_id": PAPER}
+            ) as r:
+                # leave once the summary starts streaming
+                async for line in r.content:
+                    if "content" in json.loads(line):
+                        break
+                job = server.jobs[PAPER]
+            await wait_for_jobs(server)
+            return job, await summarize(session, url)
+
+    job, events = asyncio.run(main())
+    assert job.status == "done"
+    assert not job._subscribers
+    assert content_of(job.events) == SUMMARY
+    assert events[-1]["status"] == "done"
+
+
+def test_failed_paper_ends_the_stream_with_its_error(server):
+    async def main():
+        async with running(server) as (session, url):
+            return await summarize(session, url, arxiv_id="missing")
+
+    events = asyncio.run(main())
+    assert events[-1] == {"done": True, "status": "failed", "error": "not found"}
+
+
+def test_bad_request(server):
+    async def main():
+        async with running(server) as (session, url):
+            async with session.post(f"{url}/summarize", json={}) as r:
+                return r.status
+
+    assert asyncio.run(main()) == 400
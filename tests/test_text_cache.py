@@ -0,0 +1,81 @@
+import asyncio
+import itertools
+
+from arxiv_loader import PARSER_VERSION
+from read_paper import get_source_text_key, load_or_fetch_text
+from text_cache import get_text_cache_key, load_paper_text, save_paper_text
+
+PAPER_URLS = [("ar5iv", "https://ar5iv.labs.arxiv.org/html/2303.01469")]
+SECTIONS = ["1 Introduction\nWe study a problem.", "2 Method\nWe solve it."]
+
+
+def test_key_per_option_set():
+    options = list(itertools.product([False, True], repeat=3))
+    keys = {get_text_cache_key("abc", *option) for option in options}
+    assert len(keys) == len(options)
+    assert get_text_cache_key("abc", keep_latex=True) == (
+        f"abc.v{PARSER_VERSION}-ref0-app0-latex1"
+    )
+
+
+def test_round_trip(paper_cache):
+    key = get_text_cache_key("abc", keep_ref=True)
+    assert load_paper_text(paper_cache, key) is None
+    save_paper_text(paper_cache, key, "\n\n".join(SECTIONS), SECTIONS)
+    assert load_paper_text(paper_cache, key) == ("\n\n".join(SECTIONS), SECTIONS)
+    # the other options are not served this text
+    assert load_paper_text(paper_cache, get_text_cache_key("abc")) is None
+
+
+def test_corrupt_text_is_a_miss(paper_cache):
+    key = get_text_cache_key("abc")
+    paper_cache.put(key, "text", "{not json")
+    assert load_paper_text(paper_cache, key) is None
+
+
+class Parser:
+    """
+    The fetch and extract of load_or_fetch_text, counting their calls.
+    """
+
+    def __init__(self, tmp_path):
+        self.html_path = tmp_path / "paper.html"
+        self.fetches = 0
+        self.extracts = []
+
+    async def fetch(self):
+        self.fetches += 1
+        return "ar5iv", self.html_path
+
+    async def extract(self, html_path, source):
+        self.extracts.append((html_path, source))
+        return "\n\n".join(SECTIONS), SECTIONS
+
+
+def load(parser, **kwargs):
+    return asyncio.run(
+        load_or_fetch_text(PAPER_URLS, parser.fetch, parser.extract, **kwargs)
+    )
+
+
+def test_cached_text_skips_fetching_and_parsing(loader_cache, tmp_path):
+    parser = Parser(tmp_path)
+    key, content, sections, cached = load(parser)
+    assert not cached
+    assert key == get_source_text_key(PAPER_URLS[0][1])
+    assert parser.extracts == [(parser.html_path, "ar5iv")]
+
+    assert load(parser) == (key, content, sections, True)
+    assert parser.fetches == 1
+    assert len(parser.extracts) == 1
+
+    # other options are parsed again, and cached on their own
+    other_key, _, _, cached = load(parser, keep_ref=True)
+    assert not cached
+    assert other_key != key
+    assert load(parser, keep_ref=True)[3]
+    assert len(parser.extracts) == 2
+
+    _, _, _, cached = load(parser, force_refresh=True)
+    assert not cached
+    assert len(parser.extracts) == 3
@@ -0,0 +1,102 @@
+import re
+
+import pytest
+
+from arxiv_loader import parse_paper_content
+from run_benchmarks import load_fixtures
+from text_normalizer import RULE_SETS, get_normalizer
+
+
+def baseline_reduce(paper_content):
+    # reduce_paper_content as it was before the normalizer
+    paper_content = paper_content.replace("\r", "\n")
+    paper_content = paper_content.replace("\t", " ")
+    paper_content = paper_content.strip()
+    paper_content = re.sub(r"\n\s+", "\n", paper_content)
+    paper_content = re.sub(r"\s+\n", "\n", paper_content)
+    paper_content = re.sub(r"\n\n+", "\n\n", paper_content)
+    paper_content = re.sub(r"\s\s+", " ", paper_content)
+    for phrase in [
+        " –\xa0arXiv Vanity",
+        "arXiv Vanity renders academic papers from",
+        "arXiv as responsive web pages so you",
+        "don’t have to squint at a PDF",
+        "View this paper on arXiv",
+        "arXiv Vanity",
+    ]:
+        paper_content = paper_content.replace(phrase, "")
+    paper_content = re.sub(
+        r"Generated by LaTeXML.*?Want to hear about new.*",
+        "",
+        paper_content,
+        flags=re.DOTALL,
+    )
+    for marker in [
+        "start_POSTSUPERSCRIPT",
+        "end_POSTSUPERSCRIPT",
+        "start_POSTSUBSCRIPT",
+        "end_POSTSUBSCRIPT",
+        "start_FLOATSUPERSCRIPT",
+        "end_FLOATSUPERSCRIPT",
+        "italic_",
+        "textbf_",
+        "textit_",
+        "texttt_",
+    ]:
+        paper_content = paper_content.replace(marker, "")
+    return paper_content
+
+
+NOISY_TEXT = (
+    "  \r\nTitle – arXiv Vanity\t\t of the paper \n\n\n  \n"
+    "arXiv Vanity renders academic papers from\narXiv as responsive web pages so"
+    " you\ndon’t have to squint at a PDF\nView this paper on arXiv \r\r"
+    "x start_POSTSUPERSCRIPT 2end_POSTSUPERSCRIPT and a_start_POSTSUBSCRIPT i"
+    "end_POSTSUBSCRIPT, start_FLOATSUPERSCRIPT*end_FLOATSUPERSCRIPT\n"
+    "italic_word textbf_bold textit_it texttt_code  \n \t\n"
+    "Generated by LaTeXML\nWant to hear about new tools? arXiv Vanity\n"
+)
+
+
+def fixture_texts(source=None):
+    return [
+        pytest.param(path, id=name)
+        for name, fixture_source, path in load_fixtures()
+        if source in (None, fixture_source)
+    ]
+
+
+def normalize_in_chunks(normalizer, text, size):
+    return "".join(
+        normalizer.iter_normalize(text[i : i + size] for i in range(0, len(text), size))
+    )
+
+
+@pytest.mark.parametrize("source", ["default", "arxiv-vanity"])
+@pytest.mark.parametrize("path", fixture_texts())
+def test_matches_the_baseline_on_fixtures(path, source):
+    text = parse_paper_content(path, backend="lxml")
+    normalizer = get_normalizer(source)
+    assert normalizer.normalize(text) == baseline_reduce(text)
+    assert normalize_in_chunks(normalizer, text, 4096) == baseline_reduce(text)
+
+
+# the ar5iv rules don't have the arXiv Vanity phrases, which ar5iv pages lack
+@pytest.mark.parametrize("path", fixture_texts("ar5iv"))
+def test_ar5iv_rules_match_the_baseline_on_ar5iv_fixtures(path):
+    text = parse_paper_content(path, backend="lxml")
+    assert get_normalizer("ar5iv").normalize(text) == baseline_reduce(text)
+
+
+@pytest.mark.parametrize("size", [1, 7, 64, len(NOISY_TEXT)])
+@pytest.mark.parametrize("source", ["default", "arxiv-vanity"])
+def test_matches_the_baseline_on_noise(source, size):
+    expected = baseline_reduce(NOISY_TEXT)
+    assert "Vanity" not in expected and "Generated" not in expected
+    assert normalize_in_chunks(get_normalizer(source), NOISY_TEXT, size) == expected
+
+
+def test_ar5iv_rules_keep_vanity_phrases():
+    text = "arXiv Vanity italic_text"
+    assert get_normalizer("ar5iv").normalize(text) == "arXiv Vanity text"
+    assert set(RULE_SETS) == {"default", "arxiv-vanity", "ar5iv"}
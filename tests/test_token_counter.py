@@ -0,0 +1,103 @@
+import json
+
+import pytest
+from click.testing import CliRunner
+
+import count_tokens
+from read_paper import extract_paper_content
+from run_benchmarks import load_fixtures
+from token_counter import count_tokens_batch, get_paper_tokens
+from token_counter import count_tokens as count_text_tokens
+
+# the pattern of the gpt2 encoding
+PAT_STR = r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+"""
+
+
+@pytest.fixture(scope="module")
+def tiktoken_enc():
+    """
+    A real tiktoken encoding with a small vocabulary: the bytes and a few
+    merges, so that it is built without downloading BPE ranks.
+    """
+    import tiktoken
+
+    ranks = {bytes([i]): i for i in range(256)}
+    for merge in [b"th", b"the", b" the", b"in", b"ing", b"er", b" a", b"on"]:
+        ranks[merge] = len(ranks)
+    return tiktoken.Encoding(
+        "small",
+        pat_str=PAT_STR,
+        mergeable_ranks=ranks,
+        special_tokens={"<|endoftext|>": len(ranks)},
+    )
+
+
+@pytest.fixture(scope="module")
+def sections():
+    _, source, path = load_fixtures()[0]
+    _, sections = extract_paper_content(path, parser="lxml", source=source)
+    return sections
+
+
+def test_batch_counts_equal_single_counts(tiktoken_enc, sections):
+    texts = sections + ["", "naïve café — 東京 ✓", "the thing\n\n  in the end"]
+    counts = count_tokens_batch(texts, tiktoken_enc, num_threads=4)
+    assert counts == [len(tiktoken_enc.encode(text)) for text in texts]
+    assert counts == [count_text_tokens(text, tiktoken_enc) for text in texts]
+    assert sum(counts) > sum(len(text.split()) for text in texts)
+
+
+def test_special_tokens_are_counted_as_text(tiktoken_enc):
+    text = "the end<|endoftext|>"
+    plain = len(tiktoken_enc.encode(text, disallowed_special=()))
+    assert count_text_tokens(text, tiktoken_enc) == plain
+    assert count_tokens_batch([text], tiktoken_enc) == [plain]
+
+
+class CountingEncoder:
+    def __init__(self, enc):
+        self.enc = enc
+        self.name = enc.name
+        self.batches = 0
+
+    def encode_ordinary_batch(self, texts, num_threads=8):
+        self.batches += 1
+        return self.enc.encode_ordinary_batch(texts, num_threads=num_threads)
+
+
+def test_paper_tokens_are_cached(paper_cache, enc, sections):
+    counting = CountingEncoder(enc)
+    paper_content = "\n\n".join(sections)
+    counts = get_paper_tokens(paper_cache, "abc.v2", paper_content, sections, counting)
+    assert counts["paper_content"] == len(paper_content.split())
+    assert counts["sections"] == [len(section.split()) for section in sections]
+    assert counts["prompt"] > counts["paper_content"]
+
+    again = get_paper_tokens(paper_cache, "abc.v2", paper_content, sections, counting)
+    assert again == counts
+    assert counting.batches == 1
+
+    # changed sections are counted again
+    sections = sections[:-1]
+    paper_content = "\n\n".join(sections)
+    get_paper_tokens(paper_cache, "abc.v2", paper_content, sections, counting)
+    assert counting.batches == 2
+    assert json.loads(paper_cache.get_text("abc.v2", "tokens"))["sections"] == [
+        len(section.split()) for section in sections
+    ]
+
+
+def test_count_tokens_cli(tmp_path, monkeypatch, enc):
+    monkeypatch.setattr(count_tokens, "get_encoder", lambda model: enc)
+    first = tmp_path / "first.txt"
+    first.write_text("one two three", encoding="utf-8")
+    second = tmp_path / "second.jsonl"
+    second.write_text("a b\nc d e\n", encoding="utf-8")
+    runner = CliRunner()
+
+    result = runner.invoke(count_tokens.main, input="one two")
+    assert result.output == "2\n"
+    result = runner.invoke(count_tokens.main, [str(first), str(second)])
+    assert result.output == f"3\t{first}\n5\t{second}\n8\ttotal\n"
+    result = runner.invoke(count_tokens.main, ["--lines", str(second)])
+    assert result.output == f"2\t{second}:1\n3\t{second}:2\n5\ttotal\n"
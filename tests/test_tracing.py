@@ -0,0 +1,118 @@
+import json
+import asyncio
+
+import pytest
+
+from tracing import Tracer, current_span, set_tracer, span, trace, traced
+
+
+@pytest.fixture
+def tracer(tmp_path):
+    tracer = Tracer(tmp_path / "trace.jsonl", tmp_path / "metrics.prom")
+    set_tracer(tracer)
+    yield tracer
+    set_tracer(None)
+    tracer.close()
+
+
+def read_spans(tracer):
+    tracer.close()
+    with open(tracer.trace_path, encoding="utf-8") as f:
+        return {record["name"]: record for record in map(json.loads, f)}
+
+
+def test_spans_nest_in_the_trace_of_a_paper(tracer):
+    with trace("2303.01469", source="ar5iv"):
+        with span("fetch", url="https://example.org"):
+            current_span().set(bytes=123)
+        with span("llm"):
+            with span("llm_stream"):
+                pass
+
+    spans = read_spans(tracer)
+    assert set(spans) == {"paper", "fetch", "llm", "llm_stream"}
+    paper = spans["paper"]
+    assert paper["parent_id"] is None
+    assert paper["source"] == "ar5iv"
+    assert spans["fetch"]["parent_id"] == paper["span_id"]
+    assert spans["fetch"]["bytes"] == 123
+    assert spans["llm"]["parent_id"] == paper["span_id"]
+    assert spans["llm_stream"]["parent_id"] == spans["llm"]["span_id"]
+    for record in spans.values():
+        assert record["trace_id"] == paper["trace_id"]
+        assert record["arxiv_id"] == "2303.01469"
+        assert record["duration"] <= paper["duration"]
+
+
+def test_concurrent_papers_have_their_own_traces(tracer):
+    @traced("fetch")
+    async def fetch():
+        await asyncio.sleep(0.01)
+
+    async def process(arxiv_id):
+        with trace(arxiv_id):
+            await fetch()
+
+    async def main():
+        await asyncio.gather(process("2301.00001"), process("2301.00002"))
+
+    asyncio.run(main())
+    tracer.close()
+    with open(tracer.trace_path, encoding="utf-8") as f:
+        records = [json.loads(line) for line in f]
+    papers = {r["span_id"]: r for r in records if r["name"] == "paper"}
+    fetches = [r for r in records if r["name"] == "fetch"]
+    assert len(papers) == len(fetches) == 2
+    for record in fetches:
+        parent = papers[record["parent_id"]]
+        assert (record["trace_id"], record["arxiv_id"]) == (
+            parent["trace_id"],
+            parent["arxiv_id"],
+        )
+
+
+def test_errors_are_recorded(tracer):
+    with pytest.raises(ValueError):
+        with trace("2303.01469"):
+            with span("parse"):
+                raise ValueError("bad HTML")
+
+    spans = read_spans(tracer)
+    assert spans["parse"]["error"] == "ValueError"
+    assert tracer.metrics.papers.values == {(("status", "error"),): 1}
+
+
+def test_metrics(tracer):
+    with trace("2303.01469"):
+        with span("llm", model="gpt-4", prompt_tokens=1000, completion_tokens=200):
+            with span("llm_stream", ttft=0.3, tokens_per_second=40.0):
+                pass
+        with span("compact", saved={"citations": 50, "tables": 20}):
+            pass
+    with trace("2304.00001"):
+        with span("llm", model="gpt-4", prompt_tokens=500, completion_tokens=100):
+            pass
+    tracer.close()
+
+    text = tracer.metrics_path.read_text(encoding="utf-8")
+    lines = set(text.splitlines())
+    assert "# TYPE paper_stage_duration_seconds histogram" in lines
+    assert 'paper_stage_duration_seconds_count{stage="llm"} 2' in lines
+    assert 'papers_total{status="ok"} 2' in lines
+    assert 'llm_prompt_tokens_total{model="gpt-4"} 1500' in lines
+    assert 'llm_completion_tokens_total{model="gpt-4"} 300' in lines
+    assert 'llm_time_to_first_token_seconds_bucket{le="0.25"} 0' in lines
+    assert 'llm_time_to_first_token_seconds_bucket{le="0.5"} 1' in lines
+    assert 'llm_time_to_first_token_seconds_bucket{le="+Inf"} 1' in lines
+    assert "llm_time_to_first_token_seconds_sum 0.3" in lines
+    assert 'llm_tokens_per_second_bucket{le="50"} 1' in lines
+    assert 'compaction_saved_tokens_total{rule="citations"} 50' in lines
+    # metrics without observations are left out
+    assert "llm_endpoint_requests_total" not in text
+
+
+def test_disabled_tracing_records_nothing(tmp_path):
+    with trace("2303.01469") as s:
+        s.set(error="ignored")
+        with span("fetch"):
+            current_span().set(bytes=123)